@@ -74,8 +74,16 @@ class PipelineParams(ParamGroup):
         self.compute_cov3D_python = False
         self.compute_view2gaussian_python = False
         self.debug = False
+        # "cuda" (diff_gaussian_rasterization) or "cpu" (utils/cpu_rasterizer.py, runs without the extension)
+        self.rasterizer = "cuda"
         super().__init__(parser, "Pipeline Parameters")
 
+    def extract(self, args):
+        g = super().extract(args)
+        if g.rasterizer not in ["cuda", "cpu"]:
+            raise ValueError(f"unknown rasterizer {g.rasterizer}, use cuda or cpu")
+        return g
+
 class OptimizationParams(ParamGroup):
     def __init__(self, parser):
         self.iterations = 30_000
@@ -102,6 +110,7 @@ class OptimizationParams(ParamGroup):
         self.densify_until_iter = 15_000
     
         self.lambda_dssim = 0.2
+        self.fused_ssim = False
         self.lambda_distortion = 0.
         self.lambda_depth_normal = 0.05
         self.lambda_fs = 10.0
@@ -143,6 +152,8 @@ class OptimizationParams(ParamGroup):
         self.ckpt_every = 5_000
 
         self.z_prune = False
+        # sort Gaussians along a Morton curve after each densification
+        self.morton_reorder = False
 
         super().__init__(parser, "Optimization Parameters")
 
@@ -3,7 +3,7 @@ import os
 from utils.general_utils import safe_state
 from argparse import ArgumentParser
 from arguments import ModelParams, PipelineParams, get_combined_args
-from gaussian_renderer import GaussianModel
+from scene.gaussian_model import GaussianModel
 
 if __name__ == "__main__":
     # Set up command line argument parser
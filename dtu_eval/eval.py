@@ -4,8 +4,11 @@ import open3d as o3d
 import sklearn.neighbors as skln
 from tqdm import tqdm
 from scipy.io import loadmat
+from scipy.spatial import cKDTree
 import multiprocessing as mp
 import argparse
+import json
+import os
 
 def sample_single_tri(input_):
     n1, n2, v1, v2, tri_vert = input_
@@ -18,27 +21,144 @@ def sample_single_tri(input_):
     q = v1 * k[:,:1] + v2 * k[:,1:] + tri_vert
     return q
 
+def sample_tris(n1, n2, v1, v2, tri_vert, max_points=1 << 24):
+    """Vectorized sample_single_tri over all triangles.
+
+    Triangles with the same (n1, n2) share one barycentric grid, so every group is
+    sampled with a single broadcast. The points are written back in triangle order
+    and equal np.concatenate([sample_single_tri(...) for each triangle]).
+    """
+    n1, n2 = n1.reshape(-1), n2.reshape(-1)
+    pairs, group = np.unique(np.stack([n1, n2], axis=-1), axis=0, return_inverse=True)
+    group = group.reshape(-1)
+    ks = []
+    for a, b in pairs:
+        c = np.mgrid[:a+1, :b+1]
+        c += 0.5
+        c[0] /= max(a, 1e-7)
+        c[1] /= max(b, 1e-7)
+        c = np.transpose(c, (1,2,0))
+        ks.append(c[c.sum(axis=-1) < 1])
+    counts = np.array([k.shape[0] for k in ks])[group]
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    out = np.empty((int(counts.sum()), 3), dtype=tri_vert.dtype)
+
+    order = np.argsort(group, kind='stable')
+    starts = np.searchsorted(group[order], np.arange(len(pairs)))
+    ends = np.append(starts[1:], len(group))
+    for g, k in enumerate(ks):
+        if k.shape[0] == 0:
+            continue
+        tris = order[starts[g]:ends[g]]
+        # bound the size of one broadcast
+        step = max(1, max_points // k.shape[0])
+        for i in range(0, tris.shape[0], step):
+            t = tris[i:i+step]
+            q = v1[t, None] * k[None, :, :1] + v2[t, None] * k[None, :, 1:] + tri_vert[t, None]
+            out[(offsets[t, None] + np.arange(k.shape[0])).reshape(-1)] = q.reshape(-1, 3)
+    return out
+
+def radius_pairs(points, radius, max_candidates=1 << 24):
+    """All pairs (i, j), i < j, with |p_i - p_j| <= radius.
+
+    Points are hashed into cells of size radius and sorted by cell, then every
+    cell is paired with itself and its 13 forward neighbours (each neighbouring
+    cell pair is visited once), and candidates are the products of their points.
+    """
+    cell = np.floor((points - points.min(axis=0)) / radius).astype(np.int64) + 1
+    dims = cell.max(axis=0) + 2
+    key = (cell[:, 0] * dims[1] + cell[:, 1]) * dims[2] + cell[:, 2]
+    order = np.argsort(key, kind='stable')
+    pts = points[order]
+    cell_keys, starts, counts = np.unique(key[order], return_index=True, return_counts=True)
+
+    offsets = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing='ij'), axis=-1).reshape(-1, 3)
+    offsets = offsets[13:]  # (0, 0, 0) and the forward half
+    pairs = []
+    for off in (offsets[:, 0] * dims[1] + offsets[:, 1]) * dims[2] + offsets[:, 2]:
+        pos = np.minimum(np.searchsorted(cell_keys, cell_keys + off), cell_keys.shape[0] - 1)
+        a = np.nonzero(cell_keys[pos] == cell_keys + off)[0]
+        b = pos[a]
+        sizes = counts[a] * counts[b]
+        bounds = np.concatenate([[0], np.cumsum(sizes)])
+        # split the cell pairs so one batch holds at most max_candidates candidates
+        cuts = np.searchsorted(bounds, np.arange(0, bounds[-1] + max_candidates, max_candidates))
+        for lo, hi in zip(cuts[:-1], np.maximum(cuts[1:], cuts[:-1] + 1)):
+            ca, cb, sz = a[lo:hi], b[lo:hi], sizes[lo:hi]
+            if sz.sum() == 0:
+                continue
+            pair = np.repeat(np.arange(ca.shape[0]), sz)
+            t = np.arange(sz.sum()) - np.repeat(np.cumsum(sz) - sz, sz)
+            i = starts[ca][pair] + t // counts[cb][pair]
+            j = starts[cb][pair] + t % counts[cb][pair]
+            keep = ((pts[i] - pts[j]) ** 2).sum(axis=-1) <= radius ** 2
+            if off == 0:
+                keep &= i < j
+            i, j = order[i[keep]], order[j[keep]]
+            pairs.append(np.stack([np.minimum(i, j), np.maximum(i, j)], axis=-1))
+    return np.concatenate(pairs, axis=0)
+
+def radius_downsample(points, radius):
+    """Keep a point unless an earlier kept point lies within radius, i.e. the same mask
+    as walking radius_neighbors in order, resolved in vectorized rounds over the pairs.
+    """
+    pairs = radius_pairs(points, radius)
+    # 1 undecided, 2 kept, 0 dropped
+    state = np.ones(points.shape[0], dtype=np.int8)
+    while True:
+        undecided = state == 1
+        # an undecided point waits while any earlier neighbour is not dropped
+        waiting = np.zeros(points.shape[0], dtype=np.bool_)
+        waiting[pairs[:, 1][state[pairs[:, 0]] != 0]] = True
+        state[undecided & ~waiting] = 2
+        killed = pairs[:, 1][state[pairs[:, 0]] == 2]
+        state[killed] = 0
+        pairs = pairs[(state[pairs[:, 0]] == 1) | (state[pairs[:, 1]] == 1)]
+        if not (state == 1).any():
+            break
+    return state == 2
+
 def write_vis_pcd(file, points, colors):
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(points)
     pcd.colors = o3d.utility.Vector3dVector(colors)
     o3d.io.write_point_cloud(file, pcd)
 
-if __name__ == '__main__':
-    mp.freeze_support()
+def load_gt(dataset_dir, scan, cache_dir=None):
+    """Observation mask, STL points (with the above-ground mask) and the STL KD-tree of one scan.
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--data', type=str, default='data_in.ply')
-    parser.add_argument('--scan', type=int, default=1)
-    parser.add_argument('--mode', type=str, default='mesh', choices=['mesh', 'pcd'])
-    parser.add_argument('--dataset_dir', type=str, default='.')
-    parser.add_argument('--vis_out_dir', type=str, default='.')
-    parser.add_argument('--downsample_density', type=float, default=0.2)
-    parser.add_argument('--patch_size', type=float, default=60)
-    parser.add_argument('--max_dist', type=float, default=20)
-    parser.add_argument('--visualize_threshold', type=float, default=10)
-    args = parser.parse_args()
+    With cache_dir the parsed arrays are stored as .npy and read back memory-mapped,
+    so repeated evaluations skip the .mat/.ply parsing. The KD-tree is rebuilt from
+    the mapped STL points, which is much cheaper than the parsing and avoids keeping
+    a second, pickled copy of the points.
+    """
+    prefix = None if cache_dir is None else os.path.join(cache_dir, f'scan{scan}')
+    if prefix is not None and os.path.exists(f'{prefix}_stl.npy'):
+        gt = {name: np.load(f'{prefix}_{name}.npy', mmap_mode='r') for name in ['ObsMask', 'BB', 'Res', 'stl', 'stl_above']}
+        gt['stl_tree'] = cKDTree(gt['stl'])
+        return gt
+
+    obs_mask_file = loadmat(f'{dataset_dir}/ObsMask/ObsMask{scan}_10.mat')
+    ObsMask, BB, Res = [obs_mask_file[attr] for attr in ['ObsMask', 'BB', 'Res']]
+    BB = BB.astype(np.float32)
+    stl_pcd = o3d.io.read_point_cloud(f'{dataset_dir}/Points/stl/stl{scan:03}_total.ply')
+    stl = np.asarray(stl_pcd.points)
+    ground_plane = loadmat(f'{dataset_dir}/ObsMask/Plane{scan}.mat')['P']
+    stl_hom = np.concatenate([stl, np.ones_like(stl[:,:1])], -1)
+    stl_above = (ground_plane.reshape((1,4)) * stl_hom).sum(-1) > 0
+    gt = {'ObsMask': ObsMask, 'BB': BB, 'Res': Res, 'stl': stl, 'stl_above': stl_above,
+          'stl_tree': cKDTree(stl)}
+
+    if prefix is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in ['ObsMask', 'BB', 'Res', 'stl_above']:
+            np.save(f'{prefix}_{name}.npy', gt[name])
+        # written last, its presence marks a complete cache entry
+        np.save(f'{prefix}_stl.tmp.npy', stl)
+        os.replace(f'{prefix}_stl.tmp.npy', f'{prefix}_stl.npy')
+    return gt
 
+def evaluate(args, gt=None):
     thresh = args.downsample_density
     if args.mode == 'mesh':
         pbar = tqdm(total=9)
@@ -64,10 +184,7 @@ if __name__ == '__main__':
         n1 = np.floor(l1 / thr)
         n2 = np.floor(l2 / thr)
 
-        with mp.Pool() as mp_pool:
-            new_pts = mp_pool.map(sample_single_tri, ((n1[i,0], n2[i,0], v1[i:i+1], v2[i:i+1], tri_vert[i:i+1,0]) for i in range(len(n1))), chunksize=1024)
-
-        new_pts = np.concatenate(new_pts, axis=0)
+        new_pts = sample_tris(n1, n2, v1, v2, tri_vert[:,0])
         data_pcd = np.concatenate([vertices, new_pts], axis=0)
     
     elif args.mode == 'pcd':
@@ -78,26 +195,20 @@ if __name__ == '__main__':
 
     pbar.update(1)
     pbar.set_description('random shuffle pcd index')
-    shuffle_rng = np.random.default_rng()
+    shuffle_rng = np.random.default_rng(args.seed)
     shuffle_rng.shuffle(data_pcd, axis=0)
 
     pbar.update(1)
     pbar.set_description('downsample pcd')
     nn_engine = skln.NearestNeighbors(n_neighbors=1, radius=thresh, algorithm='kd_tree', n_jobs=-1)
-    nn_engine.fit(data_pcd)
-    rnn_idxs = nn_engine.radius_neighbors(data_pcd, radius=thresh, return_distance=False)
-    mask = np.ones(data_pcd.shape[0], dtype=np.bool_)
-    for curr, idxs in enumerate(rnn_idxs):
-        if mask[curr]:
-            mask[idxs] = 0
-            mask[curr] = 1
+    mask = radius_downsample(data_pcd, thresh)
     data_down = data_pcd[mask]
 
     pbar.update(1)
     pbar.set_description('masking data pcd')
-    obs_mask_file = loadmat(f'{args.dataset_dir}/ObsMask/ObsMask{args.scan}_10.mat')
-    ObsMask, BB, Res = [obs_mask_file[attr] for attr in ['ObsMask', 'BB', 'Res']]
-    BB = BB.astype(np.float32)
+    if gt is None:
+        gt = load_gt(args.dataset_dir, args.scan, args.cache_dir)
+    ObsMask, BB, Res = gt['ObsMask'], gt['BB'], gt['Res']
 
     patch = args.patch_size
     inbound = ((data_down >= BB[:1]-patch) & (data_down < BB[1:]+patch*2)).sum(axis=-1) ==3
@@ -111,22 +222,17 @@ if __name__ == '__main__':
 
     pbar.update(1)
     pbar.set_description('read STL pcd')
-    stl_pcd = o3d.io.read_point_cloud(f'{args.dataset_dir}/Points/stl/stl{args.scan:03}_total.ply')
-    stl = np.asarray(stl_pcd.points)
+    stl = gt['stl']
 
     pbar.update(1)
     pbar.set_description('compute data2stl')
-    nn_engine.fit(stl)
-    dist_d2s, idx_d2s = nn_engine.kneighbors(data_in_obs, n_neighbors=1, return_distance=True)
+    dist_d2s, idx_d2s = gt['stl_tree'].query(data_in_obs, k=[1], workers=-1)
     max_dist = args.max_dist
     mean_d2s = dist_d2s[dist_d2s < max_dist].mean()
 
     pbar.update(1)
     pbar.set_description('compute stl2data')
-    ground_plane = loadmat(f'{args.dataset_dir}/ObsMask/Plane{args.scan}.mat')['P']
-
-    stl_hom = np.concatenate([stl, np.ones_like(stl[:,:1])], -1)
-    above = (ground_plane.reshape((1,4)) * stl_hom).sum(-1) > 0
+    above = gt['stl_above']
     stl_above = stl[above]
 
     nn_engine.fit(data_in)
@@ -157,12 +263,30 @@ if __name__ == '__main__':
     over_all = (mean_d2s + mean_s2d) / 2
     print(mean_d2s, mean_s2d, over_all)
     
-    import json
+    results = {
+        'mean_d2s': float(mean_d2s),
+        'mean_s2d': float(mean_s2d),
+        'overall': float(over_all),
+    }
     with open(f'{args.vis_out_dir}/results.json', 'w') as fp:
-        json.dump({
-            'mean_d2s': mean_d2s,
-            'mean_s2d': mean_s2d,
-            'overall': over_all,
-        }, fp, indent=True)
+        json.dump(results, fp, indent=True)
+    return results
+
+if __name__ == '__main__':
+    mp.freeze_support()
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data_in.ply')
+    parser.add_argument('--scan', type=int, default=1)
+    parser.add_argument('--mode', type=str, default='mesh', choices=['mesh', 'pcd'])
+    parser.add_argument('--dataset_dir', type=str, default='.')
+    parser.add_argument('--vis_out_dir', type=str, default='.')
+    parser.add_argument('--downsample_density', type=float, default=0.2)
+    parser.add_argument('--patch_size', type=float, default=60)
+    parser.add_argument('--max_dist', type=float, default=20)
+    parser.add_argument('--visualize_threshold', type=float, default=10)
+    parser.add_argument('--cache_dir', type=str, default=None, help='cache the parsed GT and KD-tree here')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the point shuffle before downsampling')
+    args = parser.parse_args()
 
+    evaluate(args)
@@ -0,0 +1,71 @@
+# evaluate many meshes against the DTU GT in one process pool, sharing the cached GT per scan
+import os
+import csv
+import json
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from eval import evaluate, load_gt
+
+
+def prepare_gt(dataset_dir, scan, cache_dir):
+    load_gt(dataset_dir, scan, cache_dir)
+    return scan
+
+
+def run_job(job):
+    gt = load_gt(job.dataset_dir, job.scan, job.cache_dir)
+    os.makedirs(job.vis_out_dir, exist_ok=True)
+    results = evaluate(job, gt)
+    return dict(scan=job.scan, data=job.data, **results)
+
+
+if __name__ == '__main__':
+    mp.freeze_support()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, nargs='+', required=True, help='meshes (or point clouds) to evaluate')
+    parser.add_argument('--scans', type=int, nargs='+', required=True, help='DTU scan of every --data entry')
+    parser.add_argument('--mode', type=str, default='mesh', choices=['mesh', 'pcd'])
+    parser.add_argument('--dataset_dir', type=str, default='.')
+    parser.add_argument('--out_dir', type=str, default='.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='defaults to <out_dir>/gt_cache')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--downsample_density', type=float, default=0.2)
+    parser.add_argument('--patch_size', type=float, default=60)
+    parser.add_argument('--max_dist', type=float, default=20)
+    parser.add_argument('--visualize_threshold', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    assert len(args.data) == len(args.scans), 'need one scan id per --data entry'
+
+    cache_dir = args.cache_dir or os.path.join(args.out_dir, 'gt_cache')
+    jobs = []
+    for i, (data, scan) in enumerate(zip(args.data, args.scans)):
+        job = argparse.Namespace(**vars(args))
+        job.data, job.scan, job.cache_dir = data, scan, cache_dir
+        job.vis_out_dir = os.path.join(args.out_dir, f'{i:03}_scan{scan}')
+        jobs.append(job)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # parse every scan's GT once, the jobs then read the memory-mapped cache
+        list(executor.map(prepare_gt, [args.dataset_dir] * len(set(args.scans)), sorted(set(args.scans)),
+                          [cache_dir] * len(set(args.scans))))
+        rows = list(executor.map(run_job, jobs))
+
+    keys = ['mean_d2s', 'mean_s2d', 'overall']
+    mean = {k: float(np.mean([row[k] for row in rows])) for k in keys}
+    os.makedirs(args.out_dir, exist_ok=True)
+    with open(os.path.join(args.out_dir, 'results.csv'), 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=['scan', 'data'] + keys)
+        writer.writeheader()
+        writer.writerows(rows)
+        writer.writerow(dict(scan='mean', data='', **mean))
+    with open(os.path.join(args.out_dir, 'results.json'), 'w') as fp:
+        json.dump({'scans': rows, 'mean': mean}, fp, indent=True)
+
+    for row in rows:
+        print(f"scan {row['scan']:>3}  d2s {row['mean_d2s']:.4f}  s2d {row['mean_s2d']:.4f}  overall {row['overall']:.4f}  {row['data']}")
+    print(f"mean      d2s {mean['mean_d2s']:.4f}  s2d {mean['mean_s2d']:.4f}  overall {mean['overall']:.4f}")
@@ -6,11 +6,11 @@ import os
 import argparse
 import torch
 import trimesh
-import pyrender
 import copy
 from copy import deepcopy
 import torch.nn.functional as F
-from help_func import auto_orient_and_center_poses
+from help_func import auto_orient_and_center_poses, connected_face_labels
+from rasterize import rasterize_depth
 import cv2
 
 
@@ -20,6 +20,7 @@ def extract_depth_from_mesh(mesh,
                             far=20.0,):
     """Adapted from Go-Surf: https://github.com/JingwenWang95/go-surf"""
     os.environ['PYOPENGL_PLATFORM'] = 'egl'  # allows for GPU-accelerated rendering
+    import pyrender
     scene = pyrender.Scene()
     #mesh = trimesh.load("/home/yuzh/mnt/A100_data/sdfstudio/meshes_tnt/bakedangelo/Courthouse_fullres_1024.ply")
     #mesh = trimesh.load("/home/yuzh/mnt/A100_data/sdfstudio/meshes_tnt/bakedangelo/Caterpillar_fullres_1024.ply")
@@ -67,7 +68,7 @@ def extract_depth_from_mesh(mesh,
 
 
 class Mesher(object):
-    def __init__(self, H, W, fx, fy, cx, cy, far, points_batch_size=5e5):
+    def __init__(self, H, W, fx, fy, cx, cy, far, points_batch_size=5e5, camera_batch_size=16, renderer='pyrender', device='cuda:0'):
         """
         Mesher class, given a scene representation, the mesher extracts the mesh from it.
         Args:
@@ -76,13 +77,18 @@ class Mesher(object):
             slam:                       (class NICE-SLAM), NICE-SLAM main class
             points_batch_size:          (int), maximum points size for query in one batch
                                         Used to alleviate GPU memory usage. Defaults to 5e5
+            camera_batch_size:          (int), number of cameras (depth maps) tested per grid_sample call
             ray_batch_size:             (int), maximum ray size for query in one batch
                                         Used to alleviate GPU memory usage. Defaults to 1e5
+            renderer:                   (str), 'pyrender' (OpenGL/EGL) or 'software' (CPU z-buffer)
+            device:                     (str), device for the depth tests and the software renderer
         """
 
         self.points_batch_size = int(points_batch_size)
+        self.camera_batch_size = int(camera_batch_size)
         self.scale = 1.0
-        self.device = 'cuda:0'
+        self.device = device
+        self.renderer = renderer
         self.forecast_radius = 0
         self.H, self.W, self.fx, self.fy, self.cx, self.cy = H, W, fx, fy, cx, cy
 
@@ -115,69 +121,50 @@ class Mesher(object):
 
         """
         H, W, fx, fy, cx, cy = self.H, self.W, self.fx, self.fy, self.cx, self.cy
-        device =self.device
+        device = self.device
         if not isinstance(input_points, torch.Tensor):
             input_points = torch.from_numpy(input_points)
-        input_points = input_points.clone().detach().float()
-        mask = []
-        forecast_mask = []
+        points = input_points.clone().detach().float().to(device)
+        n_pts = points.shape[0]
         # this eps should be tuned for the scene
         eps = 0.005
-        for _, pnts in enumerate(torch.split(input_points, self.points_batch_size, dim=0)):
-            n_pts, _ = pnts.shape
-            valid = torch.zeros(n_pts).to(device).bool()
-            valid_num = torch.zeros(n_pts).to(device).int()
-            valid_forecast = torch.zeros(n_pts).to(device).bool()
-            r = self.forecast_radius
-            for i in range(len(estimate_c2w_list)):
-                points = pnts.to(device).float()
-                c2w = estimate_c2w_list[i].to(device).float()
-                # transform to opencv coordinate as nerfstudio dataparser's .json file is in opengl coordinate
-                c2w[:3, 1:3] *= -1
-
-                depth = depth_list[i].to(device)
-                w2c = torch.inverse(c2w).to(device).float()
-                ones = torch.ones_like(points[:, 0]).reshape(-1, 1).to(device)
-                homo_points = torch.cat([points, ones], dim=1).reshape(-1, 4, 1).to(device).float()
-                cam_cord_homo = w2c @ homo_points
-                cam_cord = cam_cord_homo[:, :3, :]  # [N, 3, 1]
-                K = np.eye(3)
-                K[0, 0], K[0, 2], K[1, 1], K[1, 2] = fx, cx, fy, cy
-                K = torch.from_numpy(K).to(device)
-
-                uv = K.float() @ cam_cord.float()
-                z = uv[:, -1:] + 1e-8
-                uv = uv[:, :2] / z  # [N, 2, 1]
-                u, v = uv[:, 0, 0].float(), uv[:, 1, 0].float()
-                z = z[:, 0, 0].float()
+        r = self.forecast_radius
+
+        # all w2c and K once, nerfstudio's .json file is in opengl coordinate so flip to opencv
+        c2ws = torch.stack([c2w.float() for c2w in estimate_c2w_list]).to(device)
+        c2ws[:, :3, 1:3] *= -1
+        w2cs = torch.inverse(c2ws)
+        K = torch.tensor([[fx, 0., cx], [0., fy, cy], [0., 0., 1.]], device=device)
+        KR = K @ w2cs[:, :3, :3]
+        Kt = K @ w2cs[:, :3, 3:]
+
+        valid_num = torch.zeros(n_pts, dtype=torch.int16, device=device)
+        valid_forecast = torch.zeros(n_pts, dtype=torch.bool, device=device)
+        for c in range(0, len(estimate_c2w_list), self.camera_batch_size):
+            depth = torch.stack(depth_list[c:c + self.camera_batch_size]).to(device).float()
+            n_cams = depth.shape[0]
+            depth = depth.reshape(n_cams, 1, H, W)
+            for start in range(0, n_pts, self.points_batch_size):
+                pnts = points[start:start + self.points_batch_size]
+                uv = KR[c:c + n_cams] @ pnts.T + Kt[c:c + n_cams]  # [B, 3, N]
+                z = uv[:, 2] + 1e-8
+                u, v = uv[:, 0] / z, uv[:, 1] / z
 
                 in_frustum = (u >= 0) & (u <= W-1) & (v >= 0) & (v <= H-1) & (z > 0)
                 forecast_frustum = (u >= -r) & (u <= W-1+r) & (v >= -r) & (v <= H-1+r) & (z > 0)
 
-                depth = depth.reshape(1, 1, H, W)
-                vgrid = uv.reshape(1, 1, -1, 2)
                 # normalized to [-1, 1]
-                vgrid[..., 0] = (vgrid[..., 0] / (W - 1) * 2.0 - 1.0)
-                vgrid[..., 1] = (vgrid[..., 1] / (H - 1) * 2.0 - 1.0)
-
-                depth_sample = F.grid_sample(depth, vgrid, padding_mode='border', align_corners=True)
-                depth_sample = depth_sample.reshape(-1)
-                is_front_face = torch.where((depth_sample > 0.0), (z < (depth_sample + eps)), torch.ones_like(z).bool())
-                is_forecast_face = torch.where((depth_sample > 0.0), (z < (depth_sample + eps)), torch.ones_like(z).bool())
+                vgrid = torch.stack([u / (W - 1) * 2.0 - 1.0, v / (H - 1) * 2.0 - 1.0], dim=-1)[:, None]
+                depth_sample = F.grid_sample(depth, vgrid, padding_mode='border', align_corners=True)[:, 0, 0]
+                is_front_face = (depth_sample <= 0.0) | (z < (depth_sample + eps))
                 in_frustum = in_frustum & is_front_face
 
-                valid = valid | in_frustum.bool()
-                valid_num = valid_num + in_frustum.int()
-
-                forecast_frustum = forecast_frustum & is_forecast_face
-                forecast_frustum = in_frustum | forecast_frustum
-                valid_forecast = valid_forecast | forecast_frustum.bool()
-            valid = valid_num >= 20
-            mask.append(valid.cpu().numpy())
-            forecast_mask.append(valid_forecast.cpu().numpy())
+                valid_num[start:start + pnts.shape[0]] += in_frustum.sum(dim=0, dtype=torch.int16)
+                forecast_frustum = (forecast_frustum & is_front_face) | in_frustum
+                valid_forecast[start:start + pnts.shape[0]] |= forecast_frustum.any(dim=0)
 
-        mask = np.concatenate(mask, axis=0)
-        forecast_mask = np.concatenate(forecast_mask, axis=0)
+        mask = (valid_num >= 20).cpu().numpy()
+        forecast_mask = valid_forecast.cpu().numpy()
 
         return mask, forecast_mask
 
@@ -185,18 +172,17 @@ class Mesher(object):
     @torch.no_grad()
     def get_connected_mesh(self, mesh, get_largest_components=False):
         print("split")
-        components = mesh.split(only_watertight=False)
+        vertices, faces = np.asarray(mesh.vertices), np.asarray(mesh.faces)
+        labels, areas = connected_face_labels(vertices, faces)
         print("split completed")
         if get_largest_components:
-            areas = np.array([c.area for c in components], dtype=np.float)
-            mesh = components[areas.argmax()]
+            keep = np.arange(areas.shape[0]) == areas.argmax()
         else:
-            new_components = []
-            global_area = mesh.area
-            for comp in components:
-                if comp.area > self.remove_small_geometry_threshold * global_area:
-                    new_components.append(comp)
-            mesh = trimesh.util.concatenate(new_components)
+            keep = areas > self.remove_small_geometry_threshold * areas.sum()
+        face_mask = keep[labels]
+        used, remap = np.unique(faces[face_mask], return_inverse=True)
+        vertex_colors = mesh.visual.vertex_colors[used] if mesh.visual.kind == 'vertex' else None
+        mesh = trimesh.Trimesh(vertices[used], remap.reshape(-1, 3), vertex_colors=vertex_colors, process=False)
 
         return mesh
 
@@ -216,9 +202,15 @@ class Mesher(object):
 
         # cull with 3d projection
         print(f' --->> {step}(Projection)', end='')
-        forward_depths = extract_depth_from_mesh(
-            mesh, estimate_c2w_list, H=self.H, W=self.W, fx=self.fx, fy=self.fy, cx=self.cx, cy=self.cy, far=20.0
-        )
+        if self.renderer == 'software':
+            forward_depths = rasterize_depth(
+                mesh.vertices, mesh.faces, estimate_c2w_list, H=self.H, W=self.W, fx=self.fx, fy=self.fy, cx=self.cx, cy=self.cy,
+                far=20.0, device=self.device
+            )
+        else:
+            forward_depths = extract_depth_from_mesh(
+                mesh, estimate_c2w_list, H=self.H, W=self.W, fx=self.fx, fy=self.fy, cx=self.cx, cy=self.cy, far=20.0
+            )
         print("after forward depth")
         """        
         backward_mesh = deepcopy(mesh)
@@ -314,7 +306,8 @@ class Mesher(object):
         if self.verbose:
             print("\nINFO: Save mesh at {}!\n".format(mesh_out_file))
 
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
 
 def get_traj(traj_path):
@@ -378,9 +371,15 @@ if __name__ == "__main__":
         required=True,
         help="path to reconstruction ply file",
     )
+    parser.add_argument(
+        "--renderer",
+        type=str,
+        default="pyrender",
+        choices=["pyrender", "software"],
+        help="depth renderer, software runs without OpenGL/EGL",
+    )
+    parser.add_argument("--device", type=str, default="cuda:0")
     args = parser.parse_args()
-        
-    import ipdb; ipdb.set_trace()
 
     estimate_c2w_list = get_traj(args.traj_path)
 
@@ -399,7 +398,7 @@ if __name__ == "__main__":
     cy = 272.5
     far = 100.0
 
-    mesher = Mesher(H, W, fx, fy, cx, cy, far, points_batch_size=5e5)
+    mesher = Mesher(H, W, fx, fy, cx, cy, far, points_batch_size=5e5, renderer=args.renderer, device=args.device)
     # mesher = Mesher(H*2, W*2, fx*2, fy*2, cx*2, cy*2, far, points_batch_size=5e5)
 
     mesher(args.ply_path, estimate_c2w_list)
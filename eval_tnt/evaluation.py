@@ -34,11 +34,11 @@
 # https://tanksandtemples.org/license/
 
 import json
-import copy
 import os
 import numpy as np
 import open3d as o3d
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 
 
 def read_alignment_transformation(filename):
@@ -57,6 +57,31 @@ def write_color_distances(path, pcd, distances, max_distance):
     o3d.io.write_point_cloud(path, pcd)
 
 
+def prepare_target(target, crop_volume, voxel_size):
+    """Crop and voxel-downsample the GT cloud, returns (pcd, KD-tree of its points)."""
+    if crop_volume is not None:
+        t = crop_volume.crop_point_cloud(target)
+    else:
+        print("No bounding box provided to crop groundtruth point cloud, leaving it as the loaded version!!")
+        t = target
+    t = t.voxel_down_sample(voxel_size)
+    t.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamKNN(knn=20))
+    return t, cKDTree(np.asarray(t.points))
+
+
+def compute_distances(source_points, target_points, target_tree=None, workers=-1):
+    """
+    Nearest neighbour distances source -> target (precision) and target -> source
+    (recall), as compute_point_cloud_distance but with parallel KD-tree queries.
+    target_tree can be passed in to reuse the GT tree between evaluations.
+    """
+    if target_tree is None:
+        target_tree = cKDTree(target_points)
+    distance1, _ = target_tree.query(source_points, workers=workers)
+    distance2, _ = cKDTree(source_points).query(target_points, workers=workers)
+    return distance1, distance2
+
+
 def EvaluateHisto(
     source,
     target,
@@ -69,11 +94,19 @@ def EvaluateHisto(
     scene_name,
     view_crop,
     verbose=True,
+    target_tree=None,
+    thresholds=None,
 ):
+    """
+    target_tree: KD-tree of the target points, in which case target is taken as
+    already cropped and downsampled (see prepare_target).
+    thresholds: optional list of distance thresholds, the P/R/F1 sweep over them
+    is written to <scene>.prf_sweep.txt from the same distances.
+    """
     print("[EvaluateHisto]")
     o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Debug)
-    s = copy.deepcopy(source)
-    s.transform(trans)
+    points = np.asarray(source.points) @ trans[:3, :3].T + trans[:3, 3]
+    s = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
     if crop_volume is not None:
         s = crop_volume.crop_point_cloud(s)
         if view_crop:
@@ -84,18 +117,12 @@ def EvaluateHisto(
     s.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamKNN(knn=20))
     print(filename_mvs + "/" + scene_name + ".precision.ply")
 
-    t = copy.deepcopy(target)
-    if crop_volume is not None:
-        t = crop_volume.crop_point_cloud(t)
+    if target_tree is None:
+        t, target_tree = prepare_target(target, crop_volume, voxel_size)
     else:
-        print("No bounding box provided to crop groundtruth point cloud, leaving it as the loaded version!!")
-
-    t = t.voxel_down_sample(voxel_size)
-    t.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamKNN(knn=20))
-    print("[compute_point_cloud_to_point_cloud_distance]")
-    distance1 = s.compute_point_cloud_distance(t)
+        t = target
     print("[compute_point_cloud_to_point_cloud_distance]")
-    distance2 = t.compute_point_cloud_distance(s)
+    distance1, distance2 = compute_distances(np.asarray(s.points), target_tree.data, target_tree)
 
     # write the distances to bin files
     # np.array(distance1).astype("float64").tofile(
@@ -158,6 +185,12 @@ def EvaluateHisto(
         filename_mvs + "/" + scene_name + ".prf_tau_plotstr.txt",
         np.array([precision, recall, fscore, threshold, plot_stretch]),
     )
+    if thresholds is not None:
+        sweep = np.stack([thresholds, *sweep_f1_scores(distance1, distance2, thresholds)], axis=1)
+        np.savetxt(filename_mvs + "/" + scene_name + ".prf_sweep.txt", sweep,
+                   header="threshold precision recall fscore")
+        for row in sweep:
+            print("tau %.4f  precision %.4f  recall %.4f  f-score %.4f" % tuple(row))
 
     return [
         precision,
@@ -178,13 +211,15 @@ def get_f1_score_histo2(threshold,
                         verbose=True):
     print("[get_f1_score_histo2]")
     dist_threshold = threshold
+    distance1 = np.asarray(distance1)
+    distance2 = np.asarray(distance2)
     if len(distance1) and len(distance2):
 
-        recall = float(sum(d < threshold for d in distance2)) / float(
+        recall = float(np.count_nonzero(distance2 < threshold)) / float(
             len(distance2))
-        precision = float(sum(d < threshold for d in distance1)) / float(
+        precision = float(np.count_nonzero(distance1 < threshold)) / float(
             len(distance1))
-        fscore = 2 * recall * precision / (recall + precision)
+        fscore = 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0
         num = len(distance1)
         bins = np.arange(0, dist_threshold * plot_stretch, dist_threshold / 100)
         hist, edges_source = np.histogram(distance1, bins)
@@ -213,3 +248,19 @@ def get_f1_score_histo2(threshold,
         edges_target,
         cum_target,
     ]
+
+
+def sweep_f1_scores(distance1, distance2, thresholds):
+    """Precision, recall and F1 for every threshold from one sort of each distance array."""
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    distance1 = np.sort(np.asarray(distance1))
+    distance2 = np.sort(np.asarray(distance2))
+    if not len(distance1) or not len(distance2):
+        zeros = np.zeros_like(thresholds)
+        return zeros, zeros, zeros
+    # d < threshold, as in get_f1_score_histo2
+    precision = np.searchsorted(distance1, thresholds, side="left") / len(distance1)
+    recall = np.searchsorted(distance2, thresholds, side="left") / len(distance2)
+    denom = precision + recall
+    fscore = np.where(denom > 0, 2 * precision * recall / np.where(denom > 0, denom, 1), 0)
+    return precision, recall, fscore
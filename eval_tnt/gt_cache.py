@@ -0,0 +1,128 @@
+# preprocess the Tanks and Temples ground truth once per scene and voxel size:
+#   python gt_cache.py --dataset-dir <TNT>/Barn --cache-dir <cache>
+# run.py --gt-cache <cache> then loads the cropped, downsampled GT memory-mapped
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import open3d as o3d
+from scipy.spatial import cKDTree
+
+from config import scenes_tau_dict
+from registration import crop_and_downsample, read_trajectory
+from trajectory_io import CameraPose
+
+
+def voxel_key(voxel_size):
+    return "vox%.6g" % voxel_size
+
+
+def preprocess_gt(dataset_dir, cache_dir, voxel_sizes=None):
+    """
+    Write the GT of one scene to <cache_dir>/<scene>: the alignment, the COLMAP
+    poses, the crop file, and for every voxel size the cropped, downsampled GT
+    points and normals, and the uniform subsample used by
+    registration_unif. Defaults to the voxel sizes run.py uses (tau, tau / 2).
+    """
+    scene = os.path.basename(os.path.normpath(dataset_dir))
+    dTau = scenes_tau_dict[scene]
+    if voxel_sizes is None:
+        voxel_sizes = [dTau, dTau / 2.0]
+    out = os.path.join(cache_dir, scene)
+    os.makedirs(out, exist_ok=True)
+
+    np.save(os.path.join(out, "trans.npy"), np.loadtxt(os.path.join(dataset_dir, scene + "_trans.txt")))
+    gt_traj_col = read_trajectory(os.path.join(dataset_dir, scene + "_COLMAP_SfM.log"))
+    np.save(os.path.join(out, "colmap_poses.npy"), np.stack([c.pose for c in gt_traj_col]))
+    shutil.copy(os.path.join(dataset_dir, scene + ".json"), os.path.join(out, "crop.json"))
+
+    gt_pcd = o3d.io.read_point_cloud(os.path.join(dataset_dir, scene + ".ply"))
+    vol = o3d.visualization.read_selection_polygon_volume(os.path.join(out, "crop.json"))
+    unif = crop_and_downsample(gt_pcd, vol, down_sample_method="uniform")
+    np.save(os.path.join(out, "unif_points.npy"), np.asarray(unif.points))
+
+    meta = {"scene": scene, "voxel_sizes": []}
+    for voxel_size in voxel_sizes:
+        t = crop_and_downsample(gt_pcd, vol, down_sample_method="voxel", voxel_size=voxel_size)
+        t.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamKNN(knn=20))
+        prefix = os.path.join(out, voxel_key(voxel_size))
+        np.save(prefix + "_points.npy", np.asarray(t.points))
+        np.save(prefix + "_normals.npy", np.asarray(t.normals))
+        meta["voxel_sizes"].append(voxel_size)
+        print("%s: %d GT points at voxel size %g" % (scene, len(t.points), voxel_size))
+
+    # written last, its presence marks a complete cache entry
+    with open(os.path.join(out, "meta.json.tmp"), "w") as fp:
+        json.dump(meta, fp)
+    os.replace(os.path.join(out, "meta.json.tmp"), os.path.join(out, "meta.json"))
+    return out
+
+
+def has_gt(cache_dir, scene, voxel_sizes=()):
+    meta_file = os.path.join(cache_dir, scene, "meta.json")
+    if not os.path.exists(meta_file):
+        return False
+    with open(meta_file) as fp:
+        cached = [voxel_key(v) for v in json.load(fp)["voxel_sizes"]]
+    return all(voxel_key(v) in cached for v in voxel_sizes)
+
+
+def to_pcd(points, normals=None):
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(normals)
+    return pcd
+
+
+def load_gt(cache_dir, scene, tree_voxel_sizes=()):
+    """
+    Cached GT of one scene, arrays are memory-mapped. Returns a dict with
+    trans, gt_traj_col (CameraPose list), crop_file, unif_points and
+    per voxel key ("vox0.005", ...) a dict of points and normals. A KD-tree
+    of the mapped points is only built for the voxel sizes in
+    tree_voxel_sizes, under "tree"; trees are not stored in the cache.
+    """
+    out = os.path.join(cache_dir, scene)
+    with open(os.path.join(out, "meta.json")) as fp:
+        meta = json.load(fp)
+    gt = {
+        "trans": np.load(os.path.join(out, "trans.npy")),
+        "gt_traj_col": [CameraPose(meta=None, mat=pose) for pose in np.load(os.path.join(out, "colmap_poses.npy"))],
+        "crop_file": os.path.join(out, "crop.json"),
+        "unif_points": np.load(os.path.join(out, "unif_points.npy"), mmap_mode="r"),
+    }
+    tree_keys = [voxel_key(v) for v in tree_voxel_sizes]
+    for voxel_size in meta["voxel_sizes"]:
+        key = voxel_key(voxel_size)
+        prefix = os.path.join(out, key)
+        gt[key] = {
+            "points": np.load(prefix + "_points.npy", mmap_mode="r"),
+            "normals": np.load(prefix + "_normals.npy", mmap_mode="r"),
+        }
+        if key in tree_keys:
+            gt[key]["tree"] = cKDTree(gt[key]["points"])
+    return gt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset-dir",
+        type=str,
+        nargs="+",
+        required=True,
+        help="scene directories containing X.json, X.ply, ...",
+    )
+    parser.add_argument("--cache-dir", type=str, required=True)
+    parser.add_argument(
+        "--voxel-sizes",
+        type=float,
+        nargs="+",
+        default=None,
+        help="default: the scene tau and tau / 2, as used by run.py",
+    )
+    args = parser.parse_args()
+
+    for dataset_dir in args.dataset_dir:
+        print("GT cache written to %s" % preprocess_gt(dataset_dir, args.cache_dir, args.voxel_sizes))
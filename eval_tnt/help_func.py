@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # coding=utf-8
+import numpy as np
 import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 def rotation_matrix(a, b):
     """Compute the rotation matrix that rotates vector a to vector b.
@@ -88,3 +91,28 @@ def auto_orient_and_center_poses(
     return oriented_poses, transform
 
 
+def connected_face_labels(vertices, faces):
+    """Label faces by edge-connected component and return the area of every component.
+
+    Args:
+        vertices: (V, 3) vertex positions.
+        faces: (F, 3) vertex indices.
+
+    Returns:
+        Per-face component labels and per-component areas.
+    """
+    num_faces = faces.shape[0]
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, edge_ids = np.unique(edges, axis=0, return_inverse=True)
+    # bipartite face / edge graph, faces sharing an edge end up connected
+    rows = np.repeat(np.arange(num_faces), 3)
+    cols = num_faces + edge_ids.reshape(-1)
+    n = int(cols.max()) + 1
+    graph = coo_matrix((np.ones(rows.shape[0], dtype=np.int8), (rows, cols)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    _, labels = np.unique(labels[:num_faces], return_inverse=True)
+    labels = labels.reshape(-1)
+
+    tris = vertices[faces]
+    face_area = 0.5 * np.linalg.norm(np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]), axis=1)
+    return labels, np.bincount(labels, weights=face_area)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding=utf-8
+import time
+import numpy as np
+import torch
+
+
+@torch.no_grad()
+def rasterize_depth(vertices, faces, c2w_list, H, W, fx, fy, cx, cy, near=0.01, far=20.0,
+                    view_batch=4, max_candidates=1 << 24, device='cpu'):
+    """Z-buffer depth maps of a triangle mesh, a drop-in for the pyrender depth pass.
+
+    Poses are OpenGL camera-to-world matrices as given to pyrender. Pixels are
+    sampled at their centres, depth is the perspective-correct camera z, faces
+    are not culled, and pixels without a hit (or beyond far) are 0.
+
+    Each triangle is expanded into the pixels of its screen bounding box, the
+    candidates are tested with barycentric coordinates and reduced into the
+    depth buffer with scatter_reduce(amin). Several views share one buffer and
+    the candidates are processed in chunks of at most max_candidates.
+
+    Triangles with a vertex closer than near are skipped instead of clipped.
+
+    Args:
+        vertices: (V, 3) array or tensor.
+        faces: (F, 3) array or tensor.
+        c2w_list: list of (4, 4) tensors.
+
+    Returns:
+        List of (H, W) depth tensors on the CPU.
+    """
+    vertices = torch.as_tensor(np.asarray(vertices), dtype=torch.float32, device=device)
+    faces = torch.as_tensor(np.asarray(faces), dtype=torch.long, device=device)
+    flip = torch.tensor([1.0, -1.0, -1.0], device=device)
+
+    depths = []
+    start_time = time.time()
+    for v0 in range(0, len(c2w_list), view_batch):
+        c2ws = torch.stack([c2w.to(device).float() for c2w in c2w_list[v0:v0 + view_batch]])
+        n_views = c2ws.shape[0]
+        w2cs = torch.inverse(c2ws)
+        # OpenGL -> OpenCV camera coordinates
+        cam = (vertices[None] @ w2cs[:, :3, :3].transpose(1, 2) + w2cs[:, None, :3, 3]) * flip
+        z = cam[..., 2]
+        u = fx * cam[..., 0] / z + cx
+        v = fy * cam[..., 1] / z + cy
+
+        tri_z = z[:, faces]  # [B, F, 3]
+        tri_u, tri_v = u[:, faces], v[:, faces]
+        ok = (tri_z > near).all(dim=-1) & (tri_z < far).any(dim=-1)
+        # pixel i covers [i, i + 1), its centre is at i + 0.5
+        x0 = torch.ceil(tri_u.min(dim=-1).values - 0.5).clamp(min=0)
+        x1 = torch.floor(tri_u.max(dim=-1).values - 0.5).clamp(max=W - 1)
+        y0 = torch.ceil(tri_v.min(dim=-1).values - 0.5).clamp(min=0)
+        y1 = torch.floor(tri_v.max(dim=-1).values - 0.5).clamp(max=H - 1)
+        ok &= (x1 >= x0) & (y1 >= y0)
+
+        view_idx, face_idx = ok.nonzero(as_tuple=True)
+        x0, y0 = x0[view_idx, face_idx].long(), y0[view_idx, face_idx].long()
+        bw = x1[view_idx, face_idx].long() - x0 + 1
+        bh = y1[view_idx, face_idx].long() - y0 + 1
+        tu, tv, tz = tri_u[view_idx, face_idx], tri_v[view_idx, face_idx], tri_z[view_idx, face_idx]
+
+        # edge function denominators, degenerate triangles are dropped
+        area = (tu[:, 1] - tu[:, 0]) * (tv[:, 2] - tv[:, 0]) - (tu[:, 2] - tu[:, 0]) * (tv[:, 1] - tv[:, 0])
+        keep = area.abs() > 1e-12
+        view_idx, x0, y0, bw, bh, tu, tv, tz, area = [t[keep] for t in [view_idx, x0, y0, bw, bh, tu, tv, tz, area]]
+
+        zbuf = torch.full((n_views * H * W,), float('inf'), device=device)
+        counts = bw * bh
+        bounds = torch.cat([torch.zeros(1, dtype=torch.long, device=device), torch.cumsum(counts, 0)])
+        # chunk boundaries (triangle indices), a single huge triangle gets a chunk of its own
+        cuts = torch.searchsorted(bounds, torch.arange(0, int(bounds[-1]), max_candidates, device=device))
+        cuts = torch.unique(torch.cat([cuts, torch.tensor([counts.shape[0]], device=device)])).tolist()
+        for lo, hi in zip(cuts[:-1], cuts[1:]):
+            c = counts[lo:hi]
+            tri = torch.repeat_interleave(torch.arange(lo, hi, device=device), c)
+            local = torch.arange(int(c.sum()), device=device) - torch.repeat_interleave(torch.cumsum(c, 0) - c, c)
+            px = x0[tri] + local % bw[tri]
+            py = y0[tri] + local // bw[tri]
+            pu, pv = px.float() + 0.5, py.float() + 0.5
+
+            a, b, d = tu[tri], tv[tri], area[tri]
+            w0 = ((a[:, 1] - pu) * (b[:, 2] - pv) - (a[:, 2] - pu) * (b[:, 1] - pv)) / d
+            w1 = ((a[:, 2] - pu) * (b[:, 0] - pv) - (a[:, 0] - pu) * (b[:, 2] - pv)) / d
+            w2 = 1 - w0 - w1
+            inside = (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+            zs = tz[tri]
+            depth = 1 / (w0 / zs[:, 0] + w1 / zs[:, 1] + w2 / zs[:, 2])
+            inside &= depth <= far
+
+            pix = (view_idx[tri] * H + py) * W + px
+            zbuf.scatter_reduce_(0, pix[inside], depth[inside], reduce='amin')
+
+        zbuf[torch.isinf(zbuf)] = 0
+        depths.extend(zbuf.reshape(n_views, H, W).cpu().unbind(0))
+
+    elapsed = time.time() - start_time
+    print(f'software rasterizer: {faces.shape[0] * len(c2w_list) / max(elapsed, 1e-9):.3e} faces x views / s')
+    return depths
@@ -138,6 +138,7 @@ def registration_unif(
     max_itr,
     max_size=4 * MAX_POINT_NUMBER,
     verbose=True,
+    target_prepared=False,
 ):
     if verbose:
         print("[Registration] threshold: %f" % threshold)
@@ -146,9 +147,10 @@ def registration_unif(
                             crop_volume,
                             down_sample_method="uniform",
                             trans=init_trans)
-    t = crop_and_downsample(gt_target,
-                            crop_volume,
-                            down_sample_method="uniform")
+    # target_prepared: gt_target is already cropped and downsampled (gt_cache.py)
+    t = gt_target if target_prepared else crop_and_downsample(gt_target,
+                                                              crop_volume,
+                                                              down_sample_method="uniform")
     reg = o3d.registration.registration_icp(
         s,
         t,
@@ -170,6 +172,7 @@ def registration_vol_ds(
     threshold,
     max_itr,
     verbose=True,
+    target_prepared=False,
 ):
     if verbose:
         print("[Registration] voxel_size: %f, threshold: %f" %
@@ -182,7 +185,7 @@ def registration_vol_ds(
         voxel_size=voxel_size,
         trans=init_trans,
     )
-    t = crop_and_downsample(
+    t = gt_target if target_prepared else crop_and_downsample(
         gt_target,
         crop_volume,
         down_sample_method="voxel",
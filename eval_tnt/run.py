@@ -51,11 +51,12 @@ from registration import (
 # from help_func import auto_orient_and_center_poses
 from trajectory_io import CameraPose
 from evaluation import EvaluateHisto
+from gt_cache import has_gt, load_gt, preprocess_gt, to_pcd, voxel_key
 from util import make_dir
 from plot import plot_graph
 
 
-def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop):
+def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop, tau_sweep=None, gt_cache=None):
     scene = os.path.basename(os.path.normpath(dataset_dir))
 
     if scene not in scenes_tau_dict:
@@ -108,10 +109,19 @@ def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop):
     pcd.points = o3d.utility.Vector3dVector(vertices)
     ### end add center points
     
-    print(gt_filen)
-    gt_pcd = o3d.io.read_point_cloud(gt_filen)
-
-    gt_trans = np.loadtxt(alignment)
+    gt = None
+    if gt_cache is not None:
+        # cropped and downsampled GT, written once per scene by gt_cache.py
+        if not has_gt(gt_cache, scene, [dTau, dTau / 2.0]):
+            preprocess_gt(dataset_dir, gt_cache)
+        # only the tau / 2 GT is used for the distances, so only its tree is built
+        gt = load_gt(gt_cache, scene, tree_voxel_sizes=[dTau / 2.0])
+        cropfile = gt["crop_file"]
+        gt_trans = gt["trans"]
+    else:
+        print(gt_filen)
+        gt_pcd = o3d.io.read_point_cloud(gt_filen)
+        gt_trans = np.loadtxt(alignment)
     print(traj_path)
     traj_to_register = []
     if traj_path.endswith('.npy'):
@@ -140,8 +150,11 @@ def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop):
 
     else:
         traj_to_register = read_trajectory(traj_path)
-    print(colmap_ref_logfile)
-    gt_traj_col = read_trajectory(colmap_ref_logfile)
+    if gt is not None:
+        gt_traj_col = gt["gt_traj_col"]
+    else:
+        print(colmap_ref_logfile)
+        gt_traj_col = read_trajectory(colmap_ref_logfile)
 
     trajectory_transform = trajectory_alignment(map_file, traj_to_register,
                                                 gt_traj_col, gt_trans, scene)
@@ -153,11 +166,23 @@ def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop):
     vol = o3d.visualization.read_selection_polygon_volume(cropfile)
     
     # Registration refinment in 3 iterations
-    r2 = registration_vol_ds(pcd, gt_pcd, trajectory_transform, vol, dTau,
-                             dTau * 80, 20)
-    r3 = registration_vol_ds(pcd, gt_pcd, r2.transformation, vol, dTau / 2.0,
-                             dTau * 20, 20)
-    r = registration_unif(pcd, gt_pcd, r3.transformation, vol, 2 * dTau, 20)
+    if gt is not None:
+        gt_eval = gt[voxel_key(dTau / 2.0)]
+        r2 = registration_vol_ds(pcd, to_pcd(gt[voxel_key(dTau)]["points"]), trajectory_transform, vol, dTau,
+                                 dTau * 80, 20, target_prepared=True)
+        r3 = registration_vol_ds(pcd, to_pcd(gt_eval["points"]), r2.transformation, vol, dTau / 2.0,
+                                 dTau * 20, 20, target_prepared=True)
+        r = registration_unif(pcd, to_pcd(gt["unif_points"]), r3.transformation, vol, 2 * dTau, 20,
+                              target_prepared=True)
+        gt_pcd = to_pcd(gt_eval["points"], gt_eval["normals"])
+        gt_tree = gt_eval["tree"]
+    else:
+        r2 = registration_vol_ds(pcd, gt_pcd, trajectory_transform, vol, dTau,
+                                 dTau * 80, 20)
+        r3 = registration_vol_ds(pcd, gt_pcd, r2.transformation, vol, dTau / 2.0,
+                                 dTau * 20, 20)
+        r = registration_unif(pcd, gt_pcd, r3.transformation, vol, 2 * dTau, 20)
+        gt_tree = None
     trajectory_transform = r.transformation
     
     # Histogramms and P/R/F1
@@ -180,7 +205,9 @@ def run_evaluation(dataset_dir, traj_path, ply_path, out_dir, view_crop):
         out_dir,
         plot_stretch,
         scene,
-        view_crop
+        view_crop,
+        target_tree=gt_tree,
+        thresholds=None if tau_sweep is None else [dTau * k for k in tau_sweep],
     )
     eva = [precision, recall, fscore]
     print("==============================")
@@ -240,6 +267,19 @@ if __name__ == "__main__":
         default=0,
         help="whether view the crop pointcloud after aligned",
     )
+    parser.add_argument(
+        "--tau-sweep",
+        type=float,
+        nargs="+",
+        default=None,
+        help="also report P/R/F1 at these multiples of the scene tau (one distance pass)",
+    )
+    parser.add_argument(
+        "--gt-cache",
+        type=str,
+        default=None,
+        help="directory of preprocessed GT (see gt_cache.py), filled on first use",
+    )
     args = parser.parse_args()
 
     args.view_crop = False #  (args.view_crop > 0)
@@ -252,5 +292,7 @@ if __name__ == "__main__":
         traj_path=args.traj_path,
         ply_path=args.ply_path,
         out_dir=args.out_dir,
-        view_crop=args.view_crop
+        view_crop=args.view_crop,
+        tau_sweep=args.tau_sweep,
+        gt_cache=args.gt_cache,
     )
@@ -1,15 +1,18 @@
 import numpy as np
 import torch
-import torch.nn.functional as F
 from scene import Scene
 import cv2
 import os
+import json
+import hashlib
 import random
 from os import makedirs, path
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 from arguments import ModelParams, PipelineParams, get_combined_args
-from gaussian_renderer import GaussianModel
+from scene.gaussian_model import GaussianModel
 import trimesh
+from utils.mesh_utils import filter_components
+from dtu_eval.eval import evaluate as evaluate_dtu, load_gt
 from skimage.morphology import binary_dilation, disk
 
 def best_fit_transform(A, B):
@@ -74,56 +77,71 @@ def load_dtu_camera(DTU):
         camtoworlds.append(pose)
     return camtoworlds
 
-def cull_mesh(cameras, mesh):
-    
-    vertices = mesh.vertices
-    
-    # project and filter
-    vertices = torch.from_numpy(vertices).cuda()
-    vertices = torch.cat((vertices, torch.ones_like(vertices[:, :1])), dim=-1)
-    vertices = vertices.permute(1, 0)
-    vertices = vertices.float()
-    
-    sampled_masks = []
-    
+def dilated_masks(cameras, cache_dir=None, radius=6):
+    """
+    gt masks of all cameras dilated by disk(radius) (similar to unisurf), as a
+    [N_cameras, H, W] bool array. Cached in cache_dir under a key of the camera
+    names, resolution and radius, and read back memory-mapped.
+    """
+    H, W = cameras[0].image_height, cameras[0].image_width
+    cache_file = None
+    if cache_dir is not None:
+        key = json.dumps({"cameras": [camera.image_name for camera in cameras], "resolution": [H, W], "radius": radius})
+        cache_file = os.path.join(cache_dir, f"dilated_masks_{hashlib.sha1(key.encode()).hexdigest()}.npy")
+    if cache_file is not None and os.path.exists(cache_file):
+        masks = np.load(cache_file, mmap_mode='r')
+        if masks.shape == (len(cameras), H, W):
+            return masks
+    masks = np.stack([binary_dilation(camera.gt_alpha_mask[0].cpu().numpy() > 0, disk(radius)) for camera in cameras])
+    if cache_file is not None:
+        makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file, masks)
+    return masks
+
+@torch.no_grad()
+def visible_in_masks(vertices, cameras, masks, device="cpu", tile_size=1 << 20, camera_batch=8):
+    """
+    True for vertices that fall inside the (dilated) mask of every camera that
+    sees them. Vertices are projected in tiles against batches of cameras and the
+    result is reduced with a running AND, so no [N_vertices, N_cameras] stack is built.
+    """
+    projections = []
     for camera in cameras:
-        c2w = (camera.world_view_transform.T).inverse()
-        w2c = torch.inverse(c2w).cuda()
-        mask = camera.gt_alpha_mask
-        
         intrinsic = torch.eye(4)
         intrinsic[0, 0] = camera.focal_x
         intrinsic[1, 1] = camera.focal_y
         intrinsic[0, 2] = camera.image_width / 2.
         intrinsic[1, 2] = camera.image_height / 2.
-        intrinsic = intrinsic.cuda()
-
-        W, H = camera.image_width, camera.image_height
-        
-        with torch.no_grad():
-            # transform and project
-            cam_points = intrinsic @ w2c @ vertices
-            pix_coords = cam_points[:2, :] / (cam_points[2, :].unsqueeze(0) + 1e-6)
-            pix_coords = pix_coords.permute(1, 0)
-            pix_coords[..., 0] /= W - 1
-            pix_coords[..., 1] /= H - 1
-            pix_coords = (pix_coords - 0.5) * 2
-            valid = ((pix_coords > -1. ) & (pix_coords < 1.)).all(dim=-1).float()
-            
-            # dialate mask similar to unisurf
-            maski = mask[0, :, :].cpu().numpy().astype(np.float32) / 256.
-            maski = torch.from_numpy(binary_dilation(maski, disk(6))).float()[None, None].cuda()
-            
-            sampled_mask = F.grid_sample(maski, pix_coords[None, None], mode='nearest', padding_mode='zeros', align_corners=True)[0, -1, 0]
-
-            sampled_mask = sampled_mask + (1. - valid)
-
-            sampled_masks.append(sampled_mask)
-        
-    sampled_masks = torch.stack(sampled_masks, -1)
-
+        projections.append(intrinsic @ camera.world_view_transform.T.cpu())
+    projections = torch.stack(projections).to(device)
+    masks = torch.from_numpy(np.ascontiguousarray(masks))
+    H, W = masks.shape[1:]
+
+    keep = torch.ones(vertices.shape[0], dtype=torch.bool)
+    for start in range(0, vertices.shape[0], tile_size):
+        tile = torch.from_numpy(vertices[start:start + tile_size]).float().to(device)
+        tile = torch.cat((tile, torch.ones_like(tile[:, :1])), dim=-1)
+        tile_keep = torch.ones(tile.shape[0], dtype=torch.bool, device=device)
+        for c in range(0, len(cameras), camera_batch):
+            cam_points = projections[c:c + camera_batch] @ tile.T
+            pix = cam_points[:, :2] / (cam_points[:, 2:3] + 1e-6)
+            u, v = pix[:, 0], pix[:, 1]
+            valid = (u > 0) & (u < W - 1) & (v > 0) & (v < H - 1)
+            # nearest pixel, as grid_sample(mode='nearest', align_corners=True)
+            ui = torch.round(u).long().clamp(0, W - 1)
+            vi = torch.round(v).long().clamp(0, H - 1)
+            batch_masks = masks[c:c + camera_batch].to(device)
+            inside = torch.gather(batch_masks.reshape(batch_masks.shape[0], -1), 1, vi * W + ui)
+            tile_keep &= (inside | ~valid).all(dim=0)
+        keep[start:start + tile_size] = tile_keep.cpu()
+    return keep.numpy()
+
+def cull_mesh(cameras, mesh, mask_cache=None, device="cpu"):
+    
+    masks = dilated_masks(cameras, mask_cache)
+    mask = visible_in_masks(np.asarray(mesh.vertices), cameras, masks, device=device)
+    
     # filter
-    mask = (sampled_masks > 0.).all(dim=-1).cpu().numpy()
     face_mask = mask[mesh.faces].all(axis=1)
     
     mesh.update_vertices(mask)
@@ -131,14 +149,12 @@ def cull_mesh(cameras, mesh):
     
     # Taking the biggest connected component
     print("Taking the biggest connected component")
-    components = mesh.split(only_watertight=False)
-    areas = np.array([c.area for c in components], dtype=np.float32)
-    mesh_clean = components[areas.argmax()]
+    mesh_clean = filter_components(mesh, largest=True)
 
     return mesh_clean
 
 
-def evaluate_mesh(dataset : ModelParams, iteration : int, DTU_PATH : str):
+def evaluate_mesh(dataset : ModelParams, iteration : int, DTU_PATH : str, gt_cache=None):
     
     gaussians = GaussianModel(dataset.sh_degree)
     scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
@@ -171,7 +187,7 @@ def evaluate_mesh(dataset : ModelParams, iteration : int, DTU_PATH : str):
     
     mesh = trimesh.load(mesh_file)
     
-    mesh = cull_mesh(train_cameras, mesh)
+    mesh = cull_mesh(train_cameras, mesh, mask_cache=os.path.join(dataset.model_path, "dilated_masks"))
     
     culled_mesh_file = os.path.join(dataset.model_path, "test/ours_{}".format(iteration), mesh_dir, filename.replace(".ply", "_culled.ply"))
     mesh.export(culled_mesh_file)
@@ -185,11 +201,13 @@ def evaluate_mesh(dataset : ModelParams, iteration : int, DTU_PATH : str):
         
     # evaluate
     out_dir = os.path.join(dataset.model_path, "test/ours_{}".format(iteration), mesh_dir)
-    scan = dataset.model_path.split("/")[-1][4:]
+    scan = int(dataset.model_path.split("/")[-1][4:])
     
-    cmd = f"python dtu_eval/eval.py --data {aligned_mesh_file} --scan {scan} --mode mesh --dataset_dir {DTU_PATH} --vis_out_dir {out_dir}"
-    print(cmd)
-    os.system(cmd)
+    # in process, the GT of the scan comes from the shared memory-mapped cache
+    eval_args = Namespace(data=aligned_mesh_file, scan=scan, mode="mesh", dataset_dir=DTU_PATH, vis_out_dir=out_dir,
+                          downsample_density=0.2, patch_size=60, max_dist=20, visualize_threshold=10,
+                          cache_dir=gt_cache, seed=None)
+    return evaluate_dtu(eval_args, load_gt(DTU_PATH, scan, cache_dir=gt_cache))
     
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -202,6 +220,7 @@ if __name__ == "__main__":
     parser.add_argument("--quiet", action="store_true")
     parser.add_argument('--scan_id', type=str,  help='scan id of the input mesh')
     parser.add_argument('--DTU', type=str,  default='dtu_eval/Offical_DTU_Dataset', help='path to the GT DTU point clouds')
+    parser.add_argument('--gt_cache', type=str, default='dtu_eval/gt_cache', help='parsed GT shared across evaluations')
     
     args = get_combined_args(parser)
     print("evaluating " + args.model_path)
@@ -211,4 +230,4 @@ if __name__ == "__main__":
     torch.manual_seed(0)
     torch.cuda.set_device(torch.device("cuda:0"))
     
-    evaluate_mesh(model.extract(args), args.iteration, args.DTU)
\ No newline at end of file
+    evaluate_mesh(model.extract(args), args.iteration, args.DTU, gt_cache=args.gt_cache)
\ No newline at end of file
@@ -2,53 +2,88 @@ import torch
 from scene import Scene
 import os
 from os import makedirs
-from gaussian_renderer import render, integrate
+from gaussian_renderer import render, integrate, project_to_image
 import random
 from tqdm import tqdm
 from argparse import ArgumentParser
 from arguments import ModelParams, PipelineParams, get_combined_args
-from gaussian_renderer import GaussianModel
+from scene.gaussian_model import GaussianModel
 import numpy as np
-import trimesh
-from tetranerf.utils.extension import cpp
 from utils.tetmesh import marching_tetrahedra
+from utils.tetra_utils import triangulate, cached_triangulate, deduplicate_points
+from utils.refine_utils import refine_level_set
+from utils.lod_utils import export_lod_from_file
+from utils.ply_utils import write_mesh
 
 @torch.no_grad()
-def evaluage_alpha(points, views, gaussians, pipeline, background, kernel_size):
-    final_alpha = torch.ones((points.shape[0]), dtype=torch.float32, device="cuda")
-    
+def evaluage_alpha(points, views, gaussians, pipeline, background, kernel_size, sign_threshold=None):
+    """
+    Minimum transmittance of each point over all views, returned as 1 - min.
+
+    Views are visited in order of how many points they see, and each view only
+    integrates the points that are still active and project into it. A point
+    is dropped once its running minimum is 0, or, with sign_threshold, once it
+    is below sign_threshold (then only the side of the threshold is exact).
+    """
+    final_alpha = torch.ones((points.shape[0]), dtype=torch.float32, device=points.device)
+
+    coverage = torch.tensor([project_to_image(view, points)[0].sum().item() for view in views])
+    order = torch.argsort(coverage, descending=True).tolist()
+
+    active = torch.arange(points.shape[0], device=points.device)
+    calls, processed = 0, 0
     with torch.no_grad():
-        for _, view in enumerate(tqdm(views, desc="Rendering progress")):
-            ret = integrate(points, view, gaussians, pipeline, background, kernel_size=kernel_size)
-            alpha_integrated = ret["alpha_integrated"]
-            final_alpha = torch.min(final_alpha, alpha_integrated)
+        for i in tqdm(order, desc="Rendering progress"):
+            if active.shape[0] == 0:
+                break
+            in_view = project_to_image(views[i], points[active])[0]
+            idx = active[in_view]
+            if idx.shape[0] == 0:
+                continue
+            ret = integrate(points[idx], views[i], gaussians, pipeline, background, kernel_size=kernel_size)
+            final_alpha[idx] = torch.min(final_alpha[idx], ret["alpha_integrated"])
+            calls += 1
+            processed += idx.shape[0]
+            if sign_threshold is None:
+                active = active[final_alpha[active] > 0]
+            else:
+                active = active[final_alpha[active] >= sign_threshold]
         alpha = 1 - final_alpha
+    print(f"alpha integration: {calls} / {len(views)} rasterizer calls, "
+          f"{processed} / {len(views) * points.shape[0]} point evaluations")
     return alpha
 
 @torch.no_grad()
-def marching_tetrahedra_with_binary_search(model_path, name, iteration, views, gaussians, pipeline, background, kernel_size):
+def marching_tetrahedra_with_binary_search(model_path, name, iteration, views, gaussians, pipeline, background, kernel_size, tet_tiles=None, tet_margin=0.1, tet_workers=None, tet_verify=False, dedup_eps=0.0,
+                                           refine_args=None, alpha_sign_only=False, cell_cache=True):
     render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "fusion")
 
     makedirs(render_path, exist_ok=True)
+    refine_args = refine_args or {}
+    # plain bisection only looks at the sign of alpha - 0.5
+    if alpha_sign_only and (refine_args.get("method", "bisection") != "bisection" or refine_args.get("sdf_tol", 0.0) > 0):
+        print("alpha_sign_only needs bisection without sdf_tol, ignoring it")
+        alpha_sign_only = False
+    sign_threshold = 0.5 if alpha_sign_only else None
     
     # generate tetra points here
     points, points_scale = gaussians.get_tetra_points()
-    # load cell if exists
-    if os.path.exists(os.path.join(render_path, "cells.pt")):
-        print("load existing cells")
-        cells = torch.load(os.path.join(render_path, "cells.pt"))
+    if dedup_eps > 0:
+        # merge near-coincident corner points before triangulating
+        keep, _ = deduplicate_points(points, dedup_eps)
+        points = points[keep]
+        points_scale = points_scale[keep]
+    # cells are cached by the hash of the points, so a retrained model never reuses stale cells
+    if cell_cache:
+        cells = cached_triangulate(points, os.path.join(render_path, "cells"), tiles=tet_tiles, margin=tet_margin, num_workers=tet_workers, verify=tet_verify)
     else:
-        # create cell and save cells
-        print("create cells and save")
-        cells = cpp.triangulate(points)
-        # we should filter the cell if it is larger than the gaussians
-        torch.save(cells, os.path.join(render_path, "cells.pt"))
+        cells = triangulate(points, tiles=tet_tiles, margin=tet_margin, num_workers=tet_workers, verify=tet_verify)
     
     # evaluate alpha
-    alpha = evaluage_alpha(points, views, gaussians, pipeline, background, kernel_size)
+    alpha = evaluage_alpha(points, views, gaussians, pipeline, background, kernel_size, sign_threshold=sign_threshold)
 
-    vertices = points.cuda()[None]
-    tets = cells.cuda().long()
+    vertices = points[None]
+    tets = cells.to(points.device).long()
 
     print(vertices.shape, tets.shape, alpha.shape)
     def alpha_to_sdf(alpha):    
@@ -65,7 +100,7 @@ def marching_tetrahedra_with_binary_search(model_path, name, iteration, views, g
     end_points, end_sdf = verts_list[0]
     end_scales = scale_list[0]
     
-    faces=faces_list[0].cpu().numpy()
+    faces=faces_list[0]
     points = (end_points[:, 0, :] + end_points[:, 1, :]) / 2.
         
     left_points = end_points[:, 0, :]
@@ -77,54 +112,41 @@ def marching_tetrahedra_with_binary_search(model_path, name, iteration, views, g
     distance = torch.norm(left_points - right_points, dim=-1)
     scale = left_scale + right_scale
     
-    n_binary_steps = 8
-    for step in range(n_binary_steps):
-        print("binary search in step {}".format(step))
-        mid_points = (left_points + right_points) / 2
-        alpha = evaluage_alpha(mid_points, views, gaussians, pipeline, background, kernel_size)
-        mid_sdf = alpha_to_sdf(alpha).squeeze().unsqueeze(-1)
-        
-        ind_low = ((mid_sdf < 0) & (left_sdf < 0)) | ((mid_sdf > 0) & (left_sdf > 0))
+    n_binary_steps = refine_args.get("max_steps", 8)
+    sdf_fn = lambda x: alpha_to_sdf(evaluage_alpha(x, views, gaussians, pipeline, background, kernel_size,
+                                                   sign_threshold=sign_threshold)).squeeze().unsqueeze(-1)
+    points, _ = refine_level_set(left_points, right_points, left_sdf, right_sdf, sdf_fn, scale=scale, **refine_args)
 
-        left_sdf[ind_low] = mid_sdf[ind_low]
-        right_sdf[~ind_low] = mid_sdf[~ind_low]
-        left_points[ind_low.flatten()] = mid_points[ind_low.flatten()]
-        right_points[~ind_low.flatten()] = mid_points[~ind_low.flatten()]
+    # filter, faces touching a dropped vertex are dropped by the writer
+    mask = distance <= scale
     
-        points = (left_points + right_points) / 2
-        if step not in [7]:
-            continue
-        
-        mesh = trimesh.Trimesh(vertices=points.cpu().numpy(), faces=faces, process=False)
-        
-        # filter
-        mask = (distance <= scale).cpu().numpy()
-        face_mask = mask[faces].all(axis=1)
-        mesh.update_vertices(mask)
-        mesh.update_faces(face_mask)
-        
-        mesh.export(os.path.join(render_path, f"mesh_binary_search_{step}.ply"))
+    mesh_path = os.path.join(render_path, f"mesh_binary_search_{n_binary_steps - 1}.ply")
+    write_mesh(mesh_path, points, faces, vertex_mask=mask)
 
     # linear interpolation
     # right_sdf *= -1
     # points = (left_points * left_sdf + right_points * right_sdf) / (left_sdf + right_sdf)
     # mesh = trimesh.Trimesh(vertices=points.cpu().numpy(), faces=faces)
     # mesh.export(os.path.join(render_path, f"mesh_binary_search_interp.ply"))
+    return mesh_path
     
 
-def extract_mesh(dataset : ModelParams, iteration : int, pipeline : PipelineParams):
+def extract_mesh(dataset : ModelParams, iteration : int, pipeline : PipelineParams, tet_tiles=None, tet_margin=0.1, tet_workers=None, tet_verify=False, dedup_eps=0.0,
+                 refine_args=None, alpha_sign_only=False, cell_cache=True, device="cuda"):
     with torch.no_grad():
-        gaussians = GaussianModel(dataset.sh_degree)
-        scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
-        
-        gaussians.load_ply(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "point_cloud.ply"))
+        gaussians = GaussianModel(dataset.sh_degree, device=device)
+        # loads the point cloud of this iteration and the cameras on device
+        scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False, device=device)
         
         bg_color = [1,1,1] if dataset.white_background else [0, 0, 0]
-        background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+        background = torch.tensor(bg_color, dtype=torch.float32, device=device)
         kernel_size = dataset.kernel_size
         
         cams = scene.getTrainCameras()
-        marching_tetrahedra_with_binary_search(dataset.model_path, "test", iteration, cams, gaussians, pipeline, background, kernel_size)
+        return marching_tetrahedra_with_binary_search(dataset.model_path, "test", iteration, cams, gaussians, pipeline, background, kernel_size,
+                                                      tet_tiles=tet_tiles, tet_margin=tet_margin, tet_workers=tet_workers, tet_verify=tet_verify, dedup_eps=dedup_eps,
+                                                      refine_args=refine_args, alpha_sign_only=alpha_sign_only,
+                                                      cell_cache=cell_cache)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -133,12 +155,33 @@ if __name__ == "__main__":
     pipeline = PipelineParams(parser)
     parser.add_argument("--iteration", default=30000, type=int)
     parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--tet_tiles", nargs=3, type=int, default=None, help="triangulate in x*y*z spatial blocks")
+    parser.add_argument("--tet_margin", type=float, default=0.1, help="block overlap as a fraction of the block size")
+    parser.add_argument("--tet_workers", type=int, default=None)
+    parser.add_argument("--tet_verify", action="store_true", help="also triangulate monolithically and compare the tiled cells against it")
+    parser.add_argument("--dedup_eps", type=float, default=0.0, help="merge tetra points closer than this")
+    parser.add_argument("--refine_steps", type=int, default=8, help="maximum level set refinement steps per edge")
+    parser.add_argument("--sdf_tol", type=float, default=0.0, help="stop refining an edge once |sdf| is below this")
+    parser.add_argument("--rel_tol", type=float, default=0.0, help="stop refining an edge once its bracket is below rel_tol * scale")
+    parser.add_argument("--refine_method", type=str, default="bisection", choices=["bisection", "regula_falsi"])
+    parser.add_argument("--no_cell_cache", action="store_true", help="always re-triangulate instead of reusing cached cells")
+    parser.add_argument("--lod_levels", nargs="+", type=int, default=None, help="also write a tiled level of detail chain, e.g. 1 4 16")
+    parser.add_argument("--lod_tiles", nargs=3, type=int, default=[2, 2, 2])
+    parser.add_argument("--alpha_sign_only", action="store_true", help="stop integrating a point once its alpha is known to be above 0.5")
     args = get_combined_args(parser)
     print("Rendering " + args.model_path)
     
     random.seed(0)
     np.random.seed(0)
     torch.manual_seed(0)
-    torch.cuda.set_device(torch.device("cuda:0"))
+    # the cpu rasterizer runs everything on the host, without a gpu
+    device = torch.device("cpu" if args.rasterizer == "cpu" else "cuda:0")
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
     
-    extract_mesh(model.extract(args), args.iteration, pipeline.extract(args))
\ No newline at end of file
+    mesh_path = extract_mesh(model.extract(args), args.iteration, pipeline.extract(args),
+                             tet_tiles=args.tet_tiles, tet_margin=args.tet_margin, tet_workers=args.tet_workers, tet_verify=args.tet_verify, dedup_eps=args.dedup_eps,
+                             refine_args=dict(max_steps=args.refine_steps, sdf_tol=args.sdf_tol, rel_tol=args.rel_tol, method=args.refine_method),
+                             alpha_sign_only=args.alpha_sign_only, cell_cache=not args.no_cell_cache, device=device)
+    if args.lod_levels:
+        export_lod_from_file(mesh_path, levels=args.lod_levels, tiles=args.lod_tiles)
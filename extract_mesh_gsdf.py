@@ -2,7 +2,7 @@ import torch
 from scene import Scene
 import os
 from os import makedirs
-from gaussian_renderer import render, integrate, integrate_sdf
+from gaussian_renderer import render, integrate, integrate_sdf, project_to_image
 import random
 from tqdm import tqdm
 from argparse import ArgumentParser
@@ -10,9 +10,11 @@ from arguments import ModelParams, OptimizationParams, PipelineParams, get_combi
 # from gaussian_renderer import GaussianModel
 from scene.sdf_gaussian_model_v3 import GaussianModel
 import numpy as np
-import trimesh
-from tetranerf.utils.extension import cpp
-from utils.tetmesh import marching_tetrahedra
+from utils.tetmesh import marching_tetrahedra, marching_tetrahedra_streaming
+from utils.ply_utils import StreamingPlyWriter, write_mesh
+from utils.refine_utils import refine_level_set
+from utils.lod_utils import export_lod_from_file
+from utils.tetra_utils import triangulate, cached_triangulate, deduplicate_points
 from skimage.measure import marching_cubes
 
 @torch.no_grad()
@@ -21,48 +23,109 @@ def filter_points_in_bounding_box(points, bounding_box):
     bbox_max = bounding_box[:, 1]
     
     mask = (points >= bbox_min) & (points <= bbox_max)
-    mask = mask.any(dim=1)
+    mask = mask.all(dim=1)
     
     filtered_points = points[mask]
     
     return filtered_points, mask
 
 @torch.no_grad()
-def marching_tetrahedra_with_binary_search(model_path, name, iteration, gaussians):
+def filter_points_in_views(points, views, min_views=1):
+    '''
+    Keep points that project into at least min_views of the given cameras.
+    '''
+    count = torch.zeros(points.shape[0], dtype=torch.int32, device=points.device)
+    for view in tqdm(views, desc="Frustum filter"):
+        valid, _, _ = project_to_image(view, points)
+        count += valid.int()
+    mask = count >= min_views
+    return points[mask], mask
+
+@torch.no_grad()
+def filter_tetra_points(points, points_scale, gaussians, sdf_band=0.0, views=None, min_views=1):
+    '''
+    Drop tetra points that cannot contribute to the zero level set before they
+    reach the triangulation: points outside the bounding box, points whose
+    |sdf| is larger than sdf_band (if > 0) and, when views are given, points
+    seen by fewer than min_views cameras. Returns the kept points, their
+    scales and their sdf values.
+    '''
+    n_input = points.shape[0]
+    points, mask = filter_points_in_bounding_box(points, gaussians.bounding_box)
+    points_scale = points_scale[mask]
+    print(f"bounding box filter: {n_input} -> {points.shape[0]} points")
+
+    if views is not None:
+        n_input = points.shape[0]
+        points, mask = filter_points_in_views(points, views, min_views)
+        points_scale = points_scale[mask]
+        print(f"frustum filter: {n_input} -> {points.shape[0]} points")
+
+    sdf = gaussians.query_sdf(points)['sdf']
+    if sdf_band > 0:
+        n_input = points.shape[0]
+        mask = (sdf.abs() <= sdf_band).squeeze(-1)
+        points = points[mask]
+        points_scale = points_scale[mask]
+        sdf = sdf[mask]
+        print(f"sdf band filter: {n_input} -> {points.shape[0]} points")
+
+    return points, points_scale, sdf
+
+@torch.no_grad()
+def marching_tetrahedra_with_binary_search(model_path, name, iteration, gaussians, tet_tiles=None, tet_margin=0.1, tet_workers=None, tet_verify=False, dedup_eps=0.0,
+                                           opacity_threshold=0.0, sdf_band=0.0, views=None, min_views=1, stream_chunk=0, refine_args=None,
+                                           cell_cache=True):
     render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "fusion")
 
     makedirs(render_path, exist_ok=True)
+    refine_args = refine_args or {}
+    n_binary_steps = refine_args.get("max_steps", 8)
+    sdf_fn = lambda x: gaussians.query_sdf(x)['sdf']
+    mesh_path = os.path.join(render_path, f"mesh_binary_search_{n_binary_steps - 1}.ply")
     
     # generate tetra points here
-    points, points_scale = gaussians.get_tetra_points()
-    points, mask = filter_points_in_bounding_box(points, gaussians.bounding_box)
-    points_scale = points_scale[mask]
-    # load cell if exists
-    if False: #os.path.exists(os.path.join(render_path, "cells.pt")):
-        print("load existing cells")
-        cells = torch.load(os.path.join(render_path, "cells.pt"))
+    points, points_scale = gaussians.get_tetra_points(opacity_threshold=opacity_threshold)
+    n_points = points.shape[0]
+    points, points_scale, sdf = filter_tetra_points(points, points_scale, gaussians, sdf_band=sdf_band, views=views, min_views=min_views)
+    if dedup_eps > 0:
+        # merge near-coincident corner points before triangulating
+        keep, _ = deduplicate_points(points, dedup_eps)
+        points = points[keep]
+        points_scale = points_scale[keep]
+        sdf = sdf[keep]
+    print(f"tetra points after filtering: {points.shape[0]} / {n_points}")
+    # cells are cached by the hash of the filtered points, so a retrained model never reuses stale cells
+    if cell_cache:
+        cells = cached_triangulate(points, os.path.join(render_path, "cells"), tiles=tet_tiles, margin=tet_margin, num_workers=tet_workers, verify=tet_verify)
     else:
-        # create cell and save cells
-        print("create cells and save")
-        cells = cpp.triangulate(points)
-        # we should filter the cell if it is larger than the gaussians
-        torch.save(cells, os.path.join(render_path, "cells.pt"))
+        cells = triangulate(points, tiles=tet_tiles, margin=tet_margin, num_workers=tet_workers, verify=tet_verify)
 
-    sdf = gaussians.query_sdf(points.cuda())['sdf']
     sdf = sdf[None]
 
-    vertices = points.cuda()[None]
-    tets = cells.cuda().long()
+    vertices = points[None]
+    tets = cells.to(points.device).long()
     print(vertices.shape, tets.shape)
 
+    if stream_chunk > 0:
+        # refine and write each chunk of new vertices and faces straight to disk,
+        # the distance <= scale filter below is not applied in this mode
+        refine = lambda edges, edges_sdf, edges_scale: refine_level_set(edges[:, 0], edges[:, 1], edges_sdf[:, 0], edges_sdf[:, 1], sdf_fn,
+                                                                        scale=edges_scale.sum(dim=1).squeeze(-1), **refine_args)[0]
+        with StreamingPlyWriter(mesh_path) as writer:
+            marching_tetrahedra_streaming(vertices[0], tets, sdf[0], points_scale, chunk_size=stream_chunk,
+                                          writer=writer, vertex_fn=refine)
+        return mesh_path
+
     torch.cuda.empty_cache()
     verts_list, scale_list, faces_list, _ = marching_tetrahedra(vertices, tets, sdf, points_scale[None])
     torch.cuda.empty_cache()
+    print(f"marching tetrahedra: {faces_list[0].shape[0]} faces from {tets.shape[0]} tets")
     
     end_points, end_sdf = verts_list[0]
     end_scales = scale_list[0]
     
-    faces=faces_list[0].cpu().numpy()
+    faces=faces_list[0]
     points = (end_points[:, 0, :] + end_points[:, 1, :]) / 2.
         
     left_points = end_points[:, 0, :]
@@ -74,48 +137,38 @@ def marching_tetrahedra_with_binary_search(model_path, name, iteration, gaussian
     distance = torch.norm(left_points - right_points, dim=-1)
     scale = left_scale + right_scale
     
-    n_binary_steps = 8
-    for step in range(n_binary_steps):
-        print("binary search in step {}".format(step))
-        mid_points = (left_points + right_points) / 2
-        mid_sdf = gaussians.query_sdf(mid_points.cuda())['sdf']
-        mid_sdf = mid_sdf.squeeze().unsqueeze(-1)
-
-        ind_low = ((mid_sdf < 0) & (left_sdf < 0)) | ((mid_sdf > 0) & (left_sdf > 0))
-
-        left_sdf[ind_low] = mid_sdf[ind_low]
-        right_sdf[~ind_low] = mid_sdf[~ind_low]
-        left_points[ind_low.flatten()] = mid_points[ind_low.flatten()]
-        right_points[~ind_low.flatten()] = mid_points[~ind_low.flatten()]
-    
-        points = (left_points + right_points) / 2
-        if step not in [7]:
-            continue
-        
-        mesh = trimesh.Trimesh(vertices=points.cpu().numpy(), faces=faces, process=False)
-        
-        # filter
-        mask = (distance <= scale).cpu().numpy()
-        face_mask = mask[faces].all(axis=1)
-        mesh.update_vertices(mask)
-        mesh.update_faces(face_mask)
+    points, _ = refine_level_set(left_points, right_points, left_sdf, right_sdf, sdf_fn, scale=scale, **refine_args)
 
-        mesh.export(os.path.join(render_path, f"mesh_binary_search_{step}.ply"))
+    # filter, faces touching a dropped vertex are dropped by the writer
+    mask = distance <= scale
+    write_mesh(mesh_path, points, faces, vertex_mask=mask)
 
     # linear interpolation
     # right_sdf *= -1
     # points = (left_points * left_sdf + right_points * right_sdf) / (left_sdf + right_sdf)
     # mesh = trimesh.Trimesh(vertices=points.cpu().numpy(), faces=faces)
     # mesh.export(os.path.join(render_path, f"mesh_binary_search_interp.ply"))
+    return mesh_path
     
 
-def extract_mesh(dataset : ModelParams, opt, iteration : int, pipeline : PipelineParams):
+def extract_mesh(dataset : ModelParams, opt, iteration : int, pipeline : PipelineParams, tet_tiles=None, tet_margin=0.1, tet_workers=None, tet_verify=False, dedup_eps=0.0,
+                 opacity_threshold=0.0, sdf_band=0.0, min_views=0, stream_chunk=0, refine_args=None,
+                 cell_cache=True, device="cuda"):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree, opt.network)
-        gaussians.load_ply(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "point_cloud.ply"))
-        gaussians.load_model(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "model.pt"))
+        views = None
+        if min_views > 0:
+            # Scene loads the point cloud of this iteration itself
+            scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False, device=device)
+            views = scene.getTrainCameras()
+        else:
+            gaussians.load_ply(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "point_cloud.ply"), device=device)
+        gaussians.load_model(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "model.pt"), device=device)
         
-        marching_tetrahedra_with_binary_search(dataset.model_path, "test", iteration, gaussians)
+        return marching_tetrahedra_with_binary_search(dataset.model_path, "test", iteration, gaussians,
+                                                      tet_tiles=tet_tiles, tet_margin=tet_margin, tet_workers=tet_workers, tet_verify=tet_verify, dedup_eps=dedup_eps,
+                                                      opacity_threshold=opacity_threshold, sdf_band=sdf_band, views=views, min_views=min_views,
+                                                      stream_chunk=stream_chunk, refine_args=refine_args, cell_cache=cell_cache)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -125,6 +178,22 @@ if __name__ == "__main__":
     pipeline = PipelineParams(parser)
     parser.add_argument("--iteration", default=30000, type=int)
     parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--tet_tiles", nargs=3, type=int, default=None, help="triangulate in x*y*z spatial blocks")
+    parser.add_argument("--tet_margin", type=float, default=0.1, help="block overlap as a fraction of the block size")
+    parser.add_argument("--tet_workers", type=int, default=None)
+    parser.add_argument("--tet_verify", action="store_true", help="also triangulate monolithically and compare the tiled cells against it")
+    parser.add_argument("--dedup_eps", type=float, default=0.0, help="merge tetra points closer than this")
+    parser.add_argument("--opacity_threshold", type=float, default=0.0, help="drop gaussians below this opacity before triangulating")
+    parser.add_argument("--sdf_band", type=float, default=0.0, help="drop tetra points with |sdf| above this")
+    parser.add_argument("--min_views", type=int, default=0, help="drop tetra points seen by fewer training views")
+    parser.add_argument("--stream_chunk", type=int, default=0, help="stream marching tetrahedra to disk with this many tets per chunk")
+    parser.add_argument("--no_cell_cache", action="store_true", help="always re-triangulate instead of reusing cached cells")
+    parser.add_argument("--lod_levels", nargs="+", type=int, default=None, help="also write a tiled level of detail chain, e.g. 1 4 16")
+    parser.add_argument("--lod_tiles", nargs=3, type=int, default=[2, 2, 2])
+    parser.add_argument("--refine_steps", type=int, default=8, help="maximum level set refinement steps per edge")
+    parser.add_argument("--sdf_tol", type=float, default=0.0, help="stop refining an edge once |sdf| is below this")
+    parser.add_argument("--rel_tol", type=float, default=0.0, help="stop refining an edge once its bracket is below rel_tol * scale")
+    parser.add_argument("--refine_method", type=str, default="bisection", choices=["bisection", "regula_falsi"])
     args = get_combined_args(parser)
 
     print("Rendering " + args.model_path)
@@ -132,6 +201,15 @@ if __name__ == "__main__":
     random.seed(0)
     np.random.seed(0)
     torch.manual_seed(0)
-    torch.cuda.set_device(torch.device("cuda:0"))
+    device = torch.device("cpu" if args.rasterizer == "cpu" else "cuda:0")
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
     
-    extract_mesh(model.extract(args), op.extract(args), args.iteration, pipeline.extract(args))
\ No newline at end of file
+    mesh_path = extract_mesh(model.extract(args), op.extract(args), args.iteration, pipeline.extract(args),
+                             tet_tiles=args.tet_tiles, tet_margin=args.tet_margin, tet_workers=args.tet_workers, tet_verify=args.tet_verify, dedup_eps=args.dedup_eps,
+                             opacity_threshold=args.opacity_threshold, sdf_band=args.sdf_band, min_views=args.min_views,
+                             stream_chunk=args.stream_chunk,
+                             refine_args=dict(max_steps=args.refine_steps, sdf_tol=args.sdf_tol, rel_tol=args.rel_tol, method=args.refine_method),
+                             cell_cache=not args.no_cell_cache, device=device)
+    if args.lod_levels:
+        export_lod_from_file(mesh_path, levels=args.lod_levels, tiles=args.lod_tiles)
@@ -8,20 +8,33 @@ from arguments import ModelParams, OptimizationParams, PipelineParams, get_combi
 # from gaussian_renderer import GaussianModel
 from scene.sdf_gaussian_model_v3 import GaussianModel
 import numpy as np
-import trimesh
 from skimage.measure import marching_cubes
 import marching_cubes as mcubes
+from utils.mc_utils import sparse_marching_cubes
+from utils.lod_utils import export_lod_from_file
+from utils.ply_utils import write_mesh
 
 
 @torch.no_grad()
-def marching_cube(model_path, name, iteration, gaussians):
+def marching_cube(model_path, name, iteration, gaussians, bound_scale=12.0, vox_size=0.01, sparse=False, block_size=32, coarse_margin=1.5):
     render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "fusion")
 
     makedirs(render_path, exist_ok=True)
     
-    max_bound = gaussians.bounding_box[:, 1] / 12
-    min_bound = gaussians.bounding_box[:, 0] / 12
-    vox_size = 0.01
+    max_bound = gaussians.bounding_box[:, 1] / bound_scale
+    min_bound = gaussians.bounding_box[:, 0] / bound_scale
+
+    if sparse:
+        # only blocks near the surface are evaluated
+        sdf_fn = lambda x: gaussians.query_sdf(x)['sdf']
+        verts, faces = sparse_marching_cubes(sdf_fn, min_bound, max_bound, vox_size, block_size=block_size,
+                                             points=gaussians.get_xyz, coarse_margin=coarse_margin)
+        print('done', verts.shape, faces.shape)
+        mesh_path = os.path.join(render_path, f"mesh_sparse_marching_cube_{iteration}.ply")
+        write_mesh(mesh_path, verts, faces)
+        print('Mesh saved')
+        return mesh_path
+
     grid_size = ((max_bound - min_bound) / vox_size).long() + 1  # [D, H, W]
 
     # Function to generate grid points in batches
@@ -55,9 +68,11 @@ def marching_cube(model_path, name, iteration, gaussians):
     print('Running Marching Cubes')
     # verts, faces, normals, values = marching_cubes(sdf_grid, level=0.0)
     verts, faces = mcubes.marching_cubes(sdf_grid, 0.0, truncation=3.0)
+    # grid index to world space, the same frame as the sparse path
+    spacing = ((max_bound - min_bound) / (grid_size - 1).clamp(min=1)).cpu().numpy()
+    verts = verts * spacing + min_bound.cpu().numpy()
     print('done', verts.shape, faces.shape)
 
-    mesh = trimesh.Trimesh(verts, faces, process=False)
     # get connected components
     # components = mesh.split(only_watertight=False)
     # if False:
@@ -73,17 +88,19 @@ def marching_cube(model_path, name, iteration, gaussians):
     # faces = mesh.faces
     # mesh = trimesh.Trimesh(verts, faces, process=False)
 
-    mesh.export(os.path.join(render_path, f"mesh_marching_cube_{iteration}.ply"))
+    mesh_path = os.path.join(render_path, f"mesh_marching_cube_{iteration}.ply")
+    write_mesh(mesh_path, verts, faces)
     print('Mesh saved')
+    return mesh_path
     
 
-def extract_mesh(dataset : ModelParams, opt, iteration : int):
+def extract_mesh(dataset : ModelParams, opt, iteration : int, **mc_args):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree, opt.network)
         gaussians.load_ply(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "point_cloud.ply"))
         gaussians.load_model(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "model.pt"))
         
-        marching_cube(dataset.model_path, "test", iteration, gaussians)
+        return marching_cube(dataset.model_path, "test", iteration, gaussians, **mc_args)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -96,6 +113,13 @@ if __name__ == "__main__":
     parser.add_argument("--hash_size", type=int, default=22)
     parser.add_argument("--hash_resolution", type=int, default=2048)
     parser.add_argument("--alpha", type=float, default=0.1)
+    parser.add_argument("--lod_levels", nargs="+", type=int, default=None, help="also write a tiled level of detail chain, e.g. 1 4 16")
+    parser.add_argument("--lod_tiles", nargs=3, type=int, default=[2, 2, 2])
+    parser.add_argument("--bound_scale", type=float, default=12.0, help="divide the gaussian bounding box by this")
+    parser.add_argument("--vox_size", type=float, default=0.01)
+    parser.add_argument("--sparse", action="store_true", help="only evaluate blocks that straddle the surface")
+    parser.add_argument("--block_size", type=int, default=32, help="cells per block side in sparse mode")
+    parser.add_argument("--coarse_margin", type=float, default=1.5, help="block is active if |sdf| at its centre < margin * half diagonal")
     args = get_combined_args(parser)
 
     op.network['grid']['hash_size'] = args.hash_size
@@ -109,4 +133,7 @@ if __name__ == "__main__":
     torch.manual_seed(0)
     torch.cuda.set_device(torch.device("cuda:0"))
     
-    extract_mesh(model.extract(args), op.extract(args), args.iteration)
\ No newline at end of file
+    mesh_path = extract_mesh(model.extract(args), op.extract(args), args.iteration, bound_scale=args.bound_scale, vox_size=args.vox_size,
+                             sparse=args.sparse, block_size=args.block_size, coarse_margin=args.coarse_margin)
+    if args.lod_levels:
+        export_lod_from_file(mesh_path, levels=args.lod_levels, tiles=args.lod_tiles)
@@ -13,15 +13,36 @@ import numpy as np
 import open3d as o3d
 import open3d.core as o3c
 import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.dlpack import to_dlpack
+from utils.tsdf_utils import VoxelHashTSDF
+from utils.lod_utils import export_lod_from_file
         
-def tsdf_fusion(model_path, name, iteration, views, gaussians, pipeline, background, kernel_size):
-    render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "tsdf")
-
-    makedirs(render_path, exist_ok=True)
-    o3d_device = o3d.core.Device("CUDA:0")
+def render_depth(view, gaussians, pipeline, background, kernel_size, alpha_thres=0.5):
+    rendering = sdf_render_v3(view, gaussians, pipeline, background, kernel_size=kernel_size)["render"]
+    
+    depth = rendering[6, :, :]
+    alpha = rendering[7, :, :]
+    rgb = rendering[:3, :, :].permute(1, 2, 0).contiguous()
     
-    voxel_size = 0.002
-    alpha_thres=0.5
+    if view.gt_alpha_mask is not None:
+        depth[(view.gt_alpha_mask[0] < 0.5)] = 0
+    
+    depth[(alpha < alpha_thres)] = 0
+    return depth.contiguous(), rgb
+
+def camera_matrices(view):
+    intrinsic = torch.eye(3, dtype=torch.float64)
+    intrinsic[0, 0] = view.image_width / (2 * math.tan(view.FoVx / 2.))
+    intrinsic[1, 1] = view.image_height / (2 * math.tan(view.FoVy / 2.))
+    intrinsic[0, 2] = view.image_width / 2
+    intrinsic[1, 2] = view.image_height / 2
+    extrinsic = view.world_view_transform.T.double().cpu()
+    return intrinsic, extrinsic
+
+def tsdf_fusion_open3d(views, gaussians, pipeline, background, kernel_size, voxel_size=0.002, block_count=50000, depth_max=6.0):
+    o3d_device = o3d.core.Device("CUDA:0" if background.is_cuda else "CPU:0")
     
     vbg = o3d.t.geometry.VoxelBlockGrid(
             attr_names=('tsdf', 'weight', 'color'),
@@ -29,68 +50,99 @@ def tsdf_fusion(model_path, name, iteration, views, gaussians, pipeline, backgro
             attr_channels=((1), (1), (3)),
             voxel_size=voxel_size,
             block_resolution=16,
-            block_count=50000,
+            block_count=block_count,
             device=o3d_device)
     
-    with torch.no_grad():
-        for _, view in enumerate(tqdm(views, desc="Rendering progress")):
-            import ipdb; ipdb.set_trace()
-            
-            rendering = sdf_render_v3(view, gaussians, pipeline, background, kernel_size=kernel_size)["render"]
-            
-            depth = rendering[6:7, :, :]
-            alpha = rendering[7:8, :, :]
-            rgb = rendering[:3, :, :]
-            
-            if view.gt_alpha_mask is not None:
-                depth[(view.gt_alpha_mask < 0.5)] = 0
-            
-            depth[(alpha < alpha_thres)] = 0
-            
-            intrinsic = o3d.camera.PinholeCameraIntrinsic(width=view.image_width, 
-                    height=view.image_height, 
-                    cx = view.image_width/2,
-                    cy = view.image_height/2,
-                    fx = view.image_width / (2 * math.tan(view.FoVx / 2.)),
-                    fy = view.image_height / (2 * math.tan(view.FoVy / 2.)))
-            extrinsic = np.asarray((view.world_view_transform.T).cpu().numpy())
-            
-            o3d_color = o3d.t.geometry.Image(np.asarray(rgb.permute(1,2,0).cpu().numpy(), order="C"))
-            o3d_depth = o3d.t.geometry.Image(np.asarray(depth.permute(1,2,0).cpu().numpy(), order="C"))
-            o3d_color = o3d_color.to(o3d_device)
-            o3d_depth = o3d_depth.to(o3d_device)
+    for _, view in enumerate(tqdm(views, desc="Rendering progress")):
+        depth, rgb = render_depth(view, gaussians, pipeline, background, kernel_size)
+        
+        # hand the tensors over without going through numpy
+        o3d_depth = o3d.t.geometry.Image(o3c.Tensor.from_dlpack(to_dlpack(depth[..., None])))
+        o3d_color = o3d.t.geometry.Image(o3c.Tensor.from_dlpack(to_dlpack(rgb)))
+        intrinsic, extrinsic = camera_matrices(view)
+        intrinsic = o3c.Tensor.from_dlpack(to_dlpack(intrinsic))
+        extrinsic = o3c.Tensor.from_dlpack(to_dlpack(extrinsic))
+        
+        frustum_block_coords = vbg.compute_unique_block_coordinates(
+            o3d_depth, intrinsic, extrinsic, 1.0, depth_max)
 
-            intrinsic = o3d.core.Tensor(intrinsic.intrinsic_matrix, o3d.core.Dtype.Float64)#.to(o3d_device)
-            extrinsic = o3d.core.Tensor(extrinsic, o3d.core.Dtype.Float64)#.to(o3d_device)
-            
-            frustum_block_coords = vbg.compute_unique_block_coordinates(
-                o3d_depth, intrinsic, extrinsic, 1.0, 6.0)
+        vbg.integrate(frustum_block_coords, o3d_depth, o3d_color, intrinsic,
+                      intrinsic, extrinsic, 1.0, depth_max)
+        
+    return vbg.extract_triangle_mesh().to_legacy()
 
-            vbg.integrate(frustum_block_coords, o3d_depth, o3d_color, intrinsic,
-                          intrinsic, extrinsic, 1.0, 6.0)
-            
-        mesh = vbg.extract_triangle_mesh().to_legacy()
+def tsdf_fusion_voxel_hash(views, gaussians, pipeline, background, kernel_size, voxel_size=0.002, block_count=50000, depth_max=6.0, batch_size=4):
+    # start with block_count blocks like open3d, the volume doubles its storage if it runs out
+    volume = VoxelHashTSDF(voxel_size, block_resolution=16, block_count=block_count, device="cpu")
+    
+    # integrate batch k on the cpu while the gpu renders batch k + 1
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    batch = []
+    def flush(batch):
+        depths, colors, intrinsics, extrinsics = zip(*batch)
+        return executor.submit(volume.integrate, torch.stack(depths), torch.stack(colors),
+                               torch.stack(intrinsics), torch.stack(extrinsics), depth_max)
+    
+    for i, view in enumerate(tqdm(views, desc="Rendering progress")):
+        depth, rgb = render_depth(view, gaussians, pipeline, background, kernel_size)
+        intrinsic, extrinsic = camera_matrices(view)
+        batch.append((depth.cpu(), rgb.cpu(), intrinsic, extrinsic))
+        if len(batch) == batch_size or i == len(views) - 1:
+            if pending is not None:
+                pending.result()
+            pending = flush(batch)
+            batch = []
+    if pending is not None:
+        pending.result()
+    executor.shutdown()
+    
+    verts, faces, colors = volume.extract_triangle_mesh()
+    mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(verts.astype(np.float64)),
+                                     o3d.utility.Vector3iVector(faces.astype(np.int32)))
+    mesh.vertex_colors = o3d.utility.Vector3dVector(np.clip(colors, 0, 1).astype(np.float64))
+    return mesh
+
+def tsdf_fusion(model_path, name, iteration, views, gaussians, pipeline, background, kernel_size,
+                backend="open3d", voxel_size=0.002, block_count=50000, depth_max=6.0, batch_size=4):
+    render_path = os.path.join(model_path, name, "ours_{}".format(iteration), "tsdf")
+
+    makedirs(render_path, exist_ok=True)
+    
+    with torch.no_grad():
+        start = time.time()
+        if backend == "open3d":
+            mesh = tsdf_fusion_open3d(views, gaussians, pipeline, background, kernel_size,
+                                      voxel_size=voxel_size, block_count=block_count, depth_max=depth_max)
+        else:
+            mesh = tsdf_fusion_voxel_hash(views, gaussians, pipeline, background, kernel_size,
+                                          voxel_size=voxel_size, block_count=block_count, depth_max=depth_max,
+                                          batch_size=batch_size)
+        elapsed = time.time() - start
+        print(f"{backend} tsdf fusion: {len(views)} frames in {elapsed:.1f}s ({len(views) / elapsed:.2f} frames/s, including meshing)")
         
         # write mesh
-        o3d.io.write_triangle_mesh(f"{render_path}/tsdf.ply", mesh)
+        mesh_path = f"{render_path}/tsdf.ply"
+        o3d.io.write_triangle_mesh(mesh_path, mesh)
+        return mesh_path
             
             
-def extract_mesh(dataset : ModelParams, opt, iteration : int, pipeline : PipelineParams):
+def extract_mesh(dataset : ModelParams, opt, iteration : int, pipeline : PipelineParams, device="cuda", **tsdf_args):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree, opt.network)
-        scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
+        # loads the point cloud of this iteration and the cameras on device
+        scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False, device=device)
     
         train_cameras = scene.getTrainCameras()
     
-        gaussians.load_ply(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "point_cloud.ply"))
-        gaussians.load_model(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "model.pt"))
+        gaussians.load_model(os.path.join(dataset.model_path, "point_cloud", f"iteration_{iteration}", "model.pt"), device=device)
         
         bg_color = [1,1,1] if dataset.white_background else [0, 0, 0]
-        background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+        background = torch.tensor(bg_color, dtype=torch.float32, device=device)
         kernel_size = dataset.kernel_size
         
         cams = train_cameras
-        tsdf_fusion(dataset.model_path, "test", iteration, cams, gaussians, pipeline, background, kernel_size)
+        return tsdf_fusion(dataset.model_path, "test", iteration, cams, gaussians, pipeline, background, kernel_size, **tsdf_args)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -103,6 +155,13 @@ if __name__ == "__main__":
     parser.add_argument("--hash_size", type=int, default=22)
     parser.add_argument("--hash_resolution", type=int, default=2048)
     parser.add_argument("--alpha", type=float, default=0.02)
+    parser.add_argument("--lod_levels", nargs="+", type=int, default=None, help="also write a tiled level of detail chain, e.g. 1 4 16")
+    parser.add_argument("--lod_tiles", nargs=3, type=int, default=[2, 2, 2])
+    parser.add_argument("--tsdf_backend", type=str, default="open3d", choices=["open3d", "voxel_hash"])
+    parser.add_argument("--voxel_size", type=float, default=0.002)
+    parser.add_argument("--block_count", type=int, default=50000, help="number of 16^3 voxel blocks to allocate up front (voxel_hash doubles it when it runs out)")
+    parser.add_argument("--depth_max", type=float, default=6.0)
+    parser.add_argument("--tsdf_batch", type=int, default=4, help="views fused per batch by the voxel_hash backend")
     args = get_combined_args(parser)
 
     op.network['grid']['hash_size'] = args.hash_size
@@ -115,6 +174,12 @@ if __name__ == "__main__":
     random.seed(0)
     np.random.seed(0)
     torch.manual_seed(0)
-    torch.cuda.set_device(torch.device("cuda:0"))
+    device = torch.device("cpu" if args.rasterizer == "cpu" else "cuda:0")
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
     
-    extract_mesh(model.extract(args), op.extract(args), args.iteration, pipeline.extract(args))
+    mesh_path = extract_mesh(model.extract(args), op.extract(args), args.iteration, pipeline.extract(args), device=device,
+                             backend=args.tsdf_backend, voxel_size=args.voxel_size, block_count=args.block_count,
+                             depth_max=args.depth_max, batch_size=args.tsdf_batch)
+    if args.lod_levels:
+        export_lod_from_file(mesh_path, levels=args.lod_levels, tiles=args.lod_tiles)
@@ -9,15 +9,35 @@
 # For inquiries contact  george.drettakis@inria.fr
 #
 
+from __future__ import annotations
+from typing import TYPE_CHECKING
 import torch
 import math
 import numpy as np
-from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
-from scene.sdf_gaussian_model_v3 import GaussianModel
+try:
+    from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+except ImportError:
+    # the CUDA extension is not built, only --rasterizer cpu works
+    from utils.cpu_rasterizer import GaussianRasterizationSettings
+    GaussianRasterizer = None
+if TYPE_CHECKING:
+    # only for annotations, the model pulls in CUDA-only extensions
+    from scene.sdf_gaussian_model_v3 import GaussianModel
 # from scene.gaussian_model import GaussianModel
 import torch.nn.functional as F
 from utils.sh_utils import eval_sh
 from utils.general_utils import depth_to_normal, get_samples, sample_along_rays, get_all_rays
+from utils import cpu_rasterizer
+
+def get_rasterizer(raster_settings, pipe):
+    backend = getattr(pipe, "rasterizer", "cuda")
+    if backend == "cpu":
+        return cpu_rasterizer.GaussianRasterizer(raster_settings=raster_settings)
+    if backend != "cuda":
+        raise ValueError(f"unknown rasterizer {backend}, use cuda or cpu")
+    if GaussianRasterizer is None:
+        raise ImportError("diff_gaussian_rasterization is not installed, run with --rasterizer cpu")
+    return GaussianRasterizer(raster_settings=raster_settings)
 
 def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, kernel_size: float, scaling_modifier = 1.0, override_color = None, subpixel_offset=None):
     """
@@ -27,7 +47,7 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
     try:
         screenspace_points.retain_grad()
     except:
@@ -38,7 +58,7 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -57,7 +77,7 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
@@ -127,7 +147,7 @@ def sdf_render_v2(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
     try:
         screenspace_points.retain_grad()
     except:
@@ -138,7 +158,7 @@ def sdf_render_v2(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -157,7 +177,7 @@ def sdf_render_v2(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     with torch.no_grad():
         frustum_mask, _, _ = project_to_image(viewpoint_camera, pc.get_xyz)
@@ -252,7 +272,7 @@ def sdf_render_v3(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
     try:
         screenspace_points.retain_grad()
     except:
@@ -263,7 +283,7 @@ def sdf_render_v3(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -282,7 +302,7 @@ def sdf_render_v3(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
@@ -295,12 +315,12 @@ def sdf_render_v3(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
 
     out = pc.query_sdf(mask_xyz, dir=dir_pp_normalized, return_opacity=True, return_rot_scale=True, return_color=False)
     gsdf, gopacity, gscale, grot, gcolor = out['sdf'], out['opacity'], out['scale'], out['rot'], out['color']
-    opacity = torch.zeros_like(pc.get_xyz[:, :1], dtype=pc.get_xyz.dtype, device="cuda")
+    opacity = torch.zeros_like(pc.get_xyz[:, :1], dtype=pc.get_xyz.dtype, device=pc.get_xyz.device)
     opacity[frustum_mask] = gopacity
 
-    scales = torch.zeros((opacity.shape[0], 3), dtype=pc.get_xyz.dtype, device="cuda")
+    scales = torch.zeros((opacity.shape[0], 3), dtype=pc.get_xyz.dtype, device=pc.get_xyz.device)
     scales[frustum_mask] = gscale
-    rotations = torch.zeros((opacity.shape[0], 4), dtype=pc.get_xyz.dtype, device="cuda")
+    rotations = torch.zeros((opacity.shape[0], 4), dtype=pc.get_xyz.dtype, device=pc.get_xyz.device)
     rotations[frustum_mask] = grot
 
     cov3D_precomp = None
@@ -324,7 +344,7 @@ def sdf_render_v3(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.T
     
     shs = None
     if gcolor is not None:
-        colors_precomp = torch.zeros((opacity.shape[0], 3), dtype=pc.get_xyz.dtype, device="cuda")
+        colors_precomp = torch.zeros((opacity.shape[0], 3), dtype=pc.get_xyz.dtype, device=pc.get_xyz.device)
         colors_precomp[frustum_mask] = gcolor
     else:
         colors_precomp = None
@@ -470,8 +490,9 @@ def sample_ellipse_planes(normals, U, V, u_scale, v_scale, centers, num_samples=
 
     return world_points # [n_gaussian, n_sample, 3]
 
-def project_to_image(viewpoint_camera, pts, device="cuda"):
+def project_to_image(viewpoint_camera, pts, device=None):
     # for each gaussian, project to image coordinate to match depth
+    device = pts.device if device is None else device
     H, W = viewpoint_camera.image_height, viewpoint_camera.image_width
     K = torch.eye(3).to(device)
     K[0, 0] = W / (2 * math.tan(viewpoint_camera.FoVx / 2))
@@ -479,7 +500,7 @@ def project_to_image(viewpoint_camera, pts, device="cuda"):
     K[0, 2] = (W - 1) / 2
     K[1, 2] = (H - 1) / 2
     rel_w2c = viewpoint_camera.world_view_transform.T
-    pts_ones = torch.ones(pts.shape[0], 1).cuda().float()
+    pts_ones = torch.ones(pts.shape[0], 1, device=device).float()
     pts4 = torch.cat((pts, pts_ones), dim=1)
     transformed_pts = (rel_w2c @ pts4.T).T[:, :3]
     u, v, d = transformed_pts[:, 0], transformed_pts[:, 1], transformed_pts[:, 2]
@@ -683,7 +704,7 @@ def sdf_render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tens
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
     try:
         screenspace_points.retain_grad()
     except:
@@ -694,7 +715,7 @@ def sdf_render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tens
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -713,7 +734,7 @@ def sdf_render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tens
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
@@ -872,7 +893,7 @@ def integrate(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color : t
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
     try:
         screenspace_points.retain_grad()
     except:
@@ -883,7 +904,7 @@ def integrate(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color : t
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -902,7 +923,7 @@ def integrate(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color : t
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
@@ -976,7 +997,7 @@ def integrate_sdf(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0.0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0.0
     try:
         screenspace_points.retain_grad()
     except:
@@ -987,7 +1008,7 @@ def integrate_sdf(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
 
     if subpixel_offset is None:
-        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device="cuda")
+        subpixel_offset = torch.zeros((int(viewpoint_camera.image_height), int(viewpoint_camera.image_width), 2), dtype=torch.float32, device=pc.get_xyz.device)
         
     raster_settings = GaussianRasterizationSettings(
         image_height=int(viewpoint_camera.image_height),
@@ -1006,7 +1027,7 @@ def integrate_sdf(points3D, viewpoint_camera, pc : GaussianModel, pipe, bg_color
         debug=pipe.debug
     )
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = get_rasterizer(raster_settings, pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
@@ -11,6 +11,9 @@
 
 from pathlib import Path
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import torch
 import torchvision.transforms.functional as tf
@@ -22,20 +25,62 @@ from tqdm import tqdm
 from utils.image_utils import psnr
 from argparse import ArgumentParser
 
-def readImages(renders_dir, gt_dir):
-    renders = []
-    gts = []
-    image_names = []
-    for fname in os.listdir(renders_dir):
-        render = Image.open(renders_dir / fname)
-
-        gt = Image.open(gt_dir / fname)
-        renders.append(tf.to_tensor(render).unsqueeze(0)[:, :3, :, :].cuda())
-        gts.append(tf.to_tensor(gt).unsqueeze(0)[:, :3, :, :].cuda())
-        image_names.append(fname)
-    return renders, gts, image_names
-
-def evaluate(model_paths, scale):
+def readImage(path):
+    with Image.open(path) as image:
+        return tf.to_tensor(image)[:3]
+
+def streamImageBatches(renders_dir, gt_dir, image_names, batch_size, workers):
+    """
+    Yield (names, renders, gts) batches of up to batch_size same-size CPU image pairs,
+    decoded by a thread pool. At most 2 * batch_size pairs are decoded ahead, which
+    bounds host memory.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        names = iter(image_names)
+        batch = []
+        while True:
+            while len(pending) < 2 * batch_size:
+                fname = next(names, None)
+                if fname is None:
+                    break
+                pending.append((fname, executor.submit(readImage, renders_dir / fname),
+                                executor.submit(readImage, gt_dir / fname)))
+            if not pending:
+                break
+            fname, render, gt = pending.popleft()
+            render, gt = render.result(), gt.result()
+            if batch and (len(batch) == batch_size or render.shape != batch[0][1].shape):
+                yield [b[0] for b in batch], torch.stack([b[1] for b in batch]), torch.stack([b[2] for b in batch])
+                batch = []
+            batch.append((fname, render, gt))
+        if batch:
+            yield [b[0] for b in batch], torch.stack([b[1] for b in batch]), torch.stack([b[2] for b in batch])
+
+@torch.no_grad()
+def evaluateMethod(renders_dir, gt_dir, lpips_fn, device, batch_size=8, workers=4):
+    """SSIM, PSNR and LPIPS of every render/gt pair, keeping only per-view values and running sums."""
+    image_names = sorted(os.listdir(renders_dir))
+    per_view = {"SSIM": {}, "PSNR": {}, "LPIPS": {}}
+    sums = {"SSIM": 0.0, "PSNR": 0.0, "LPIPS": 0.0}
+    start = time.time()
+    with tqdm(total=len(image_names), desc="Metric evaluation progress") as pbar:
+        for names, renders, gts in streamImageBatches(renders_dir, gt_dir, image_names, batch_size, workers):
+            renders, gts = renders.to(device, non_blocking=True), gts.to(device, non_blocking=True)
+            values = {"SSIM": ssim(renders, gts, size_average=False),
+                      "PSNR": psnr(renders, gts).reshape(-1),
+                      "LPIPS": lpips_fn(renders, gts).reshape(-1)}
+            for key, value in values.items():
+                value = value.tolist()
+                per_view[key].update(zip(names, value))
+                sums[key] += sum(value)
+            pbar.update(len(names))
+    elapsed = time.time() - start
+    print("  {} images in {:.1f}s, {:.2f} images/s".format(len(image_names), elapsed, len(image_names) / max(elapsed, 1e-9)))
+    means = {key: value / max(len(image_names), 1) for key, value in sums.items()}
+    return means, per_view
+
+def evaluate(model_paths, scale, lpips_fn, device, batch_size=8, workers=4):
 
     full_dict = {}
     per_view_dict = {}
@@ -64,45 +109,36 @@ def evaluate(model_paths, scale):
                 method_dir = test_dir / method
                 gt_dir = method_dir/ f"gt_{scale}"
                 renders_dir = method_dir / f"test_preds_{scale}"
-                renders, gts, image_names = readImages(renders_dir, gt_dir)
-
-                ssims = []
-                psnrs = []
-                lpipss = []
-
-                for idx in tqdm(range(len(renders)), desc="Metric evaluation progress"):
-                    ssims.append(ssim(renders[idx], gts[idx]))
-                    psnrs.append(psnr(renders[idx], gts[idx]))
-                    lpipss.append(lpips_fn(renders[idx], gts[idx]).detach())
+                means, per_view = evaluateMethod(renders_dir, gt_dir, lpips_fn, device, batch_size, workers)
 
-                print("  SSIM : {:>12.7f}".format(torch.tensor(ssims).mean(), ".5"))
-                print("  PSNR : {:>12.7f}".format(torch.tensor(psnrs).mean(), ".5"))
-                print("  LPIPS: {:>12.7f}".format(torch.tensor(lpipss).mean(), ".5"))
+                print("  SSIM : {:>12.7f}".format(means["SSIM"], ".5"))
+                print("  PSNR : {:>12.7f}".format(means["PSNR"], ".5"))
+                print("  LPIPS: {:>12.7f}".format(means["LPIPS"], ".5"))
                 print("")
 
-                full_dict[scene_dir][method].update({"SSIM": torch.tensor(ssims).mean().item(),
-                                                        "PSNR": torch.tensor(psnrs).mean().item(),
-                                                        "LPIPS": torch.tensor(lpipss).mean().item()})
-                per_view_dict[scene_dir][method].update({"SSIM": {name: ssim for ssim, name in zip(torch.tensor(ssims).tolist(), image_names)},
-                                                            "PSNR": {name: psnr for psnr, name in zip(torch.tensor(psnrs).tolist(), image_names)},
-                                                            "LPIPS": {name: lp for lp, name in zip(torch.tensor(lpipss).tolist(), image_names)}})
+                full_dict[scene_dir][method].update(means)
+                per_view_dict[scene_dir][method].update(per_view)
 
             with open(scene_dir + "/results.json", 'w') as fp:
                 json.dump(full_dict[scene_dir], fp, indent=True)
             with open(scene_dir + "/per_view.json", 'w') as fp:
                 json.dump(per_view_dict[scene_dir], fp, indent=True)
-        except:
-            print("Unable to compute metrics for model", scene_dir)
+        except OSError as e:
+            # missing or unreadable result folders/images, out-of-memory errors are not swallowed
+            print("Unable to compute metrics for model", scene_dir, e)
 
 if __name__ == "__main__":
-    device = torch.device("cuda:0")
-    torch.cuda.set_device(device)
-    lpips_fn = lpips.LPIPS(net='vgg').to(device)
-
     # Set up command line argument parser
     parser = ArgumentParser(description="Training script parameters")
     parser.add_argument('--model_paths', '-m', required=True, nargs="+", type=str, default=[])
     parser.add_argument('--resolution', '-r', type=int, default=-1)
+    parser.add_argument('--device', type=str, default="cuda:0")
+    parser.add_argument('--batch_size', type=int, default=8, help="image pairs per metric batch, bounds memory use")
+    parser.add_argument('--workers', type=int, default=4, help="image decoding threads")
     
     args = parser.parse_args()
-    evaluate(args.model_paths, args.resolution)
+    device = torch.device(args.device)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    lpips_fn = lpips.LPIPS(net='vgg').to(device)
+    evaluate(args.model_paths, args.resolution, lpips_fn, device, args.batch_size, args.workers)
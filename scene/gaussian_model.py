@@ -17,7 +17,6 @@ import os
 from utils.system_utils import mkdir_p
 from plyfile import PlyData, PlyElement
 from utils.sh_utils import RGB2SH
-from simple_knn._C import distCUDA2
 from utils.graphics_utils import BasicPointCloud
 from utils.general_utils import strip_symmetric, build_scaling_rotation
 import trimesh
@@ -44,7 +43,7 @@ class GaussianModel:
         self.rotation_activation = torch.nn.functional.normalize
 
 
-    def __init__(self, sh_degree : int):
+    def __init__(self, sh_degree : int, device="cuda"):
         self.active_sh_degree = 0
         self.max_sh_degree = sh_degree  
         self._xyz = torch.empty(0)
@@ -61,10 +60,10 @@ class GaussianModel:
         self.spatial_lr_scale = 0
         self.setup_functions()
         # appearance network and appearance embedding
-        self.appearance_network = AppearanceNetwork(3+64, 3).cuda()
+        self.appearance_network = AppearanceNetwork(3+64, 3).to(device)
         
         std = 1e-4
-        self._appearance_embeddings = nn.Parameter(torch.empty(2048, 64).cuda())
+        self._appearance_embeddings = nn.Parameter(torch.empty(2048, 64, device=device))
         self._appearance_embeddings.data.normal_(0, std)
 
     def capture(self):
@@ -157,7 +156,7 @@ class GaussianModel:
 
         q = r / norm[:, None]
         
-        R = torch.zeros((q.size(0), 3, 3), device='cuda')
+        R = torch.zeros((q.size(0), 3, 3), device=q.device)
 
         r = q[:, 0]
         x = q[:, 1]
@@ -177,7 +176,7 @@ class GaussianModel:
         rots = R
         xyz = self.get_xyz
         N = xyz.shape[0]
-        G2W = torch.zeros((N, 4, 4), device='cuda')
+        G2W = torch.zeros((N, 4, 4), device=xyz.device)
         G2W[:, :3, :3] = rots # TODO check if we need to transpose here
         G2W[:, :3, 3] = xyz
         G2W[:, 3, 3] = 1.0
@@ -189,7 +188,7 @@ class GaussianModel:
         t = G2V[:, :3, 3]
         
         t2 = torch.bmm(-R.transpose(1, 2), t[..., None])[..., 0]
-        V2G = torch.zeros((N, 4, 4), device='cuda')
+        V2G = torch.zeros((N, 4, 4), device=xyz.device)
         V2G[:, :3, :3] = R.transpose(1, 2)
         V2G[:, :3, 3] = t2
         V2G[:, 3, 3] = 1.0
@@ -254,6 +253,7 @@ class GaussianModel:
             self.active_sh_degree += 1
 
     def create_from_pcd(self, pcd : BasicPointCloud, spatial_lr_scale : float):
+        from simple_knn._C import distCUDA2
         self.spatial_lr_scale = spatial_lr_scale
         fused_point_cloud = torch.tensor(np.asarray(pcd.points)).float().cuda()
         fused_color = RGB2SH(torch.tensor(np.asarray(pcd.colors)).float().cuda())
@@ -384,7 +384,7 @@ class GaussianModel:
         # rots = rots[mask]
         
         vertices = M.vertices.T    
-        vertices = torch.from_numpy(vertices).float().cuda().unsqueeze(0).repeat(xyz.shape[0], 1, 1)
+        vertices = torch.from_numpy(vertices).float().to(xyz.device).unsqueeze(0).repeat(xyz.shape[0], 1, 1)
         # scale vertices first
         vertices = vertices * scale.unsqueeze(-1)
         vertices = torch.bmm(rots, vertices).squeeze(-1) + xyz.unsqueeze(-1)
@@ -420,7 +420,7 @@ class GaussianModel:
         self._opacity = optimizable_tensors["opacity"]
 
         
-    def load_ply(self, path):
+    def load_ply(self, path, device="cuda"):
         plydata = PlyData.read(path)
 
         xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
@@ -456,13 +456,13 @@ class GaussianModel:
         for idx, attr_name in enumerate(rot_names):
             rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
 
-        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._opacity = nn.Parameter(torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._scaling = nn.Parameter(torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._rotation = nn.Parameter(torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True))
-        self.filter_3D = torch.tensor(filter_3D, dtype=torch.float, device="cuda")
+        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device=device).requires_grad_(True))
+        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device=device).transpose(1, 2).contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device=device).transpose(1, 2).contiguous().requires_grad_(True))
+        self._opacity = nn.Parameter(torch.tensor(opacities, dtype=torch.float, device=device).requires_grad_(True))
+        self._scaling = nn.Parameter(torch.tensor(scales, dtype=torch.float, device=device).requires_grad_(True))
+        self._rotation = nn.Parameter(torch.tensor(rots, dtype=torch.float, device=device).requires_grad_(True))
+        self.filter_3D = torch.tensor(filter_3D, dtype=torch.float, device=device)
 
         self.active_sh_degree = self.max_sh_degree
 
@@ -6,10 +6,9 @@ import os
 from utils.system_utils import mkdir_p
 from plyfile import PlyData, PlyElement
 from utils.sh_utils import RGB2SH
-from simple_knn._C import distCUDA2
 from scipy.ndimage import gaussian_filter, distance_transform_edt
 from utils.graphics_utils import BasicPointCloud
-from utils.general_utils import strip_symmetric, build_scaling_rotation, get_minimum_axis, get_sorted_axis
+from utils.general_utils import strip_symmetric, build_scaling_rotation, get_minimum_axis, get_sorted_axis, morton_code
 import torch.nn.functional as F
 import trimesh
 from utils.vis_utils import save_points
@@ -47,8 +46,7 @@ class GaussianModel:
         self._features_dc = torch.empty(0)
         self._features_rest = torch.empty(0)
         self.max_radii2D = torch.empty(0)
-        self.xyz_gradient_accum = torch.empty(0)
-        self.denom = torch.empty(0)
+        self.densification_stats = torch.empty(0, 4)
         self.optimizer = None
         self.percent_dense = 0
         self.spatial_lr_scale = 0
@@ -101,11 +99,32 @@ class GaussianModel:
         net_opt_dict,
         self.spatial_lr_scale) = model_args
         self.training_setup(training_args)
-        self.xyz_gradient_accum = xyz_gradient_accum
-        self.denom = denom
+        self.xyz_gradient_accum[:] = xyz_gradient_accum
+        self.denom[:] = denom
         self.optimizer.load_state_dict(opt_dict)
         self.network_optimizer.load_state_dict(net_opt_dict)
 
+    # densification statistics live in one [N, 4] buffer, columns are
+    # (grad accum, abs grad accum, abs grad max, denom); these are strided views
+    @property
+    def xyz_gradient_accum(self):
+        return self.densification_stats[:, 0:1]
+
+    @property
+    def xyz_gradient_accum_abs(self):
+        return self.densification_stats[:, 1:2]
+
+    @property
+    def xyz_gradient_accum_abs_max(self):
+        return self.densification_stats[:, 2:3]
+
+    @property
+    def denom(self):
+        return self.densification_stats[:, 3:4]
+
+    def reset_densification_stats(self):
+        self.densification_stats = torch.zeros((self.get_xyz.shape[0], 4), device="cuda")
+
     @property
     def get_scaling(self):
         return self.scaling_activation(self._scaling)
@@ -182,7 +201,7 @@ class GaussianModel:
 
         q = r / norm[:, None]
         
-        R = torch.zeros((q.size(0), 3, 3), device='cuda')
+        R = torch.zeros((q.size(0), 3, 3), device=q.device)
 
         r = q[:, 0]
         x = q[:, 1]
@@ -202,7 +221,7 @@ class GaussianModel:
         rots = R
         xyz = self.get_xyz
         N = xyz.shape[0]
-        G2W = torch.zeros((N, 4, 4), device='cuda')
+        G2W = torch.zeros((N, 4, 4), device=q.device)
         G2W[:, :3, :3] = rots # TODO check if we need to transpose here
         G2W[:, :3, 3] = xyz
         G2W[:, 3, 3] = 1.0
@@ -214,7 +233,7 @@ class GaussianModel:
         t = G2V[:, :3, 3]
         
         t2 = torch.bmm(-R.transpose(1, 2), t[..., None])[..., 0]
-        V2G = torch.zeros((N, 4, 4), device='cuda')
+        V2G = torch.zeros((N, 4, 4), device=q.device)
         V2G[:, :3, :3] = R.transpose(1, 2)
         V2G[:, :3, 3] = t2
         V2G[:, 3, 3] = 1.0
@@ -247,10 +266,7 @@ class GaussianModel:
             self.set_bbox()
 
         self.percent_dense = training_args.percent_dense
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.xyz_gradient_accum_abs = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.xyz_gradient_accum_abs_max = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
+        self.reset_densification_stats()
         self.view_mask = torch.zeros(self.get_xyz.shape[0], dtype=torch.bool, device="cuda")
         self.query_sdf = SimpleSDF(self.cfg, self.bounding_box, in_dim=3, hidden_dim=32).cuda()
 
@@ -310,10 +326,10 @@ class GaussianModel:
         torch.save(save_dict, path)
         print('Model saved.')
 
-    def load_model(self, path):
-        model_dict = torch.load(path)
+    def load_model(self, path, device="cuda"):
+        model_dict = torch.load(path, map_location=device)
         self.bounding_box = model_dict['bounding_box']
-        self.query_sdf = SimpleSDF(self.cfg, self.bounding_box, in_dim=3, hidden_dim=32).cuda()
+        self.query_sdf = SimpleSDF(self.cfg, self.bounding_box, in_dim=3, hidden_dim=32).to(device)
         self.query_sdf.load_state_dict(model_dict['query_sdf'])
 
 
@@ -334,7 +350,7 @@ class GaussianModel:
         PlyData([el]).write(path)
     
     @torch.no_grad()
-    def get_tetra_points(self):
+    def get_tetra_points(self, batch=1_000_000, opacity_threshold=0.0):
         M = trimesh.creation.box()
         M.vertices *= 2
         
@@ -343,22 +359,29 @@ class GaussianModel:
         out = self.query_sdf(self.get_xyz, return_opacity=True, return_rot_scale=True)
         scale = out['scale']
         self.rot = out['rot']
-        rots = build_rotation(self.rot)
-        # filter points with small opacity for bicycle scene
-        # opacity = self.get_opacity_with_3D_filter
-        # mask = (opacity > 0.1).squeeze(-1)
-        # xyz = xyz[mask]
-        # scale = scale[mask]
-        # rots = rots[mask]
+        rot = self.rot
+        # filter points with small opacity (e.g. 0.1 for bicycle scene)
+        if opacity_threshold > 0:
+            mask = (out['opacity'] > opacity_threshold).squeeze(-1)
+            print(f"opacity filter keeps {mask.sum().item()} / {mask.shape[0]} gaussians")
+            xyz = xyz[mask]
+            scale = scale[mask]
+            rot = rot[mask]
         
-        vertices = M.vertices.T    
-        vertices = torch.from_numpy(vertices).float().cuda().unsqueeze(0).repeat(xyz.shape[0], 1, 1)
-        # scale vertices first
-        vertices = vertices * scale.unsqueeze(-1)
-        vertices = torch.bmm(rots, vertices).squeeze(-1) + xyz.unsqueeze(-1)
-        vertices = vertices.permute(0, 2, 1).reshape(-1, 3).contiguous()
+        # fill the 8 box corners of each Gaussian chunk by chunk instead of
+        # repeating the box for all Gaussians, then append the centers
+        box = torch.from_numpy(M.vertices.T).float().to(xyz.device)[None]
+        N = xyz.shape[0]
+        vertices = torch.empty((N * 9, 3), dtype=xyz.dtype, device=xyz.device)
+        for start in range(0, N, batch):
+            end = min(start + batch, N)
+            rots = build_rotation(rot[start:end])
+            # scale vertices first
+            corners = box * scale[start:end].unsqueeze(-1)
+            corners = torch.bmm(rots, corners) + xyz[start:end].unsqueeze(-1)
+            vertices[start * 8:end * 8] = corners.permute(0, 2, 1).reshape(-1, 3)
         # concat center points
-        vertices = torch.cat([vertices, xyz], dim=0)
+        vertices[N * 8:] = xyz
         
         # scale is not a good solution but use it for now
         scale = scale.max(dim=-1, keepdim=True)[0]
@@ -374,7 +397,7 @@ class GaussianModel:
     #     self.network_optimizer = torch.optim.Adam(sdf_l, lr=0.0, eps=1e-15)
     #     self.opacity_activation = self.sdf2opacity.density_func
 
-    def load_ply(self, path):
+    def load_ply(self, path, device="cuda"):
         plydata = PlyData.read(path)
 
         xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
@@ -395,9 +418,9 @@ class GaussianModel:
         # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
         features_extra = features_extra.reshape((features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1))
 
-        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
+        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device=device).requires_grad_(True))
+        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device=device).transpose(1, 2).contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device=device).transpose(1, 2).contiguous().requires_grad_(True))
 
         self.active_sh_degree = self.max_sh_degree
 
@@ -445,12 +468,32 @@ class GaussianModel:
         self._xyz = optimizable_tensors["xyz"]
         self._features_dc = optimizable_tensors["f_dc"]
         self._features_rest = optimizable_tensors["f_rest"]
-        self.xyz_gradient_accum = self.xyz_gradient_accum[valid_points_mask]
-        self.xyz_gradient_accum_abs = self.xyz_gradient_accum_abs[valid_points_mask]
-        self.xyz_gradient_accum_abs_max = self.xyz_gradient_accum_abs_max[valid_points_mask]
-        self.denom = self.denom[valid_points_mask]
+        self.densification_stats = self.densification_stats[valid_points_mask]
         self.max_radii2D = self.max_radii2D[valid_points_mask]
 
+    @torch.no_grad()
+    def reorder_by_morton(self):
+        '''
+        Sort all per-Gaussian tensors, optimizer moments and accumulators along a
+        Morton curve so that memory order follows spatial locality again after
+        clone/split appended new points at the end.
+        '''
+        if self.bounding_box is not None:
+            codes = morton_code(self.get_xyz, self.bounding_box[:, 0], self.bounding_box[:, 1])
+        else:
+            codes = morton_code(self.get_xyz)
+        order = torch.argsort(codes)
+
+        # indexing with a permutation instead of a mask keeps every point
+        optimizable_tensors = self._prune_optimizer(order)
+        self._xyz = optimizable_tensors["xyz"]
+        self._features_dc = optimizable_tensors["f_dc"]
+        self._features_rest = optimizable_tensors["f_rest"]
+        self.densification_stats = self.densification_stats[order]
+        self.max_radii2D = self.max_radii2D[order]
+        self.view_mask = self.view_mask[order]
+        return order
+
     def cat_tensors_to_optimizer(self, tensors_dict):
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
@@ -485,10 +528,7 @@ class GaussianModel:
         self._features_dc = optimizable_tensors["f_dc"]
         self._features_rest = optimizable_tensors["f_rest"]
 
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.xyz_gradient_accum_abs = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.xyz_gradient_accum_abs_max = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
+        self.reset_densification_stats()
         # self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
 
     def densify_and_split(self, grads, grad_threshold, grads_abs, grad_abs_threshold, scene_extent, N=2, use_sdf_mask=False):
@@ -591,10 +631,25 @@ class GaussianModel:
         torch.cuda.empty_cache()
         return clone - before, split - clone, split - prune
 
-    def add_densification_stats(self, viewspace_point_tensor, update_filter, frustum_mask):
-        self.xyz_gradient_accum[update_filter] += torch.norm(viewspace_point_tensor.grad[update_filter,:2], dim=-1, keepdim=True)
+    def add_densification_stats(self, viewspace_point_tensor, update_filter, frustum_mask=None):
+        '''
+        Accumulate the view-space gradient statistics of the visible Gaussians.
+
+        update_filter can be a boolean mask or a compact index list. All four
+        statistics are updated with one index_add_ and one scatter_reduce_ on
+        the shared buffer instead of four masked read-modify-writes.
+        '''
+        if update_filter.dtype == torch.bool:
+            update_filter = update_filter.nonzero(as_tuple=True)[0]
+        grad = viewspace_point_tensor.grad[update_filter]
+        grad_norm = torch.norm(grad[:, :2], dim=-1)
         #TODO maybe use max instead of average
-        self.xyz_gradient_accum_abs[update_filter] += torch.norm(viewspace_point_tensor.grad[update_filter,2:], dim=-1, keepdim=True)
-        self.xyz_gradient_accum_abs_max[update_filter] = torch.max(self.xyz_gradient_accum_abs_max[update_filter], torch.norm(viewspace_point_tensor.grad[update_filter,2:], dim=-1, keepdim=True))
-        self.denom[update_filter] += 1
-        self.view_mask[frustum_mask] = True
\ No newline at end of file
+        grad_abs_norm = torch.norm(grad[:, 2:], dim=-1)
+
+        # the max column gets +0 here and is reduced separately below
+        stats = torch.stack([grad_norm, grad_abs_norm, torch.zeros_like(grad_norm), torch.ones_like(grad_norm)], dim=-1)
+        self.densification_stats.index_add_(0, update_filter, stats)
+        self.densification_stats[:, 2].scatter_reduce_(0, update_filter, grad_abs_norm, reduce="amax")
+
+        if frustum_mask is not None:
+            self.view_mask |= frustum_mask
\ No newline at end of file
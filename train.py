@@ -158,7 +158,7 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
         if dataset.use_decoupled_appearance:
             Ll1 = L1_loss_appearance(image, gt_image, gaussians, viewpoint_cam.idx)
         
-        rgb_loss = (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - ssim(image, gt_image))
+        rgb_loss = (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - ssim(image, gt_image, fused=opt.fused_ssim))
         
         # depth distortion regularization
         distortion_map = rendering[8, :, :]
@@ -356,6 +356,9 @@ if __name__ == "__main__":
     parser.add_argument("--checkpoint_iterations", nargs="+", type=int, default=[])
     parser.add_argument("--start_checkpoint", type=str, default = None)
     args = parser.parse_args(sys.argv[1:])
+    if args.rasterizer == "cpu":
+        # the cpu rasterizer gives no screen space gradients for the densification stats
+        parser.error("--rasterizer cpu is for rendering and mesh extraction only, train with cuda")
     args.save_iterations.append(args.iterations)
 
     # args.source_path = '/home/kunyi/work/data/NeRF/lego'
@@ -47,6 +47,7 @@ except ImportError:
 import time
 from utils.vis_utils import apply_depth_colormap, save_points, colormap
 from utils.depth_utils import depths_to_points, depth_to_normal
+from utils.mesh_utils import filter_components
 
 TIMESTAMP = "{0:%Y-%m-%dT%H-%M-%S/}".format(datetime.now())
 
@@ -170,7 +171,7 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
             if dataset.use_decoupled_appearance:
                 Ll1 = L1_loss_appearance(image, gt_image, gaussians, viewpoint_cam.idx)
             
-            rgb_loss = (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - ssim(image, gt_image))
+            rgb_loss = (1.0 - opt.lambda_dssim) * Ll1 + opt.lambda_dssim * (1.0 - ssim(image, gt_image, fused=opt.fused_ssim))
             
             # depth distortion regularization
             distortion_map = rendering[8, :, :]
@@ -349,20 +350,10 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
                 mesh = trimesh.Trimesh(verts, faces, process=False)
 
                 # get connected components
-                components = mesh.split(only_watertight=False)
                 if True:
-                    areas = np.array([c.area for c in components], dtype=np.float)
-                    mesh = components[areas.argmax()]
+                    mesh = filter_components(mesh, largest=True)
                 else:
-                    new_components = []
-                    for comp in components:
-                        if comp.area > 0.2:
-                            new_components.append(comp)
-                    mesh = trimesh.util.concatenate(new_components)
-                verts = mesh.vertices
-                faces = mesh.faces
-
-                mesh = trimesh.Trimesh(verts, faces, process=False)
+                    mesh = filter_components(mesh, largest=False, min_area=0.2)
                 # mesh.fill_holes()
                 mesh.export(f"{dataset.model_path}/sdf_v2_mesh_{iteration}.ply")
                 print('Mesh saved')
@@ -371,11 +362,11 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
             # Densification
             if iteration < opt.densify_until_iter:
                 frustum_mask = render_pkg["frustum_mask"]
-                all_filter = torch.zeros_like(gaussians.max_radii2D, dtype=torch.bool).cuda()
-                all_filter[frustum_mask] = visibility_filter
+                # compact indices of the visible Gaussians in the full point set
+                visible_idx = frustum_mask.nonzero(as_tuple=True)[0][visibility_filter]
                 # Keep track of max radii in image-space for pruning
-                gaussians.max_radii2D[all_filter] = torch.max(gaussians.max_radii2D[all_filter], radii[visibility_filter])
-                gaussians.add_densification_stats(viewspace_point_tensor, all_filter)
+                gaussians.max_radii2D[visible_idx] = torch.max(gaussians.max_radii2D[visible_idx], radii[visibility_filter])
+                gaussians.add_densification_stats(viewspace_point_tensor, visible_idx)
 
                 if iteration < 4000:
                     densification_interval = 100
@@ -393,6 +384,8 @@ def training(dataset, opt, pipe, testing_iterations, saving_iterations, checkpoi
                         sdf_mask[frustum_mask] = gaussian_gradient > gaussian_gradient.mean() * 10
 
                     gaussians.densify_and_prune(densify_grad_threshold, 0.05, scene.cameras_extent, size_threshold, frustum_mask=frustum_mask, sdf_mask=sdf_mask)
+                    if opt.morton_reorder:
+                        gaussians.reorder_by_morton()
 
             # Optimizer step
             if iteration < opt.iterations:
@@ -515,6 +508,9 @@ if __name__ == "__main__":
     parser.add_argument("--checkpoint_iterations", nargs="+", type=int, default=[])
     parser.add_argument("--start_checkpoint", type=str, default = None)
     args = parser.parse_args(sys.argv[1:])
+    if args.rasterizer == "cpu":
+        # the cpu rasterizer gives no screen space gradients for the densification stats
+        parser.error("--rasterizer cpu is for rendering and mesh extraction only, train with cuda")
     args.save_iterations.append(args.iterations)
 
     # args.source_path = '/home/kunyi/work/data/NeRF/lego'
@@ -0,0 +1,558 @@
+#
+# Pure PyTorch reference of the diff-gaussian-rasterization forward and
+# integrate kernels (submodules/diff-gaussian-rasterization/cuda_rasterizer/forward.cu),
+# selected with --rasterizer cpu. It runs on the device of its inputs, so
+# rendering and mesh extraction work without the CUDA extension.
+#
+#   python -m utils.cpu_rasterizer --sizes 256x256 800x600 1280x720
+# benchmarks forward/integrate in tiles per second on random Gaussians.
+#
+import math
+import time
+from argparse import ArgumentParser
+from typing import NamedTuple
+import torch
+import torch.nn as nn
+from utils.sh_utils import eval_sh
+
+BLOCK_X = 16
+BLOCK_Y = 16
+NEAR_PLANE = 0.2
+FAR_PLANE = 100.0
+# the rasterizer outputs rgb, normal, depth, alpha and distortion
+OUTPUT_CHANNELS = 9
+
+# subpixel rays of the first integrate pass: centre and the 4 pixel corners
+INTEGRATE_OFFSETS = [(0.0, 0.0), (-0.5, -0.5), (0.5, -0.5), (-0.5, 0.5), (0.5, 0.5)]
+
+
+class GaussianRasterizationSettings(NamedTuple):
+    image_height: int
+    image_width: int
+    tanfovx : float
+    tanfovy : float
+    kernel_size : float
+    subpixel_offset: torch.Tensor
+    bg : torch.Tensor
+    scale_modifier : float
+    viewmatrix : torch.Tensor
+    projmatrix : torch.Tensor
+    sh_degree : int
+    campos : torch.Tensor
+    prefiltered : bool
+    debug : bool
+
+
+# per Gaussian features: the coefficients of r^T Q r, 2 b^T r and |Q r|^2 on
+# ray_basis (6 each), then c, the opacity, the colour and Q itself
+CC = 18
+OPACITY = 19
+RGB = slice(20, 23)
+QMAT = slice(23, 32)
+
+
+def ray_basis(rx, ry):
+    # quadratic forms of the ray (rx, ry, 1) become a matmul with quadratic_coefs
+    return torch.stack([rx * rx, ry * ry, rx * ry, rx, ry, torch.ones_like(rx)], dim=-1)
+
+
+def quadratic_coefs(A):
+    return torch.stack([A[:, 0, 0], A[:, 1, 1], 2 * A[:, 0, 1], 2 * A[:, 0, 2], 2 * A[:, 1, 2], A[:, 2, 2]], dim=-1)
+
+
+def quaternion_to_matrix(q):
+    # (r, x, y, z), not normalized, as computeCov3D / computeView2Gaussian
+    r, x, y, z = q.unbind(-1)
+    return torch.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - r * z), 2 * (x * z + r * y),
+        2 * (x * y + r * z), 1 - 2 * (x * x + z * z), 2 * (y * z - r * x),
+        2 * (x * z - r * y), 2 * (y * z + r * x), 1 - 2 * (x * x + y * y),
+    ], dim=-1).reshape(*q.shape[:-1], 3, 3)
+
+
+def preprocess(means3D, opacities, shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp, raster_settings):
+    """
+    Per Gaussian screen-space footprint (preprocessCUDA). Returns the radii,
+    the pixel coordinates, the view depth, the tile rectangles and the
+    per-Gaussian ray intersection terms: Q = M^T M, b = M^T o and c = |o|^2
+    with M = diag(1 / scale) R_v2g and o = t_v2g / scale, so that along a view
+    ray r the squared Mahalanobis distance at depth t is t^2 r^T Q r + 2 t b^T r + c.
+    The quadratic forms in r are stored as coefficients of ray_basis.
+    """
+    H, W = raster_settings.image_height, raster_settings.image_width
+    tanfovx, tanfovy = raster_settings.tanfovx, raster_settings.tanfovy
+    focal_x = W / (2.0 * tanfovx)
+    focal_y = H / (2.0 * tanfovy)
+    viewmatrix = raster_settings.viewmatrix
+    projmatrix = raster_settings.projmatrix
+    device, dtype = means3D.device, means3D.dtype
+
+    # the matrices are stored transposed, points are row vectors
+    p_view = means3D @ viewmatrix[:3, :3] + viewmatrix[3, :3]
+    p_hom = means3D @ projmatrix[:3] + projmatrix[3]
+    p_proj = p_hom[:, :2] / (p_hom[:, 3:] + 1e-7)
+    image_size = torch.tensor([W, H], dtype=dtype, device=device)
+    means2D = ((p_proj + 1.0) * image_size - 1.0) * 0.5
+
+    if cov3D_precomp is not None:
+        cov3D = cov3D_precomp[:, [0, 1, 2, 1, 3, 4, 2, 4, 5]].reshape(-1, 3, 3)
+    else:
+        R = quaternion_to_matrix(rotations)
+        S = scales * raster_settings.scale_modifier
+        cov3D = (R * (S * S)[:, None, :]) @ R.transpose(1, 2)
+
+    # EWA splatting with the tan(fov) clamp of computeCov2D
+    tz = p_view[:, 2]
+    limx, limy = 1.3 * tanfovx, 1.3 * tanfovy
+    tx = (p_view[:, 0] / tz).clamp(-limx, limx) * tz
+    ty = (p_view[:, 1] / tz).clamp(-limy, limy) * tz
+    J = torch.zeros((means3D.shape[0], 2, 3), dtype=dtype, device=device)
+    J[:, 0, 0] = focal_x / tz
+    J[:, 0, 2] = -(focal_x * tx) / (tz * tz)
+    J[:, 1, 1] = focal_y / tz
+    J[:, 1, 2] = -(focal_y * ty) / (tz * tz)
+    W2V = viewmatrix[:3, :3].T
+    JW = J @ W2V
+    cov2D = JW @ cov3D @ JW.transpose(1, 2)
+    cov_xx, cov_xy, cov_yy = cov2D[:, 0, 0], cov2D[:, 0, 1], cov2D[:, 1, 1]
+
+    # opacity compensation of the 2D filter
+    kernel_size = raster_settings.kernel_size
+    det_0 = cov_xx * cov_yy - cov_xy * cov_xy
+    det_1 = (cov_xx + kernel_size) * (cov_yy + kernel_size) - cov_xy * cov_xy
+    coef = torch.sqrt(det_0.clamp(min=1e-6) / (det_1.clamp(min=1e-6) + 1e-6) + 1e-6)
+    coef = torch.where((det_0 <= 1e-6) | (det_1 <= 1e-6), torch.zeros_like(coef), coef)
+    cov_xx, cov_yy = cov_xx + kernel_size, cov_yy + kernel_size
+    det = cov_xx * cov_yy - cov_xy * cov_xy
+
+    mid = 0.5 * (cov_xx + cov_yy)
+    lambda1 = mid + torch.sqrt((mid * mid - det).clamp(min=0.1))
+    radius = torch.ceil(3.0 * torch.sqrt(lambda1))
+
+    grid_x = (W + BLOCK_X - 1) // BLOCK_X
+    grid_y = (H + BLOCK_Y - 1) // BLOCK_Y
+    # getRect, the int cast truncates towards zero
+    rect_min_x = torch.trunc((means2D[:, 0] - radius) / BLOCK_X).clamp(0, grid_x)
+    rect_min_y = torch.trunc((means2D[:, 1] - radius) / BLOCK_Y).clamp(0, grid_y)
+    rect_max_x = torch.trunc((means2D[:, 0] + radius + BLOCK_X - 1) / BLOCK_X).clamp(0, grid_x)
+    rect_max_y = torch.trunc((means2D[:, 1] + radius + BLOCK_Y - 1) / BLOCK_Y).clamp(0, grid_y)
+    rect = torch.stack([rect_min_x, rect_min_y, rect_max_x, rect_max_y], dim=-1).long()
+
+    visible = (tz > NEAR_PLANE) & (det != 0) & ((rect[:, 2] - rect[:, 0]) * (rect[:, 3] - rect[:, 1]) > 0)
+    radii = torch.where(visible, radius, torch.zeros_like(radius)).detach().int()
+
+    if colors_precomp is None:
+        dirs = means3D - raster_settings.campos
+        dirs = dirs / dirs.norm(dim=1, keepdim=True)
+        colors = torch.clamp_min(eval_sh(raster_settings.sh_degree, shs.transpose(1, 2), dirs) + 0.5, 0.0)
+    else:
+        colors = colors_precomp
+
+    if view2gaussian_precomp is not None:
+        # stored transposed to match glm
+        V2G = view2gaussian_precomp.transpose(1, 2)
+        R_v2g, t_v2g = V2G[:, :3, :3], V2G[:, :3, 3]
+    else:
+        R_v2g = (W2V @ quaternion_to_matrix(rotations)).transpose(1, 2)
+        t_v2g = -(R_v2g @ p_view[..., None])[..., 0]
+
+    M = R_v2g / scales[..., None]
+    o = t_v2g / scales
+    Q = M.transpose(1, 2) @ M
+    b = (M.transpose(1, 2) @ o[..., None])[..., 0]
+    cc = (o * o).sum(dim=-1, keepdim=True)
+    opacity = opacities.reshape(-1, 1) * coef[:, None]
+    quad = torch.cat([quadratic_coefs(Q), torch.zeros_like(b), 2.0 * b, quadratic_coefs(Q @ Q)], dim=-1)
+
+    return {
+        "radii": radii,
+        "visible": visible,
+        "means2D": means2D,
+        "depths": tz,
+        "rect": rect,
+        "p_view": p_view,
+        "features": torch.cat([quad, cc, opacity, colors, Q.reshape(-1, 9)], dim=-1),
+        "focal": (focal_x, focal_y),
+        "grid": (grid_x, grid_y),
+    }
+
+
+def bin_gaussians(geom):
+    """
+    Duplicate every visible Gaussian into the tiles its rectangle touches and
+    sort by (tile, depth). Returns the sorted Gaussian ids, the [start, end)
+    range of every tile and the tiles ordered by list length, which is the
+    order they are batched in to keep the padding small.
+    """
+    rect, visible, depths = geom["rect"], geom["visible"], geom["depths"].detach()
+    grid_x, grid_y = geom["grid"]
+    device = rect.device
+    ids = visible.nonzero()[:, 0]
+    ids = ids[torch.argsort(depths[ids], stable=True)]
+    x0, y0 = rect[ids, 0], rect[ids, 1]
+    bw, bh = rect[ids, 2] - x0, rect[ids, 3] - y0
+    counts = bw * bh
+
+    gauss = torch.repeat_interleave(ids, counts)
+    local = torch.arange(gauss.shape[0], device=device) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    src = torch.repeat_interleave(torch.arange(ids.shape[0], device=device), counts)
+    tile = (y0[src] + local // bw[src]) * grid_x + x0[src] + local % bw[src]
+    order = torch.argsort(tile, stable=True)
+    gauss, tile = gauss[order], tile[order]
+
+    n_tiles = grid_x * grid_y
+    counts = torch.bincount(tile, minlength=n_tiles)
+    ranges_end = torch.cumsum(counts, 0)
+    ranges = torch.stack([ranges_end - counts, ranges_end], dim=-1)
+    return gauss, ranges, torch.argsort(counts, stable=True)
+
+
+def gather_tiles(features, gauss, ranges, tiles):
+    # per tile Gaussian features padded to the longest list, the padding is a
+    # transparent unit Gaussian at the camera so that no term divides by zero
+    counts = ranges[tiles, 1] - ranges[tiles, 0]
+    L = int(counts.max()) if tiles.numel() > 0 else 0
+    slot = torch.arange(L, device=gauss.device)
+    valid = slot[None] < counts[:, None]
+    index = (ranges[tiles, 0][:, None] + slot[None]).clamp(max=max(gauss.shape[0] - 1, 0))
+    ids = torch.where(valid, gauss[index], torch.full_like(index, -1))
+    padding = torch.zeros_like(features[0])
+    padding[[0, 1, 5, 12, 13, 17, CC, QMAT.start, QMAT.start + 4, QMAT.start + 8]] = 1.0
+    padded = torch.where(valid[..., None], features[ids.clamp(min=0)], padding)
+    return ids, padded
+
+
+def tile_pixels(tiles, grid_x, H, W):
+    # pixel coordinates of the 16x16 pixels of each tile
+    local = torch.arange(BLOCK_X * BLOCK_Y, device=tiles.device)
+    px = (tiles % grid_x)[:, None] * BLOCK_X + local[None] % BLOCK_X
+    py = (tiles // grid_x)[:, None] * BLOCK_Y + local[None] // BLOCK_X
+    inside = (px < W) & (py < H)
+    return px, py, inside
+
+
+def intersect(basis, g, forms=2):
+    """
+    Maximum of every Gaussian along every ray, basis is [n, R, 6] (ray_basis
+    of R rays) and g [n, K, F]. Returns t and alpha (0 where the kernel skips
+    the Gaussian) as [n, R, K], and |Q r|^2 for forms=3.
+    """
+    n, K = g.shape[:2]
+    coefs = g[..., :6 * forms].reshape(n, K * forms, 6).transpose(1, 2)
+    q = torch.bmm(basis, coefs).unflatten(-1, (K, forms))
+    AA, BB = q[..., 0], q[..., 1]
+    t = -BB / (2.0 * AA)
+    power = torch.clamp_max(-0.5 * (g[:, None, :, CC] - BB * BB / (4.0 * AA)), 0.0)
+    alpha = torch.clamp_max(g[:, None, :, OPACITY] * torch.exp(power), 0.99)
+    keep = (t > NEAR_PLANE) & (alpha >= 1.0 / 255.0)
+    alpha = torch.where(keep, alpha, torch.zeros_like(alpha))
+    return t, alpha, (q[..., 2] if forms == 3 else None)
+
+
+def exclusive_cumprod(x):
+    return torch.cumprod(torch.cat([torch.ones_like(x[..., :1]), x[..., :-1]], dim=-1), dim=-1)
+
+
+def render_tiles(geom, gauss, ranges, tiles, raster_settings, gaussian_batch):
+    """
+    renderCUDA for a batch of tiles: front-to-back compositing of the depth
+    sorted Gaussians, gaussian_batch at a time, until every pixel saturates.
+    Returns [n_tiles, 256, OUTPUT_CHANNELS] and the pixel coordinates.
+    """
+    H, W = raster_settings.image_height, raster_settings.image_width
+    features = geom["features"]
+    dtype = features.dtype
+    focal_x, focal_y = geom["focal"]
+    px, py, inside = tile_pixels(tiles, geom["grid"][0], H, W)
+    rx = ((px.to(dtype) + 0.5) - W / 2.0) / focal_x
+    ry = ((py.to(dtype) + 0.5) - H / 2.0) / focal_y
+    basis = ray_basis(rx, ry)
+    ray = torch.stack([rx, ry, torch.ones_like(rx)], dim=-1)
+    _, padded = gather_tiles(features, gauss, ranges, tiles)
+    n_tiles, L = padded.shape[:2]
+
+    T = torch.ones_like(rx)
+    done = ~inside
+    rgb = torch.zeros((n_tiles, BLOCK_X * BLOCK_Y, 3), dtype=dtype, device=tiles.device)
+    normal = torch.zeros_like(rgb)
+    depth = torch.zeros_like(T)
+    alpha_sum = torch.zeros_like(T)
+    dist1, dist2, distortion = torch.zeros_like(T), torch.zeros_like(T), torch.zeros_like(T)
+
+    for start in range(0, L, gaussian_batch):
+        if bool(done.all()):
+            break
+        g = padded[:, start:start + gaussian_batch]
+        t, alpha, QQ = intersect(basis, g, forms=3)
+
+        one_minus = 1.0 - alpha
+        T_before = T[..., None] * exclusive_cumprod(one_minus)
+        # a pixel stops at the first Gaussian that would bring T below 1e-4
+        stopped = torch.cumsum((T_before * one_minus < 1e-4).int(), dim=-1) > 0
+        live = (alpha > 0) & ~stopped & ~done[..., None]
+        w = torch.where(live, alpha * T_before, torch.zeros_like(alpha))
+
+        rgb = rgb + torch.bmm(w, g[..., RGB])
+        # normal -Q r / |Q r| of every Gaussian, sum_k w_k n_k = -(sum_k w_k / |Q_k r| Q_k) r
+        Q_sum = torch.bmm(w / torch.sqrt(QQ.clamp(min=0.0) + 1e-7), g[..., QMAT]).unflatten(-1, (3, 3))
+        normal = normal - (Q_sum @ ray[..., None])[..., 0]
+        alpha_sum = alpha_sum + w.sum(dim=-1)
+
+        # median depth: the last Gaussian composited while T > 0.5
+        median = live & (T_before > 0.5)
+        last = (median * torch.arange(1, median.shape[-1] + 1, device=tiles.device)).argmax(dim=-1, keepdim=True)
+        depth = torch.where(median.any(dim=-1), torch.gather(t, -1, last)[..., 0], depth)
+
+        # distortion loss of 2DGS on the NDC mapped depth
+        t_live = torch.where(live, t, torch.ones_like(t))
+        m = torch.where(live, (FAR_PLANE * t_live - FAR_PLANE * NEAR_PLANE) / ((FAR_PLANE - NEAR_PLANE) * t_live), torch.zeros_like(t))
+        mw, mmw = m * w, m * m * w
+        d1 = dist1[..., None] + torch.cumsum(mw, dim=-1) - mw
+        d2 = dist2[..., None] + torch.cumsum(mmw, dim=-1) - mmw
+        error = m * m * (1.0 - T_before) + d2 - 2.0 * m * d1
+        distortion = distortion + (error * w).sum(dim=-1)
+        dist1 = dist1 + mw.sum(dim=-1)
+        dist2 = dist2 + mmw.sum(dim=-1)
+
+        T = T * torch.where(live, one_minus, torch.ones_like(one_minus)).prod(dim=-1)
+        done = done | stopped[..., -1]
+
+    distortion = distortion / ((1.0 - T) * (1.0 - T) + 1e-7)
+    out = torch.cat([rgb + T[..., None] * raster_settings.bg, normal,
+                     depth[..., None], alpha_sum[..., None], distortion[..., None]], dim=-1)
+    return out, px, py, inside
+
+
+def integrate_tiles(geom, gauss, ranges, tiles, raster_settings, gaussian_batch):
+    """
+    First pass of integrateCUDA: a Gaussian contributes to a pixel if any of
+    the 5 subpixel rays composites it (per-ray T, no early termination).
+    Returns the rendered image of the tiles, the contributor mask [n_tiles, 256, L]
+    and the padded Gaussian features of every tile.
+    """
+    H, W = raster_settings.image_height, raster_settings.image_width
+    features = geom["features"]
+    dtype = features.dtype
+    focal_x, focal_y = geom["focal"]
+    px, py, inside = tile_pixels(tiles, geom["grid"][0], H, W)
+    offsets = torch.tensor(INTEGRATE_OFFSETS, dtype=dtype, device=tiles.device)
+    rx = ((px.to(dtype)[..., None] + 0.5 + offsets[:, 0]) - W / 2.0) / focal_x
+    ry = ((py.to(dtype)[..., None] + 0.5 + offsets[:, 1]) - H / 2.0) / focal_y
+    n_rays = len(INTEGRATE_OFFSETS)
+    basis = ray_basis(rx, ry).flatten(1, 2)
+    _, padded = gather_tiles(features, gauss, ranges, tiles)
+    n_tiles, L = padded.shape[:2]
+
+    T = torch.ones_like(rx)
+    used = torch.zeros((n_tiles, BLOCK_X * BLOCK_Y, L), dtype=torch.bool, device=tiles.device)
+    rgb = torch.zeros((n_tiles, BLOCK_X * BLOCK_Y, 3), dtype=dtype, device=tiles.device)
+    depth = torch.zeros_like(T[..., 0])
+    alpha_sum = torch.zeros_like(T[..., 0])
+
+    for start in range(0, L, gaussian_batch):
+        g = padded[:, start:start + gaussian_batch]
+        t, alpha, _ = intersect(basis, g)
+        t, alpha = t.unflatten(1, (-1, n_rays)), alpha.unflatten(1, (-1, n_rays))
+        ok = (alpha > 0) & inside[..., None, None]
+        T_in = T
+        T = T_in * torch.prod(1.0 - alpha, dim=-1)
+        # rays that reach T < 1e-4 skip the Gaussians that would saturate them,
+        # later (fainter) ones can still pass, so those rays are walked in order
+        saturated = T < 1e-4
+        if bool(saturated.any()):
+            alpha_s, ok_s, T_s = alpha[saturated], ok[saturated], T_in[saturated]
+            for k in range(alpha_s.shape[-1]):
+                test_T = T_s * (1.0 - alpha_s[:, k])
+                ok_s[:, k] &= test_T >= 1e-4
+                T_s = torch.where(ok_s[:, k], test_T, T_s)
+            ok[saturated] = ok_s
+            T[saturated] = T_s
+        used[..., start:start + gaussian_batch] = ok.any(dim=-2)
+
+        # the image of this pass never updates T
+        centre = torch.where(ok[:, :, 0], alpha[:, :, 0], torch.zeros_like(alpha[:, :, 0]))
+        rgb = rgb + torch.bmm(centre, g[..., RGB])
+        alpha_sum = alpha_sum + centre.sum(dim=-1)
+        depth = torch.maximum(depth, torch.where(ok, t, torch.zeros_like(t)).amax(dim=(-2, -1)))
+
+    out = torch.cat([rgb + raster_settings.bg, torch.zeros_like(rgb),
+                     depth[..., None], alpha_sum[..., None], torch.zeros_like(depth[..., None])], dim=-1)
+    return out, px, py, inside, used, padded
+
+
+def integrate_points(padded, used, rx, ry, depth, tile_index, pixel_index, point_batch):
+    """
+    Second pass of integrateCUDA: every point is evaluated along its own ray,
+    at min(t_max, point depth), against the contributors of its pixel.
+    Returns the accumulated opacity 1 - prod(1 - alpha) per point.
+    """
+    alpha_integrated = torch.empty_like(depth)
+    L = padded.shape[1]
+    # only the r^T Q r and 2 b^T r coefficients, c and the opacity are needed
+    compact = torch.cat([padded[..., :12], padded[..., CC:OPACITY + 1]], dim=-1)
+    step = max(1, point_batch // max(L, 1))
+    for start in range(0, depth.shape[0], step):
+        sl = slice(start, start + step)
+        g = compact[tile_index[sl]]
+        coefs = g[..., :12].reshape(g.shape[0], L * 2, 6).transpose(1, 2)
+        q = torch.bmm(ray_basis(rx[sl], ry[sl])[:, None], coefs)[:, 0].unflatten(-1, (L, 2))
+        AA, BB = q[..., 0], q[..., 1]
+        t = torch.minimum(-BB / (2.0 * AA), depth[sl, None].expand_as(AA))
+        power = -0.5 * (t * t * AA + t * BB + g[..., 12])
+        alpha = torch.clamp_max(g[..., 13] * torch.exp(power), 0.99)
+        contrib = used[tile_index[sl], pixel_index[sl]] & (alpha >= 1.0 / 255.0)
+        alpha = torch.where(contrib, alpha, torch.zeros_like(alpha))
+        alpha_integrated[sl] = 1.0 - torch.prod(1.0 - alpha, dim=-1)
+    return alpha_integrated
+
+
+class GaussianRasterizer(nn.Module):
+    """
+    Drop-in for diff_gaussian_rasterization.GaussianRasterizer. forward and
+    integrate take the same arguments and return the same outputs. Gradients
+    flow through the torch ops to all Gaussian parameters except means2D,
+    which the CUDA backward fills for densification only.
+    """
+    def __init__(self, raster_settings, tile_batch=8, gaussian_batch=32, point_batch=1 << 22):
+        super().__init__()
+        self.raster_settings = raster_settings
+        self.tile_batch = tile_batch
+        self.gaussian_batch = gaussian_batch
+        self.point_batch = point_batch
+
+    def markVisible(self, positions):
+        with torch.no_grad():
+            viewmatrix = self.raster_settings.viewmatrix
+            p_view = positions @ viewmatrix[:3, :3] + viewmatrix[3, :3]
+            return p_view[:, 2] > NEAR_PLANE
+
+    def check_inputs(self, shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp):
+        if (shs is None and colors_precomp is None) or (shs is not None and colors_precomp is not None):
+            raise Exception('Please provide excatly one of either SHs or precomputed colors!')
+
+        if ((scales is None or rotations is None) and cov3D_precomp is None) or ((scales is not None or rotations is not None) and cov3D_precomp is not None):
+            raise Exception('Please provide exactly one of either scale/rotation pair or precomputed 3D covariance!')
+
+        # the ray-Gaussian intersection works in the scaled local frame of each Gaussian
+        if scales is None or (rotations is None and view2gaussian_precomp is None):
+            raise Exception('The CPU rasterizer needs scales and rotations (or a precomputed view2gaussian)!')
+
+    def image(self, tile_outputs):
+        raster_settings = self.raster_settings
+        H, W = raster_settings.image_height, raster_settings.image_width
+        out, px, py, inside = [torch.cat(x) for x in zip(*tile_outputs)]
+        image = out.new_zeros((H * W, OUTPUT_CHANNELS)).index_put((py[inside] * W + px[inside],), out[inside])
+        return image.T.reshape(OUTPUT_CHANNELS, H, W)
+
+    def forward(self, means3D, means2D, opacities, shs = None, colors_precomp = None, scales = None, rotations = None, cov3D_precomp = None, view2gaussian_precomp = None):
+        self.check_inputs(shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp)
+        raster_settings = self.raster_settings
+        geom = preprocess(means3D, opacities, shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp, raster_settings)
+        gauss, ranges, tiles = bin_gaussians(geom)
+
+        tile_outputs = [render_tiles(geom, gauss, ranges, tiles[start:start + self.tile_batch], raster_settings, self.gaussian_batch)
+                        for start in range(0, tiles.shape[0], self.tile_batch)]
+        return self.image(tile_outputs), geom["radii"]
+
+    @torch.no_grad()
+    def integrate(self, points3D, means3D, means2D, opacities, shs = None, colors_precomp = None, scales = None, rotations = None, cov3D_precomp = None, view2gaussian_precomp = None):
+        self.check_inputs(shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp)
+        raster_settings = self.raster_settings
+        H, W = raster_settings.image_height, raster_settings.image_width
+        geom = preprocess(means3D, opacities, shs, colors_precomp, scales, rotations, cov3D_precomp, view2gaussian_precomp, raster_settings)
+        gauss, ranges, tiles = bin_gaussians(geom)
+        focal_x, focal_y = geom["focal"]
+        grid_x = geom["grid"][0]
+        device, dtype = means3D.device, means3D.dtype
+
+        # preprocessPointsCUDA: a point belongs to the pixel whose [pix, pix + 1) area it projects into
+        viewmatrix = raster_settings.viewmatrix
+        p_view = points3D @ viewmatrix[:3, :3] + viewmatrix[3, :3]
+        u = focal_x * p_view[:, 0] / (p_view[:, 2] + 1e-7) + W / 2.0
+        v = focal_y * p_view[:, 1] / (p_view[:, 2] + 1e-7) + H / 2.0
+        projected = (p_view[:, 2] > NEAR_PLANE) & (u >= 0) & (u < W) & (v >= 0) & (v < H)
+        point_ids = projected.nonzero()[:, 0]
+        pu, pv = u[point_ids], v[point_ids]
+        pix_x, pix_y = pu.floor().long().clamp(0, W - 1), pv.floor().long().clamp(0, H - 1)
+        point_tile = (pix_y // BLOCK_Y) * grid_x + pix_x // BLOCK_X
+        point_pixel = (pix_y % BLOCK_Y) * BLOCK_X + pix_x % BLOCK_X
+        point_rx = (pu - W / 2.0) / focal_x
+        point_ry = (pv - H / 2.0) / focal_y
+
+        alpha_integrated = torch.ones(points3D.shape[0], dtype=dtype, device=device)
+        color_integrated = torch.zeros((points3D.shape[0], 3), dtype=dtype, device=device)
+        num_projected = torch.bincount(pix_y * W + pix_x, minlength=H * W).to(dtype)
+
+        tile_slot = torch.empty_like(tiles)
+        tile_slot[tiles] = torch.arange(tiles.shape[0], device=device)
+        point_slot = tile_slot[point_tile]
+        tile_outputs = []
+        for start in range(0, tiles.shape[0], self.tile_batch):
+            batch = tiles[start:start + self.tile_batch]
+            out, px, py, inside, used, padded = integrate_tiles(geom, gauss, ranges, batch, raster_settings, self.gaussian_batch)
+            tile_outputs.append((out, px, py, inside))
+
+            in_batch = (point_slot >= start) & (point_slot < start + batch.shape[0])
+            if not bool(in_batch.any()):
+                continue
+            tile_index, pixel_index = point_slot[in_batch] - start, point_pixel[in_batch]
+            ids = point_ids[in_batch]
+            alpha_integrated[ids] = integrate_points(padded, used, point_rx[in_batch], point_ry[in_batch],
+                                                     p_view[ids, 2], tile_index, pixel_index, self.point_batch)
+            color_integrated[ids] = out[tile_index, pixel_index, :3]
+
+        color = self.image(tile_outputs)
+        color[OUTPUT_CHANNELS - 1] = num_projected.reshape(H, W)
+        return color, alpha_integrated, color_integrated, geom["radii"]
+
+
+def benchmark(sizes, num_gaussians, device, repeat=3):
+    from utils.graphics_utils import getProjectionMatrix
+
+    torch.manual_seed(0)
+    fov = math.radians(60.0)
+    means3D = torch.randn(num_gaussians, 3, device=device) * torch.tensor([1.0, 1.0, 0.5], device=device) + torch.tensor([0.0, 0.0, 4.0], device=device)
+    scales = torch.rand(num_gaussians, 3, device=device) * 0.03 + 0.005
+    rotations = torch.nn.functional.normalize(torch.randn(num_gaussians, 4, device=device), dim=-1)
+    opacities = torch.rand(num_gaussians, 1, device=device)
+    colors = torch.rand(num_gaussians, 3, device=device)
+    points3D = torch.randn(num_gaussians, 3, device=device) + torch.tensor([0.0, 0.0, 4.0], device=device)
+
+    for W, H in sizes:
+        fovx = 2 * math.atan(math.tan(fov / 2) * W / H)
+        viewmatrix = torch.eye(4, device=device)
+        projmatrix = viewmatrix @ getProjectionMatrix(znear=0.01, zfar=100.0, fovX=fovx, fovY=fov).transpose(0, 1).to(device)
+        raster_settings = GaussianRasterizationSettings(
+            image_height=H, image_width=W, tanfovx=math.tan(fovx / 2), tanfovy=math.tan(fov / 2),
+            kernel_size=0.0, subpixel_offset=torch.zeros((H, W, 2), device=device), bg=torch.zeros(3, device=device),
+            scale_modifier=1.0, viewmatrix=viewmatrix, projmatrix=projmatrix, sh_degree=0,
+            campos=torch.zeros(3, device=device), prefiltered=False, debug=False)
+        rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+        n_tiles = ((W + BLOCK_X - 1) // BLOCK_X) * ((H + BLOCK_Y - 1) // BLOCK_Y)
+        kwargs = dict(means3D=means3D, means2D=None, opacities=opacities, colors_precomp=colors, scales=scales, rotations=rotations)
+
+        with torch.no_grad():
+            _, ranges, _ = bin_gaussians(preprocess(means3D, opacities, None, colors, scales, rotations, None, None, raster_settings))
+            per_tile = (ranges[:, 1] - ranges[:, 0]).float().mean().item()
+            rasterizer(**kwargs)
+            start_time = time.time()
+            for _ in range(repeat):
+                rasterizer(**kwargs)
+            forward_time = (time.time() - start_time) / repeat
+            start_time = time.time()
+            for _ in range(repeat):
+                rasterizer.integrate(points3D=points3D, **kwargs)
+            integrate_time = (time.time() - start_time) / repeat
+        print(f"{W}x{H} ({n_tiles} tiles, {per_tile:.0f} Gaussians per tile): forward {n_tiles / forward_time:.1f} tiles/s, "
+              f"integrate {n_tiles / integrate_time:.1f} tiles/s")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="CPU rasterizer benchmark")
+    parser.add_argument("--sizes", type=str, nargs="+", default=["256x256", "512x384", "800x600"])
+    parser.add_argument("--num_gaussians", type=int, default=20000)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark([tuple(int(x) for x in size.split("x")) for size in args.sizes], args.num_gaussians, args.device, args.repeat)
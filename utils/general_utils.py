@@ -62,7 +62,7 @@ def get_expon_lr_func(
     return helper
 
 def strip_lowerdiag(L):
-    uncertainty = torch.zeros((L.shape[0], 6), dtype=torch.float, device="cuda")
+    uncertainty = torch.zeros((L.shape[0], 6), dtype=torch.float, device=L.device)
 
     uncertainty[:, 0] = L[:, 0, 0]
     uncertainty[:, 1] = L[:, 0, 1]
@@ -80,7 +80,7 @@ def build_rotation(r):
 
     q = r / norm[:, None]
 
-    R = torch.zeros((q.size(0), 3, 3), device='cuda')
+    R = torch.zeros((q.size(0), 3, 3), device=q.device)
 
     r = q[:, 0]
     x = q[:, 1]
@@ -99,7 +99,7 @@ def build_rotation(r):
     return R
 
 def build_scaling_rotation(s, r):
-    L = torch.zeros((s.shape[0], 3, 3), dtype=torch.float, device="cuda")
+    L = torch.zeros((s.shape[0], 3, 3), dtype=torch.float, device=s.device)
     R = build_rotation(r)
 
     L[:,0,0] = s[:,0]
@@ -130,7 +130,8 @@ def safe_state(silent):
     random.seed(0)
     np.random.seed(0)
     torch.manual_seed(0)
-    torch.cuda.set_device(torch.device("cuda:0"))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(torch.device("cuda:0"))
 
 def get_linear_noise_func(
         lr_init, lr_final, lr_delay_steps=0, lr_delay_mult=1.0, max_steps=1000000
@@ -168,6 +169,31 @@ def get_linear_noise_func(
     return helper
 
 
+def _part1by2(x):
+    # spread the lower 21 bits of x so that there are two zero bits between each
+    x = x & 0x1fffff
+    x = (x | x << 32) & 0x1f00000000ffff
+    x = (x | x << 16) & 0x1f0000ff0000ff
+    x = (x | x << 8) & 0x100f00f00f00f00f
+    x = (x | x << 4) & 0x10c30c30c30c30c3
+    x = (x | x << 2) & 0x1249249249249249
+    return x
+
+def morton_code(xyz, bbox_min=None, bbox_max=None, bits=21):
+    """
+    63-bit Morton (z-order) code of each point, quantized to 2^bits cells per axis
+    inside [bbox_min, bbox_max] (the point bounds if not given).
+    """
+    if bbox_min is None:
+        bbox_min = xyz.min(dim=0).values
+    if bbox_max is None:
+        bbox_max = xyz.max(dim=0).values
+    extent = torch.clamp(bbox_max - bbox_min, min=1e-12)
+    cells = (1 << bits) - 1
+    q = ((xyz - bbox_min) / extent).clamp(0, 1) * cells
+    q = q.long()
+    return (_part1by2(q[:, 0]) << 2) | (_part1by2(q[:, 1]) << 1) | _part1by2(q[:, 2])
+
 def get_minimum_axis(scales, rotations):
     sorted_idx = torch.argsort(scales, descending=False, dim=-1)
     R = build_rotation(rotations)
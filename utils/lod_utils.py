@@ -0,0 +1,81 @@
+import os
+import json
+import numpy as np
+import trimesh
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _decimate_tile(out_dir, name, vertices, faces, levels, boundary_weight):
+    import open3d as o3d
+    mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices.astype(np.float64)),
+                                     o3d.utility.Vector3iVector(faces.astype(np.int32)))
+    lods = []
+    for level in levels:
+        if level == 1:
+            lod_vertices, lod_faces = vertices, faces
+        else:
+            target = max(1, faces.shape[0] // level)
+            # a high boundary weight keeps the tile borders in place so neighbouring tiles still meet
+            lod = mesh.simplify_quadric_decimation(target, boundary_weight=boundary_weight)
+            lod_vertices, lod_faces = np.asarray(lod.vertices), np.asarray(lod.triangles)
+        path = os.path.join(f"lod_{level}", f"{name}.ply")
+        trimesh.Trimesh(lod_vertices, lod_faces, process=False).export(os.path.join(out_dir, path))
+        lods.append({"level": level, "path": path, "vertices": int(lod_vertices.shape[0]), "faces": int(lod_faces.shape[0])})
+    return lods
+
+
+def export_lod_tiles(vertices, faces, out_dir, levels=(1, 4, 16), tiles=(2, 2, 2), num_workers=None, boundary_weight=1000.0):
+    """
+    Write a level of detail chain of a mesh, split into spatial tiles.
+
+    Faces are assigned to tiles by their centroid and every tile is decimated
+    to 1/level of its faces for each level in a worker process. The output is
+    out_dir/lod_<level>/tile_<i>_<j>_<k>.ply plus out_dir/index.json listing
+    the bounding box, files and sizes of every tile and level, so a viewer can
+    load only the tiles and levels it needs.
+    """
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces)
+    for level in levels:
+        os.makedirs(os.path.join(out_dir, f"lod_{level}"), exist_ok=True)
+
+    bmin, bmax = vertices.min(axis=0), vertices.max(axis=0)
+    tile_size = (bmax - bmin) / np.asarray(tiles)
+    centroid = vertices[faces].mean(axis=1)
+    tile_idx = np.clip(np.floor((centroid - bmin) / np.maximum(tile_size, 1e-12)).astype(np.int64), 0, np.asarray(tiles) - 1)
+    tile_key = (tile_idx[:, 0] * tiles[1] + tile_idx[:, 1]) * tiles[2] + tile_idx[:, 2]
+
+    order = np.argsort(tile_key, kind='stable')
+    keys, starts = np.unique(tile_key[order], return_index=True)
+    ends = np.append(starts[1:], order.shape[0])
+
+    entries = []
+    with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        futures = []
+        for key, start, end in zip(keys, starts, ends):
+            tile_faces = faces[order[start:end]]
+            used, remap = np.unique(tile_faces, return_inverse=True)
+            i, j, k = int(key // (tiles[1] * tiles[2])), int(key // tiles[2] % tiles[1]), int(key % tiles[2])
+            name = f"tile_{i}_{j}_{k}"
+            lo = bmin + np.array([i, j, k]) * tile_size
+            entries.append({"tile": [i, j, k], "bbox": [lo.tolist(), (lo + tile_size).tolist()]})
+            futures.append(executor.submit(_decimate_tile, out_dir, name, vertices[used], remap.reshape(-1, 3),
+                                           levels, boundary_weight))
+        for entry, future in zip(entries, futures):
+            entry["lods"] = future.result()
+
+    index = {"bbox": [bmin.tolist(), bmax.tolist()], "tiles": list(tiles), "levels": list(levels), "entries": entries}
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+    print(f"wrote {len(entries)} tiles x {len(levels)} levels of detail to {out_dir}")
+    return index
+
+
+def export_lod_from_file(mesh_path, out_dir=None, **kwargs):
+    """
+    export_lod_tiles for a mesh on disk, written next to it by default.
+    """
+    mesh = trimesh.load(mesh_path, process=False)
+    if out_dir is None:
+        out_dir = os.path.splitext(mesh_path)[0] + "_lod"
+    return export_lod_tiles(mesh.vertices, mesh.faces, out_dir, **kwargs)
@@ -37,7 +37,83 @@ def create_window(window_size, channel):
     window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
     return window
 
-def ssim(img1, img2, window_size=11, size_average=True):
+_window_1d_cache = {}
+
+def create_window_1d(window_size, channel, dtype, device):
+    """[5 * channel, 1, window_size, 1] separable gaussian window, cached per size/dtype/device."""
+    key = (window_size, channel, dtype, device)
+    if key not in _window_1d_cache:
+        window = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+        _window_1d_cache[key] = window.reshape(1, 1, window_size, 1).repeat(5 * channel, 1, 1, 1).contiguous()
+    return _window_1d_cache[key]
+
+def _filter_stats(stats, window):
+    # gaussian blur of all five statistics, rows then columns, in two grouped conv calls
+    pad = window.shape[2] // 2
+    stats = F.conv2d(stats, window, padding=(pad, 0), groups=stats.shape[1])
+    return F.conv2d(stats, window.transpose(2, 3), padding=(0, pad), groups=stats.shape[1])
+
+def _ssim_terms(img1, img2, window):
+    C1 = 0.01 ** 2
+    C2 = 0.03 ** 2
+    mu1, mu2, e11, e22, e12 = _filter_stats(torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], dim=1), window).chunk(5, dim=1)
+    mu1_sq, mu2_sq, mu1_mu2 = mu1.pow(2), mu2.pow(2), mu1 * mu2
+    A1 = 2 * mu1_mu2 + C1
+    A2 = 2 * (e12 - mu1_mu2) + C2
+    B1 = mu1_sq + mu2_sq + C1
+    B2 = (e11 - mu1_sq) + (e22 - mu2_sq) + C2
+    return mu1, mu2, A1, A2, B1, B2
+
+class _FusedSSIM(torch.autograd.Function):
+    """SSIM map with an analytic backward: the gradient w.r.t. the five blurred statistics is blurred back in one pass."""
+
+    @staticmethod
+    def forward(ctx, img1, img2, window):
+        mu1, mu2, A1, A2, B1, B2 = _ssim_terms(img1, img2, window)
+        B = B1 * B2
+        ssim_map = A1 * A2 / B
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            d_e = -ssim_map / B2
+            d_e12 = 2 * A1 / B
+            d_mu1 = (2 * mu2 * (A2 - A1) - 2 * mu1 * ssim_map * (B2 - B1)) / B
+            d_mu2 = (2 * mu1 * (A2 - A1) - 2 * mu2 * ssim_map * (B2 - B1)) / B
+            ctx.save_for_backward(img1, img2, window, torch.cat([d_mu1, d_mu2, d_e, d_e, d_e12], dim=1))
+        return ssim_map
+
+    @staticmethod
+    def backward(ctx, grad_map):
+        img1, img2, window, d_stats = ctx.saved_tensors
+        # the gaussian window is symmetric, so the adjoint of the blur is the blur itself
+        g_mu1, g_mu2, g_e11, g_e22, g_e12 = _filter_stats(d_stats * grad_map.repeat(1, 5, 1, 1), window).chunk(5, dim=1)
+        grad1 = g_mu1 + 2 * img1 * g_e11 + img2 * g_e12
+        grad2 = g_mu2 + 2 * img2 * g_e22 + img1 * g_e12
+        return grad1, grad2, None
+
+def ssim(img1, img2, window_size=11, size_average=True, fused=False):
+    """
+    Same values as _ssim with the 2-D window, computed with a cached separable window.
+    fused=True uses an analytic backward instead of autograd through the convolutions.
+    """
+    unbatched = img1.dim() == 3
+    if unbatched:
+        img1, img2 = img1.unsqueeze(0), img2.unsqueeze(0)
+    channel = img1.size(-3)
+    window = create_window_1d(window_size, channel, img1.dtype, img1.device)
+
+    if fused:
+        ssim_map = _FusedSSIM.apply(img1, img2, window)
+    else:
+        _, _, A1, A2, B1, B2 = _ssim_terms(img1, img2, window)
+        ssim_map = A1 * A2 / (B1 * B2)
+
+    if size_average:
+        return ssim_map.mean()
+    elif unbatched:
+        return ssim_map[0].mean()
+    else:
+        return ssim_map.mean(1).mean(1).mean(1)
+
+def ssim_2d(img1, img2, window_size=11, size_average=True):
     channel = img1.size(-3)
     window = create_window(window_size, channel)
 
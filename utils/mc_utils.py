@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+from skimage.measure import marching_cubes
+
+
+def _block_origins(mask):
+    return np.stack(np.nonzero(mask), axis=-1)
+
+
+@torch.no_grad()
+def select_blocks(sdf_fn, min_bound, vox_size, num_blocks, block_size, points=None, coarse_margin=1.5, batch_size=1_000_000):
+    """
+    Mark the blocks that may contain the zero level set.
+
+    A block is active if the sdf at its centre is smaller than its half
+    diagonal times coarse_margin (the sdf is only roughly a distance), or if
+    one of the given points (e.g. the Gaussian centres) falls inside it.
+    """
+    device = min_bound.device
+    block_len = block_size * vox_size
+    ijk = torch.stack(torch.meshgrid(*[torch.arange(n, device=device) for n in num_blocks], indexing='ij'), dim=-1).reshape(-1, 3)
+    centers = min_bound + (ijk.float() + 0.5) * block_len
+    sdf = torch.cat([sdf_fn(centers[i:i + batch_size]).reshape(-1) for i in range(0, centers.shape[0], batch_size)])
+    radius = 0.5 * np.sqrt(3) * block_len * coarse_margin
+    mask = (sdf.abs() <= radius).reshape(*num_blocks)
+    n_coarse = int(mask.sum())
+
+    if points is not None:
+        idx = torch.floor((points.to(device) - min_bound) / block_len).long()
+        inside = ((idx >= 0) & (idx < torch.tensor(num_blocks, device=device))).all(dim=1)
+        idx = idx[inside]
+        mask[idx[:, 0], idx[:, 1], idx[:, 2]] = True
+    print(f"active blocks: {int(mask.sum())} / {mask.numel()} ({n_coarse} from the coarse pass)")
+    return mask.cpu().numpy()
+
+
+def _vertex_keys(verts, grid_dims):
+    """
+    Key each marching cubes vertex (in global voxel coordinates) by the grid
+    edge it lies on, so vertices produced by neighbouring blocks on their
+    shared faces get the same key.
+    """
+    rounded = np.round(verts)
+    on_grid = np.abs(verts - rounded) < 1e-5
+    base = np.where(on_grid, rounded, np.floor(verts)).astype(np.int64)
+    # axis of the edge, 3 for a vertex that sits exactly on a sample
+    axis = np.where(on_grid.all(axis=1), 3, np.argmin(on_grid, axis=1))
+    dims = np.asarray(grid_dims, dtype=np.int64)
+    return ((base[:, 0] * dims[1] + base[:, 1]) * dims[2] + base[:, 2]) * 4 + axis
+
+
+def merge_block_vertices(verts, faces, grid_dims):
+    """
+    Merge duplicated vertices of per-block marching cubes meshes (verts in
+    global voxel coordinates, all >= 0 and < grid_dims) and drop the faces
+    that collapse.
+    """
+    _, first, inverse = np.unique(_vertex_keys(verts, grid_dims), return_index=True, return_inverse=True)
+    verts = verts[first]
+    faces = inverse.reshape(-1)[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+    return verts, faces
+
+
+@torch.no_grad()
+def sparse_marching_cubes(sdf_fn, min_bound, max_bound, vox_size, block_size=32, points=None, coarse_margin=1.5,
+                          batch_size=2_000_000):
+    """
+    Marching cubes on the blocks of a virtual grid that straddle the surface.
+
+    The grid spacing is vox_size over [min_bound, max_bound]. It is split into
+    blocks of block_size^3 cells, active blocks are chosen by select_blocks,
+    and only their (block_size + 1)^3 samples are evaluated. Neighbouring
+    blocks share their border samples, and vertices are merged across block
+    borders by the grid edge they lie on. Returns world space vertices and
+    faces as numpy arrays.
+    """
+    device = min_bound.device
+    grid_dims = (((max_bound - min_bound) / vox_size).long() + 1).tolist()
+    num_blocks = [max(1, -(-(n - 1) // block_size)) for n in grid_dims]
+    mask = select_blocks(sdf_fn, min_bound, vox_size, num_blocks, block_size, points=points,
+                         coarse_margin=coarse_margin, batch_size=batch_size)
+    origins = _block_origins(mask) * block_size
+
+    S = block_size + 1
+    offsets = torch.stack(torch.meshgrid(*[torch.arange(S, device=device)] * 3, indexing='ij'), dim=-1).reshape(-1, 3)
+    blocks_per_batch = max(1, batch_size // S ** 3)
+
+    verts_list, faces_list = [], []
+    num_verts = 0
+    for i in tqdm(range(0, origins.shape[0], blocks_per_batch), desc="Sparse marching cubes"):
+        batch_origins = torch.from_numpy(origins[i:i + blocks_per_batch]).to(device)
+        samples = (batch_origins[:, None] + offsets[None]).reshape(-1, 3)
+        sdf = sdf_fn(min_bound + samples.float() * vox_size).reshape(-1, S, S, S).cpu().numpy()
+        for origin, block_sdf in zip(origins[i:i + blocks_per_batch], sdf):
+            if block_sdf.min() > 0 or block_sdf.max() < 0:
+                continue
+            verts, faces, _, _ = marching_cubes(block_sdf, level=0.0)
+            verts_list.append(verts + origin)
+            faces_list.append(faces + num_verts)
+            num_verts += verts.shape[0]
+
+    if num_verts == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64)
+
+    verts = np.concatenate(verts_list, axis=0)
+    faces = np.concatenate(faces_list, axis=0)
+    # stitch the blocks
+    # the last blocks may overhang the grid, key over the padded extent
+    padded_dims = [n * block_size + 1 for n in num_blocks]
+    verts, faces = merge_block_vertices(verts, faces, padded_dims)
+
+    verts = verts * vox_size + min_bound.cpu().numpy()
+    return verts.astype(np.float32), faces
@@ -0,0 +1,59 @@
+import numpy as np
+import trimesh
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def face_components(faces):
+    """
+    Label the faces of a triangle mesh by connected component, two faces
+    being connected when they share an edge (as in trimesh's split).
+
+    Faces and their edges form a bipartite graph, so a single
+    connected_components call labels everything. Returns (labels, count).
+    """
+    F = faces.shape[0]
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, edge_ids = np.unique(edges, axis=0, return_inverse=True)
+    edge_ids = edge_ids.reshape(-1)
+    face_ids = np.repeat(np.arange(F), 3)
+    n = F + int(edge_ids.max()) + 1 if F > 0 else 0
+    graph = coo_matrix((np.ones(face_ids.shape[0], dtype=np.int8), (face_ids, F + edge_ids)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    labels = labels[:F]
+    # relabel so only components that contain faces are counted
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels.reshape(-1), int(labels.max()) + 1 if F > 0 else 0
+
+
+def component_areas(vertices, faces, labels, count):
+    tris = vertices[faces]
+    face_area = 0.5 * np.linalg.norm(np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0]), axis=1)
+    return np.bincount(labels, weights=face_area, minlength=count)
+
+
+def filter_components(mesh, largest=True, min_area=None, min_area_ratio=None):
+    """
+    Keep the largest connected component of a trimesh (largest=True), or the
+    components whose area is above min_area or above min_area_ratio times the
+    total area, without building a Trimesh per component.
+    """
+    vertices = np.asarray(mesh.vertices)
+    faces = np.asarray(mesh.faces)
+    if faces.shape[0] == 0:
+        return mesh
+    labels, count = face_components(faces)
+    areas = component_areas(vertices, faces, labels, count)
+
+    if largest:
+        keep = np.zeros(count, dtype=bool)
+        keep[areas.argmax()] = True
+    else:
+        threshold = min_area if min_area is not None else min_area_ratio * areas.sum()
+        keep = areas > threshold
+    print(f"keeping {int(keep.sum())} / {count} connected components")
+
+    faces = faces[keep[labels]]
+    used, remap = np.unique(faces, return_inverse=True)
+    vertex_colors = mesh.visual.vertex_colors[used] if mesh.visual.kind == 'vertex' else None
+    return trimesh.Trimesh(vertices[used], remap.reshape(-1, 3), vertex_colors=vertex_colors, process=False)
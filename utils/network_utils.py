@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-import tinycudann as tcnn
 import torch.distributions.normal as normal
 
 class Dir_Encoding(torch.nn.Module):
@@ -35,6 +34,8 @@ def get_encoder(encoding, input_dim=3,
                 n_levels=16, level_dim=2, 
                 base_resolution=16, log2_hashmap_size=19, 
                 desired_resolution=512):
+    # tinycudann is CUDA only, import it when a network is actually built
+    import tinycudann as tcnn
     
     # Dense grid encoding
     if 'dense' in encoding.lower():
@@ -156,6 +157,7 @@ class Pos_Encoding(nn.Module):
 class SDF(nn.Module):
     def __init__(self, pts_dim, hidden_dim=32, feature_dim=32):
         super().__init__()
+        import tinycudann as tcnn
         # in_dim = pts_dim + feature_dim
         in_dim = feature_dim
         self.decoder = tcnn.Network(n_input_dims=in_dim,
@@ -297,6 +299,7 @@ class SimpleSDF(nn.Module):
 class SH(nn.Module):
     def __init__(self, in_dim, out_dim, hidden_dim=32):
         super().__init__()
+        import tinycudann as tcnn
 
         self.decoder = tcnn.Network(n_input_dims=in_dim,
                                           n_output_dims=out_dim,
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import torch
+
+face_dtype = np.dtype([('count', 'u1'), ('vertex_indices', '<i4', (3,))])
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+class StreamingPlyWriter:
+    """
+    Write a triangle mesh to a binary PLY file chunk by chunk.
+
+    Vertex and face chunks are spooled to two temporary files next to the
+    output; close() writes the header (the element counts are only known at the
+    end) and concatenates both spools, so only one chunk is ever in memory.
+    Face indices refer to the global vertex order of add_vertices calls.
+
+    Vertices can be dropped with a mask as they arrive; the writer keeps an
+    int64 map from input to output vertex index, and faces that touch a
+    dropped vertex (or are masked themselves) are skipped, the same as
+    trimesh's update_vertices/update_faces.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        out_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(out_dir, exist_ok=True)
+        self.vertex_file = tempfile.TemporaryFile(dir=out_dir)
+        self.face_file = tempfile.TemporaryFile(dir=out_dir)
+        self.num_vertices = 0
+        self.num_faces = 0
+        self.num_input_vertices = 0
+        # input -> output vertex index, only allocated once a mask is used
+        self.remap = None
+
+    def _grow_remap(self, n):
+        if self.remap.shape[0] < n:
+            remap = np.empty(max(n, 2 * self.remap.shape[0]), dtype=np.int64)
+            remap[:self.num_input_vertices] = self.remap[:self.num_input_vertices]
+            self.remap = remap
+
+    def add_vertices(self, vertices, mask=None):
+        vertices = _to_numpy(vertices).astype('<f4', copy=False).reshape(-1, 3)
+        n_input = vertices.shape[0]
+        if mask is not None and self.remap is None:
+            self.remap = np.arange(self.num_input_vertices, dtype=np.int64)
+        if self.remap is not None:
+            mask = np.ones(n_input, dtype=bool) if mask is None else _to_numpy(mask).reshape(-1).astype(bool)
+            self._grow_remap(self.num_input_vertices + n_input)
+            chunk_remap = np.full(n_input, -1, dtype=np.int64)
+            chunk_remap[mask] = self.num_vertices + np.arange(int(mask.sum()))
+            self.remap[self.num_input_vertices:self.num_input_vertices + n_input] = chunk_remap
+            vertices = vertices[mask]
+        self.num_input_vertices += n_input
+        self.vertex_file.write(np.ascontiguousarray(vertices).tobytes())
+        self.num_vertices += vertices.shape[0]
+
+    def add_faces(self, faces, mask=None):
+        faces = _to_numpy(faces).reshape(-1, 3)
+        if mask is not None:
+            faces = faces[_to_numpy(mask).reshape(-1).astype(bool)]
+        if self.remap is not None:
+            faces = self.remap[faces]
+            faces = faces[(faces >= 0).all(axis=1)]
+        records = np.empty(faces.shape[0], dtype=face_dtype)
+        records['count'] = 3
+        records['vertex_indices'] = faces
+        self.face_file.write(records.tobytes())
+        self.num_faces += faces.shape[0]
+
+    def close(self):
+        header = ("ply\n"
+                  "format binary_little_endian 1.0\n"
+                  f"element vertex {self.num_vertices}\n"
+                  "property float x\n"
+                  "property float y\n"
+                  "property float z\n"
+                  f"element face {self.num_faces}\n"
+                  "property list uchar int vertex_indices\n"
+                  "end_header\n")
+        with open(self.path, 'wb') as f:
+            f.write(header.encode('ascii'))
+            for spool in (self.vertex_file, self.face_file):
+                spool.seek(0)
+                shutil.copyfileobj(spool, f)
+                spool.close()
+        print(f"wrote {self.num_vertices} vertices and {self.num_faces} faces to {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.vertex_file.close()
+            self.face_file.close()
+
+
+def write_mesh(path, vertices, faces, vertex_mask=None, face_mask=None, chunk_size=1 << 22):
+    """
+    Write a mesh given as tensors or arrays through StreamingPlyWriter, moving
+    at most chunk_size vertices or faces to the host at a time.
+    """
+    with StreamingPlyWriter(path) as writer:
+        for i in range(0, vertices.shape[0], chunk_size):
+            writer.add_vertices(vertices[i:i + chunk_size], None if vertex_mask is None else vertex_mask[i:i + chunk_size])
+        for i in range(0, faces.shape[0], chunk_size):
+            writer.add_faces(faces[i:i + chunk_size], None if face_mask is None else face_mask[i:i + chunk_size])
+
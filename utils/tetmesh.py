@@ -18,7 +18,7 @@
 
 import torch
 
-__all__ = ['marching_tetrahedra']
+__all__ = ['marching_tetrahedra', 'marching_tetrahedra_streaming']
 
 triangle_table = torch.tensor([
     [-1, -1, -1, -1, -1, -1],
@@ -44,86 +44,49 @@ base_tet_edges = torch.tensor([0, 1, 0, 2, 0, 3, 1, 2, 1, 3, 2, 3], dtype=torch.
 v_id = torch.pow(2, torch.arange(4, dtype=torch.long))
 
 
-def _unbatched_marching_tetrahedra(vertices, tets, sdf, scales):
-    """unbatched marching tetrahedra.
+def _edge_keys(edges, num_vertices):
+    """encode undirected edges as a single int64 key min * N + max."""
+    lo = torch.minimum(edges[:, 0], edges[:, 1])
+    hi = torch.maximum(edges[:, 0], edges[:, 1])
+    return lo * num_vertices + hi
 
-    Refer to :func:`marching_tetrahedra`.
+
+def _decode_edge_keys(keys, num_vertices):
+    return torch.stack([keys // num_vertices, keys % num_vertices], dim=-1)
+
+
+def _crossing_edges(tets, occ_n, num_vertices):
+    """find the unique edges of tets crossing the level set.
+
+    Returns the sorted unique edge keys, the per-tet [T, 6] map from local edge
+    to position in the unique keys (-1 for edges without a vertex) and the
+    occupancy of the valid tets.
     """
-    device = vertices.device
+    device = tets.device
+    occ_fx4 = occ_n[tets.reshape(-1)].reshape(-1, 4)
+    occ_sum = torch.sum(occ_fx4, -1)
     
-    # call by chunk
-    chunk_size = 32 * 1024 * 1024
-    if tets.shape[0] > chunk_size:
-        merged_verts = None
-        merged_scales = None
-        merged_faces = None
-        merged_verts_ids = None
-        for tet_chunk in torch.chunk(tets, tets.shape[0] // chunk_size + 1):
-            torch.cuda.empty_cache()
-            verts, verts_scales, faces, verts_ids = _unbatched_marching_tetrahedra(vertices, tet_chunk, sdf, scales)
-            
-            if merged_verts is None:
-                merged_verts = verts
-                merged_scales = verts_scales
-                merged_faces = faces
-                merged_verts_ids = verts_ids
-            else:
-                all_edges = torch.cat([merged_verts_ids, verts_ids], dim=0)
-                unique_edges, idx_map = torch.unique(all_edges, dim=0, return_inverse=True)
-                # merge vertices
-                unique_verts_0 = torch.zeros((unique_edges.shape[0], 2, 3), dtype=torch.float, device=device)
-                unique_verts_1 = torch.zeros((unique_edges.shape[0], 2, 1), dtype=torch.float, device=device)
-                unique_verts_0[idx_map[:merged_verts[0].shape[0]]] = merged_verts[0]  
-                unique_verts_0[idx_map[merged_verts[0].shape[0]:]] = verts[0]         
-                unique_verts_1[idx_map[:merged_verts[1].shape[0]]] = merged_verts[1]  
-                unique_verts_1[idx_map[merged_verts[1].shape[0]:]] = verts[1]         
-                # merge scales
-                unique_scales = torch.zeros((unique_edges.shape[0], 2, 1), dtype=torch.float, device=device)
-                unique_scales[idx_map[:merged_verts[0].shape[0]]] = merged_scales     
-                unique_scales[idx_map[merged_verts[0].shape[0]:]] = verts_scales      
-                
-                # merge faces
-                unique_faces_0 = idx_map[merged_faces.reshape(-1)].reshape(-1, 3)
-                unique_faces_1 = idx_map[faces.reshape(-1) + merged_verts[0].shape[0]].reshape(-1, 3)
-
-                merged_faces = torch.cat([unique_faces_0, unique_faces_1], dim=0)
-                merged_verts = (unique_verts_0, unique_verts_1)
-                merged_scales = unique_scales
-                merged_verts_ids = unique_edges
-                torch.cuda.empty_cache()
-                
-        return merged_verts, merged_scales, merged_faces, merged_verts_ids
-        
-    with torch.no_grad():
-        occ_n = sdf > 0
-        occ_fx4 = occ_n[tets.reshape(-1)].reshape(-1, 4)
-        occ_sum = torch.sum(occ_fx4, -1)
-        
-        valid_tets = (occ_sum > 0) & (occ_sum < 4)
-        
-        # find all vertices
-        all_edges = tets[valid_tets][:, base_tet_edges.to(device)].reshape(-1, 2)
-        
-        order = (all_edges[:, 0] > all_edges[:, 1]).bool()
-        all_edges[order] = all_edges[order][:, [1, 0]]
-        
-        unique_edges, idx_map = torch.unique(all_edges, dim=0, return_inverse=True)
-        
-        unique_edges = unique_edges.long()
-        mask_edges = occ_n[unique_edges.reshape(-1)].reshape(-1, 2).sum(-1) == 1
-        mapping = torch.ones((unique_edges.shape[0]), dtype=torch.long, device=device) * -1
-        mapping[mask_edges] = torch.arange(mask_edges.sum(), dtype=torch.long, device=device)
-        idx_map = mapping[idx_map]
-
-        interp_v = unique_edges[mask_edges]
-    edges_to_interp = vertices[interp_v.reshape(-1)].reshape(-1, 2, 3)
-    edges_to_interp_sdf = sdf[interp_v.reshape(-1)].reshape(-1, 2, 1)
-    verts_scales = scales[interp_v.reshape(-1)].reshape(-1, 2, 1)
+    valid_tets = (occ_sum > 0) & (occ_sum < 4)
     
-    verts = (edges_to_interp, edges_to_interp_sdf)
-    idx_map = idx_map.reshape(-1, 6)
+    # find all vertices
+    all_edges = tets[valid_tets][:, base_tet_edges.to(device)].reshape(-1, 2).long()
+    
+    # only edges crossing the level set carry a vertex, so deduplicate just those
+    occ_edges = occ_n[all_edges]
+    mask_edges = occ_edges[:, 0] != occ_edges[:, 1]
+    
+    # 1-D sort/unique on int64 keys instead of a lexicographic unique over rows,
+    # keys sort like (min, max) pairs so the vertex order is unchanged
+    unique_keys, inverse = torch.unique(_edge_keys(all_edges[mask_edges], num_vertices), return_inverse=True)
+    idx_map = torch.full((all_edges.shape[0],), -1, dtype=torch.long, device=device)
+    idx_map[mask_edges] = inverse
+
+    return unique_keys, idx_map.reshape(-1, 6), occ_fx4[valid_tets]
+
 
-    tetindex = (occ_fx4[valid_tets] * v_id.to(device).unsqueeze(0)).sum(-1)
+def _faces_from_idx_map(idx_map, occ_fx4):
+    device = idx_map.device
+    tetindex = (occ_fx4 * v_id.to(device).unsqueeze(0)).sum(-1)
     num_triangles = num_triangles_table.to(device)[tetindex]
     triangle_table_device = triangle_table.to(device)
 
@@ -134,6 +97,126 @@ def _unbatched_marching_tetrahedra(vertices, tets, sdf, scales):
         torch.gather(input=idx_map[num_triangles == 2], dim=1,
                      index=triangle_table_device[tetindex[num_triangles == 2]][:, :6]).reshape(-1, 3),
     ), dim=0)
+    return faces
+
+
+@torch.no_grad()
+def marching_tetrahedra_streaming(vertices, tets, sdf, scales, chunk_size=32 * 1024 * 1024, writer=None, vertex_fn=None):
+    """chunked marching tetrahedra with an incremental global vertex table.
+
+    The tets are processed chunk by chunk. A sorted table of the edge keys that
+    already produced a vertex is kept across chunks, so each chunk only appends
+    its new vertices and its faces (with global vertex ids); nothing is merged
+    or re-deduplicated afterwards.
+
+    If ``writer`` is given (see :class:`utils.ply_utils.StreamingPlyWriter`),
+    the vertex positions and faces of every chunk are handed to it right away
+    and nothing is kept in memory. The positions are ``vertex_fn(edges_to_interp,
+    edges_to_interp_sdf, verts_scales)``, by default the edge midpoints.
+    Otherwise the same outputs as :func:`_unbatched_marching_tetrahedra` are
+    returned.
+    """
+    device = vertices.device
+    num_vertices = vertices.shape[0]
+    occ_n = (sdf > 0).reshape(-1)
+
+    table_keys = torch.empty(0, dtype=torch.long, device=device)
+    table_ids = torch.empty(0, dtype=torch.long, device=device)
+    num_verts = 0
+    out_verts, out_verts_sdf, out_scales, out_faces, out_edges = [], [], [], [], []
+
+    for tet_chunk in torch.split(tets, chunk_size):
+        unique_keys, idx_map, occ_fx4 = _crossing_edges(tet_chunk, occ_n, num_vertices)
+        if unique_keys.shape[0] == 0:
+            continue
+
+        # look up the edges that were already emitted by previous chunks
+        if table_keys.shape[0] > 0:
+            pos = torch.searchsorted(table_keys, unique_keys).clamp(max=table_keys.shape[0] - 1)
+            found = table_keys[pos] == unique_keys
+        else:
+            pos = torch.zeros_like(unique_keys)
+            found = torch.zeros_like(unique_keys, dtype=torch.bool)
+
+        new_keys = unique_keys[~found]
+        global_ids = torch.empty_like(unique_keys)
+        global_ids[found] = table_ids[pos[found]]
+        global_ids[~found] = torch.arange(num_verts, num_verts + new_keys.shape[0], dtype=torch.long, device=device)
+        num_verts += new_keys.shape[0]
+
+        # new_keys is sorted, so it is merged into the table at its insertion
+        # points instead of re-sorting the whole table
+        slots = torch.searchsorted(table_keys, new_keys) + torch.arange(new_keys.shape[0], device=device)
+        is_new = torch.zeros(table_keys.shape[0] + new_keys.shape[0], dtype=torch.bool, device=device)
+        is_new[slots] = True
+        merged_keys = torch.empty(is_new.shape[0], dtype=torch.long, device=device)
+        merged_ids = torch.empty(is_new.shape[0], dtype=torch.long, device=device)
+        merged_keys[slots] = new_keys
+        merged_ids[slots] = global_ids[~found]
+        merged_keys[~is_new] = table_keys
+        merged_ids[~is_new] = table_ids
+        table_keys, table_ids = merged_keys, merged_ids
+
+        valid = idx_map >= 0
+        idx_map[valid] = global_ids[idx_map[valid]]
+        faces = _faces_from_idx_map(idx_map, occ_fx4)
+
+        interp_v = _decode_edge_keys(new_keys, num_vertices)
+        edges_to_interp = vertices[interp_v.reshape(-1)].reshape(-1, 2, 3)
+        edges_to_interp_sdf = sdf[interp_v.reshape(-1)].reshape(-1, 2, 1)
+        verts_scales = scales[interp_v.reshape(-1)].reshape(-1, 2, 1)
+
+        if writer is not None:
+            if vertex_fn is None:
+                positions = edges_to_interp.mean(dim=1)
+            else:
+                positions = vertex_fn(edges_to_interp, edges_to_interp_sdf, verts_scales)
+            writer.add_vertices(positions)
+            writer.add_faces(faces)
+        else:
+            out_verts.append(edges_to_interp)
+            out_verts_sdf.append(edges_to_interp_sdf)
+            out_scales.append(verts_scales)
+            out_faces.append(faces)
+            out_edges.append(interp_v)
+
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    if writer is not None:
+        return num_verts
+
+    if len(out_faces) == 0:
+        return ((torch.zeros((0, 2, 3), device=device), torch.zeros((0, 2, 1), device=device)),
+                torch.zeros((0, 2, 1), device=device),
+                torch.zeros((0, 3), dtype=torch.long, device=device),
+                torch.zeros((0, 2), dtype=torch.long, device=device))
+
+    verts = (torch.cat(out_verts, dim=0), torch.cat(out_verts_sdf, dim=0))
+    return verts, torch.cat(out_scales, dim=0), torch.cat(out_faces, dim=0), torch.cat(out_edges, dim=0)
+
+
+def _unbatched_marching_tetrahedra(vertices, tets, sdf, scales):
+    """unbatched marching tetrahedra.
+
+    Refer to :func:`marching_tetrahedra`.
+    """
+    # call by chunk
+    chunk_size = 32 * 1024 * 1024
+    if tets.shape[0] > chunk_size:
+        return marching_tetrahedra_streaming(vertices, tets, sdf, scales, chunk_size=chunk_size)
+        
+    with torch.no_grad():
+        num_vertices = vertices.shape[0]
+        occ_n = (sdf > 0).reshape(-1)
+        unique_keys, idx_map, occ_fx4 = _crossing_edges(tets, occ_n, num_vertices)
+        interp_v = _decode_edge_keys(unique_keys, num_vertices)
+    edges_to_interp = vertices[interp_v.reshape(-1)].reshape(-1, 2, 3)
+    edges_to_interp_sdf = sdf[interp_v.reshape(-1)].reshape(-1, 2, 1)
+    verts_scales = scales[interp_v.reshape(-1)].reshape(-1, 2, 1)
+    
+    verts = (edges_to_interp, edges_to_interp_sdf)
+    faces = _faces_from_idx_map(idx_map, occ_fx4)
 
     return verts, verts_scales, faces, interp_v
 
@@ -0,0 +1,421 @@
+import os
+import json
+import time
+import hashlib
+import resource
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process and its finished children in MB.
+    """
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024, child_kb / 1024
+
+
+@torch.no_grad()
+def deduplicate_points(points, eps):
+    """
+    Merge points that fall into the same eps-sized cell, keeping the first one.
+
+    Returns the kept indices (in their original order) and, for every input
+    point, the index of the kept point that replaced it.
+    """
+    N = points.shape[0]
+    device = points.device
+    key = torch.floor((points - points.min(dim=0).values) / eps).long()
+
+    # unique rows rather than a linearized key, which would overflow int64
+    # for large extent / eps ratios and silently merge unrelated points
+    _, inverse = torch.unique(key, dim=0, return_inverse=True)
+    first = torch.full((int(inverse.max()) + 1,), N, dtype=torch.long, device=device)
+    first.scatter_reduce_(0, inverse, torch.arange(N, device=device), reduce="amin")
+
+    order = torch.argsort(first)
+    keep = first[order]
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(order.shape[0], device=device)
+    return keep, rank[inverse]
+
+
+def _triangulate_points(points):
+    from tetranerf.utils.extension import cpp
+    return cpp.triangulate(torch.from_numpy(points)).numpy().astype(np.int64)
+
+
+def _block_edges(bmin, bmax, tiles):
+    return [np.linspace(bmin[i], bmax[i], tiles[i] + 1) for i in range(3)]
+
+
+def _circumspheres(tets):
+    """
+    Circumcenters and radii of [T, 4, 3] tetrahedra, inf for degenerate ones.
+    """
+    a = tets[:, 0]
+    u, v, w = tets[:, 1] - a, tets[:, 2] - a, tets[:, 3] - a
+    vw, wu, uv = np.cross(v, w), np.cross(w, u), np.cross(u, v)
+    det = 2 * np.einsum("ij,ij->i", u, vw)
+    num = (u * u).sum(-1, keepdims=True) * vw + (v * v).sum(-1, keepdims=True) * wu + (w * w).sum(-1, keepdims=True) * uv
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = num / det[:, None]
+    radius = np.linalg.norm(offset, axis=-1)
+    radius[~np.isfinite(radius)] = np.inf
+    return a + offset, radius
+
+
+def _tet_volumes(points, cells):
+    tets = points[cells].astype(np.float64)
+    u, v, w = tets[:, 1] - tets[:, 0], tets[:, 2] - tets[:, 0], tets[:, 3] - tets[:, 0]
+    return np.abs(np.einsum("ij,ij->i", u, np.cross(v, w))) / 6
+
+
+def _unique_rows(rows):
+    """
+    Unique rows of an integer array (sorted) with the index of their first
+    occurrence, the inverse and the counts. Same as np.unique(axis=0) but
+    with a lexsort, which is much faster than its sort over row views.
+    """
+    order = np.lexsort(rows.T[::-1])
+    rows = rows[order]
+    start = np.ones(rows.shape[0], dtype=bool)
+    start[1:] = np.any(rows[1:] != rows[:-1], axis=1)
+    inverse = np.empty(rows.shape[0], dtype=np.int64)
+    inverse[order] = np.cumsum(start) - 1
+    start = np.nonzero(start)[0]
+    return rows[start], order[start], inverse, np.diff(np.append(start, rows.shape[0]))
+
+
+def _cell_faces(cells):
+    # face j of a cell is the one opposite its vertex j
+    faces = np.sort(cells[:, [[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]]].reshape(-1, 3), axis=1)
+    return faces, cells.reshape(-1)
+
+
+def _open_faces(faces, opposite):
+    """
+    Faces that occur once, with the vertex opposite to them in their cell.
+    """
+    if faces.shape[0] == 0:
+        return faces, opposite
+    faces, first, _, counts = _unique_rows(faces)
+    return faces[counts == 1], opposite[first[counts == 1]]
+
+
+def _sphere_within(lo, hi, box_lo, box_hi, bmin, bmax):
+    # box sides on the bounding box of all points have nothing beyond them
+    return np.all(((lo >= box_lo) | (box_lo <= bmin)) & ((hi <= box_hi) | (box_hi >= bmax)), axis=1)
+
+
+def _cap_bounds(center, radius, planes):
+    """
+    Bounding boxes of the part of each sphere inside the convex hull given by
+    its facet planes. Large circumspheres along the hull mostly lie outside of
+    it, the facet plane farthest from the center cuts them down to a cap.
+    """
+    lo, hi = center - radius[:, None], center + radius[:, None]
+    facet = np.concatenate([(c @ planes[:, :3].T + planes[:, 3]).argmax(axis=1)
+                            for c in np.array_split(center, max(1, center.shape[0] * planes.shape[0] // (1 << 24)))])
+    d = (center * planes[facet, :3]).sum(-1) + planes[facet, 3]
+    cut = (d > 0) & (d < radius)
+    c, r, d, n = center[cut], radius[cut, None], d[cut, None], planes[facet[cut], :3]
+    # the cap reaches the sphere's own extreme along an axis if that lies inside
+    # the facet plane, else its extreme is on the circle cut by the plane
+    rim_center = c - d * n
+    rim = np.sqrt(np.maximum(r ** 2 - d ** 2, 0) * np.maximum(1 - n ** 2, 0))
+    lo[cut] = np.where(d - r * n <= 0, c - r, rim_center - rim)
+    hi[cut] = np.where(d + r * n <= 0, c + r, rim_center + rim)
+    return lo, hi
+
+
+def _triangulate_block(points, idx, shell, region, edges, block):
+    """
+    Triangulate the points of one padded block and sort its cells.
+
+    idx are the global (ascending) indices of points and shell the points in a
+    band around the padded region. A cell is certified if its circumsphere
+    stays inside region + band and contains no band point, it is then a cell
+    of the global Delaunay tetrahedralization. Certified cells whose
+    circumsphere lies in a single block core are kept by that block only
+    (interior), the others are returned for deduplication (crossing). Only
+    the faces the interior cells leave open are returned with them, so the
+    caller stitches block borders without touching the interior cells.
+    """
+    from scipy.spatial import ConvexHull, cKDTree
+
+    bmin = np.array([e[0] for e in edges])
+    bmax = np.array([e[-1] for e in edges])
+    local = np.sort(_triangulate_points(points), axis=1)
+    center, radius = _circumspheres(points[local].astype(np.float64))
+    lo, hi = center - radius[:, None], center + radius[:, None]
+    (region_lo, region_hi), (safe_lo, safe_hi) = region
+
+    certified = np.isfinite(radius) & _sphere_within(lo, hi, safe_lo, safe_hi, bmin, bmax)
+    in_band = certified & ~_sphere_within(lo, hi, region_lo, region_hi, bmin, bmax)
+    if in_band.any() and shell.shape[0] > 0:
+        dist, _ = cKDTree(shell).query(center[in_band])
+        certified[in_band] = dist >= radius[in_band] * (1 - 1e-9)
+
+    # the core holding the circumcenter owns cells whose circumsphere it contains
+    owner = np.stack([np.clip(np.searchsorted(edges[i], center[:, i], side="right") - 1, 0, len(edges[i]) - 2)
+                      for i in range(3)], axis=1)
+    owner_lo = np.stack([edges[i][owner[:, i]] for i in range(3)], axis=1)
+    owner_hi = np.stack([edges[i][owner[:, i] + 1] for i in range(3)], axis=1)
+    owned = certified & _sphere_within(lo, hi, owner_lo, owner_hi, bmin, bmax)
+    interior = owned & np.all(owner == np.array(block), axis=1)
+
+    cells = idx[local]
+    interior_cells = cells[interior]
+    crossing_cells = cells[certified & ~owned]
+    faces, opposite = _open_faces(*_cell_faces(interior_cells))
+    hull = idx[ConvexHull(points).vertices]
+    return interior_cells, crossing_cells, faces, opposite, hull, int((~certified).sum())
+
+
+def _close_faces(executor, points, open_faces, open_opposite, hull_planes, bmin, bmax, size, extra_voxels=None):
+    """
+    Fill open faces with certified cells, triangulating the points in voxels of
+    the given size around them (and in extra_voxels). Points in the next ring
+    of voxels are only used to certify the cells. Cells are added face by face
+    as long as they reach an open face. Returns them, the faces still left
+    open and the voxels a next round needs to certify the cells that would
+    fill those faces.
+    """
+    from scipy.spatial import cKDTree
+
+    dims = np.floor((bmax - bmin) / size).astype(np.int64) + 1
+    voxel = lambda x: np.clip(np.floor((x - bmin) / size).astype(np.int64), 0, dims - 1)
+    linear = lambda v: (v[:, 0] * dims[1] + v[:, 1]) * dims[2] + v[:, 2]
+    offsets = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+
+    def dilate(v):
+        v = (v[:, None] + offsets[None]).reshape(-1, 3)
+        return _unique_rows(v[np.all((v >= 0) & (v < dims), axis=1)])[0]
+
+    def box_voxels(vlo, vhi, limit=1 << 16):
+        # all voxels of the given ranges, boxes with more than limit voxels are skipped
+        boxes = [np.stack(np.meshgrid(*[np.arange(a, b + 1) for a, b in zip(l, h)], indexing="ij"), axis=-1).reshape(-1, 3)
+                 for l, h in zip(vlo, vhi) if np.prod(h - l + 1) <= limit]
+        return np.concatenate(boxes, axis=0) if boxes else np.zeros((0, 3), dtype=np.int64)
+
+    seeds = voxel(points[np.unique(open_faces)])
+    if extra_voxels is not None:
+        seeds = np.concatenate([seeds, extra_voxels], axis=0)
+    region_voxels = dilate(seeds)
+    region_keys = np.sort(linear(region_voxels))
+    covered_keys = np.sort(linear(dilate(region_voxels)))
+    shell_keys = np.setdiff1d(covered_keys, region_keys)
+    in_region = np.zeros(points.shape[0], dtype=bool)
+    in_shell = np.zeros(points.shape[0], dtype=bool)
+    for start in range(0, points.shape[0], 1 << 22):
+        keys = linear(voxel(points[start:start + (1 << 22)]))
+        in_region[start:start + (1 << 22)] = np.isin(keys, region_keys)
+        in_shell[start:start + (1 << 22)] = np.isin(keys, shell_keys)
+    everything = bool(in_region.all())
+    idx = np.nonzero(in_region)[0]
+    if idx.shape[0] < 4:
+        return np.zeros((0, 4), dtype=np.int64), open_faces, open_opposite, None, everything
+    cells = idx[np.sort(executor.submit(_triangulate_points, points[idx]).result(), axis=1)]
+
+    certified = np.ones(cells.shape[0], dtype=bool)
+    if not everything:
+        # the part of the circumsphere inside the hull has to be covered by region + shell
+        center, radius = _circumspheres(points[cells].astype(np.float64))
+        certified = np.isfinite(radius)
+        lo, hi = center - radius[:, None], center + radius[:, None]
+        large = certified & (radius > size)
+        lo[large], hi[large] = _cap_bounds(center[large], radius[large], hull_planes)
+        vlo, vhi = voxel(np.maximum(lo, bmin)), voxel(np.minimum(hi, bmax))
+        near = voxel(center)
+        certified &= np.isin(linear(near), region_keys) & np.all((vlo >= near - 1) & (vhi <= near + 1), axis=1)
+        # caps along the hull can be wide but thin, check their voxels one by one
+        for i in np.nonzero(large & ~certified)[0]:
+            keys = linear(box_voxels(vlo[i:i + 1], vhi[i:i + 1]))
+            certified[i] = keys.shape[0] > 0 and np.isin(keys, covered_keys).all()
+        if certified.any() and in_shell.any():
+            dist, _ = cKDTree(points[in_shell]).query(center[certified])
+            certified[certified] = dist >= radius[certified] * (1 - 1e-9)
+
+    faces, opposite = _cell_faces(cells)
+    table, _, inverse, _ = _unique_rows(np.concatenate([open_faces, faces], axis=0))
+    is_open = np.zeros(table.shape[0], dtype=bool)
+    is_open[inverse[:open_faces.shape[0]]] = True
+    current = np.full(table.shape[0], -2, dtype=np.int64)
+    current[inverse[:open_faces.shape[0]]] = open_opposite
+    face_ids = inverse[open_faces.shape[0]:].reshape(-1, 4)
+    opposite = opposite.reshape(-1, 4)
+    added = np.zeros(cells.shape[0], dtype=bool)
+    while True:
+        # a cell fills an open face from the side its current cell is not on
+        fills = ~added & (is_open[face_ids] & (current[face_ids] != opposite)).any(axis=1)
+        if not (fills & certified).any():
+            break
+        fills &= certified
+        added |= fills
+        ids, counts = np.unique(face_ids[fills], return_counts=True)
+        toggled = ids[counts == 1]
+        opened = toggled[~is_open[toggled]]
+        is_open[toggled] = ~is_open[toggled]
+        new_ids = face_ids[fills].reshape(-1)
+        first = np.full(table.shape[0], -1, dtype=np.int64)
+        first[new_ids[::-1]] = np.arange(new_ids.shape[0])[::-1]
+        current[opened] = opposite[fills].reshape(-1)[first[opened]]
+
+    # cells that would fill a face but reach out of region + shell
+    pending = fills & ~certified
+    extra = None
+    if pending.any():
+        center, radius = _circumspheres(points[cells[pending]].astype(np.float64))
+        lo, hi = _cap_bounds(center, radius, hull_planes)
+        extra = box_voxels(voxel(np.maximum(lo, bmin)), voxel(np.minimum(hi, bmax)))
+    return cells[added], table[is_open], current[is_open], extra, everything
+
+
+def triangulate_tiled(points, tiles=(2, 2, 2), margin=0.1, num_workers=None, verify=False):
+    """
+    Delaunay tetrahedralization of points in independent spatial blocks.
+
+    The bounding box is split into tiles[0] x tiles[1] x tiles[2] blocks. Each
+    block is triangulated together with the points inside an overlap margin
+    (a fraction of the block size) in a worker process, which also certifies
+    its cells against the points in a band of the same width around it, so
+    every kept cell is a cell of the global Delaunay tetrahedralization. The
+    faces left open along block borders are then closed by re-triangulating
+    the points around them, growing that region until no face is open. With
+    verify the cells are also checked to fill the convex hull.
+    """
+    from scipy.spatial import ConvexHull
+
+    points_np = np.ascontiguousarray(points.detach().cpu().float().numpy())
+    tiles = np.array(tiles)
+    bmin = points_np.min(axis=0)
+    bmax = points_np.max(axis=0)
+    edges = _block_edges(bmin, bmax, tiles)
+
+    interior, crossing, faces, opposite, hull = [], [], [], [], []
+    rejected = 0
+    with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        futures = []
+        for block in np.ndindex(*tiles):
+            lo = np.array([edges[i][block[i]] for i in range(3)])
+            hi = np.array([edges[i][block[i] + 1] for i in range(3)])
+            pad = (hi - lo) * margin
+            region = (lo - pad, hi + pad), (lo - 2 * pad, hi + 2 * pad)
+            inside = np.all((points_np >= region[0][0]) & (points_np <= region[0][1]), axis=1)
+            if inside.sum() < 4:
+                continue
+            band = np.all((points_np >= region[1][0]) & (points_np <= region[1][1]), axis=1) & ~inside
+            idx = np.nonzero(inside)[0]
+            futures.append(executor.submit(_triangulate_block, points_np[idx], idx, points_np[band], region, edges, block))
+        for future in futures:
+            block_interior, block_crossing, block_faces, block_opposite, block_hull, block_rejected = future.result()
+            interior.append(block_interior)
+            crossing.append(block_crossing)
+            faces.append(block_faces)
+            opposite.append(block_opposite)
+            hull.append(block_hull)
+            rejected += block_rejected
+        n_blocks = len(futures)
+
+        # a crossing cell is found by every block whose region contains its circumsphere
+        cells = _unique_rows(np.concatenate(crossing, axis=0))[0]
+        hull = np.unique(np.concatenate(hull))
+        hull_facets = ConvexHull(points_np[hull])
+        hull_faces = np.sort(hull[hull_facets.simplices], axis=1)
+        crossing_faces, crossing_opposite = _cell_faces(cells)
+        open_faces, open_opposite = _open_faces(np.concatenate(faces + [crossing_faces, hull_faces], axis=0),
+                                                np.concatenate(opposite + [crossing_opposite, np.full(hull_faces.shape[0], -1)]))
+        cells = [cells]
+
+        rounds = 0
+        size = None
+        extra = None
+        while open_faces.shape[0] > 0:
+            rounds += 1
+            if size is None:
+                # typical border face size
+                face_pts = points_np[open_faces]
+                size = np.median(np.linalg.norm(face_pts - face_pts[:, [1, 2, 0]], axis=-1).max(axis=1))
+            elif extra is None:
+                # nothing left to fill in reach, grow the region
+                size *= 2
+            print(f"tiled triangulation: closing {open_faces.shape[0]} open border faces (voxel size {size:.4g})")
+            new_cells, open_faces, open_opposite, extra, everything = _close_faces(
+                executor, points_np, open_faces, open_opposite, hull_facets.equations, bmin, bmax, size, extra)
+            cells.append(new_cells)
+            if everything and open_faces.shape[0] > 0:
+                raise RuntimeError(f"tiled triangulation could not close {open_faces.shape[0]} border faces")
+
+    cells = np.concatenate(interior + cells, axis=0)
+    print(f"tiled triangulation: {cells.shape[0]} cells from {n_blocks} blocks, {rejected} border cells rejected, "
+          f"{rounds} rounds to close the borders")
+    if verify:
+        tet_volume = _tet_volumes(points_np, cells).sum()
+        hull_volume = ConvexHull(points_np).volume
+        if not np.isclose(tet_volume, hull_volume, rtol=1e-5):
+            raise RuntimeError(f"tiled triangulation does not fill the convex hull (cells {tet_volume:.6g}, hull {hull_volume:.6g})")
+    return torch.from_numpy(cells.astype(np.int32))
+
+
+def triangulate(points, tiles=None, margin=0.1, num_workers=None, verify=False):
+    """
+    Triangulate points with CGAL, either monolithically or in tiles, and log
+    wall time and peak memory so both paths can be compared. With verify the
+    tiled result is also checked against the convex hull and compared against
+    the monolithic one.
+    """
+    start = time.time()
+    if tiles is None or np.prod(tiles) == 1:
+        from tetranerf.utils.extension import cpp
+        cells = cpp.triangulate(points)
+    else:
+        cells = triangulate_tiled(points, tiles, margin=margin, num_workers=num_workers, verify=verify)
+    peak_self, peak_children = peak_memory_mb()
+    print(f"triangulated {points.shape[0]} points into {cells.shape[0]} cells in {time.time() - start:.1f}s "
+          f"(peak memory {peak_self:.0f}MB, workers {peak_children:.0f}MB)")
+
+    if verify and tiles is not None and np.prod(tiles) > 1:
+        from tetranerf.utils.extension import cpp
+        reference = cpp.triangulate(points).numpy()
+        tiled = np.sort(cells.numpy().astype(np.int64), axis=1)
+        reference = np.sort(reference.astype(np.int64), axis=1)
+        common = np.intersect1d(tiled.view([("", np.int64)] * 4), reference.view([("", np.int64)] * 4)).shape[0]
+        print(f"tiled {tiled.shape[0]} cells, monolithic {reference.shape[0]} cells, {common} in common")
+    return cells
+
+
+def points_hash(points, **params):
+    """
+    Hash of the exact point coordinates and the triangulation parameters.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(points.detach().cpu().float().numpy()).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def cached_triangulate(points, cache_dir, tiles=None, margin=0.1, num_workers=None, verify=False):
+    """
+    triangulate() with a content addressed cache of the cells.
+
+    Cells are stored as int32 .npy files named by points_hash, so the cache is
+    only hit for the very same points and parameters (stale cells from an
+    older model are never reused), and read back memory mapped.
+    """
+    params = {"tiles": list(tiles) if tiles is not None and np.prod(tiles) > 1 else None, "margin": margin}
+    path = os.path.join(cache_dir, f"cells_{points_hash(points, **params)}.npy")
+    if os.path.exists(path):
+        print(f"load cached cells from {path}")
+        # copy-on-write mapping, pages are only read when the cells are used
+        return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+    cells = triangulate(points, tiles=tiles, margin=margin, num_workers=num_workers, verify=verify)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, cells.cpu().numpy().astype(np.int32))
+    os.replace(tmp_path, path)
+    return cells
+
@@ -0,0 +1,222 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+from skimage.measure import marching_cubes
+from utils.mc_utils import merge_block_vertices
+
+_BITS = 21
+_OFFSET = 1 << (_BITS - 1)
+
+
+def _block_keys(coords):
+    coords = coords + _OFFSET
+    return (coords[:, 0] << (2 * _BITS)) | (coords[:, 1] << _BITS) | coords[:, 2]
+
+
+class VoxelHashTSDF:
+    """
+    Voxel-hashed TSDF volume in plain torch, meant to run on CPU.
+
+    Space is split into blocks of block_resolution^3 voxels that are only
+    allocated once a depth map touches them. Block coordinates are hashed to
+    int64 keys and kept sorted, so lookups are a searchsorted. Storage starts
+    at block_count blocks and doubles whenever it runs out.
+    """
+
+    def __init__(self, voxel_size, block_resolution=16, block_count=1024, trunc_multiplier=8.0, device="cpu"):
+        self.voxel_size = voxel_size
+        self.R = block_resolution
+        self.block_count = block_count
+        self.trunc = trunc_multiplier * voxel_size
+        self.device = torch.device(device)
+
+        self.keys = torch.empty(0, dtype=torch.long, device=self.device)
+        self.key_slots = torch.empty(0, dtype=torch.long, device=self.device)
+        self.block_coords = torch.zeros((block_count, 3), dtype=torch.long, device=self.device)
+        self.tsdf = torch.ones((block_count, self.R ** 3), dtype=torch.float32, device=self.device)
+        self.weight = torch.zeros((block_count, self.R ** 3), dtype=torch.float32, device=self.device)
+        self.color = torch.zeros((block_count, self.R ** 3, 3), dtype=torch.float32, device=self.device)
+        self.num_blocks = 0
+
+        r = torch.arange(self.R, device=self.device)
+        self.local = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).reshape(-1, 3)
+
+    def lookup(self, coords):
+        """
+        Slot of each block coordinate, -1 if the block is not allocated.
+        """
+        keys = _block_keys(coords)
+        if self.keys.shape[0] == 0:
+            return torch.full_like(keys, -1)
+        pos = torch.searchsorted(self.keys, keys).clamp(max=self.keys.shape[0] - 1)
+        found = self.keys[pos] == keys
+        return torch.where(found, self.key_slots[pos], torch.full_like(keys, -1))
+
+    def reserve(self, count):
+        """
+        Grow the block storage geometrically to hold at least count blocks.
+        """
+        new_count = self.block_count
+        while new_count < count:
+            new_count *= 2
+        grow = new_count - self.block_count
+        self.block_coords = torch.cat([self.block_coords, self.block_coords.new_zeros((grow, 3))])
+        self.tsdf = torch.cat([self.tsdf, self.tsdf.new_ones((grow, self.R ** 3))])
+        self.weight = torch.cat([self.weight, self.weight.new_zeros((grow, self.R ** 3))])
+        self.color = torch.cat([self.color, self.color.new_zeros((grow, self.R ** 3, 3))])
+        self.block_count = new_count
+
+    def activate(self, coords):
+        coords = torch.unique(coords, dim=0)
+        slots = self.lookup(coords)
+        new = slots < 0
+        num_new = int(new.sum())
+        if self.num_blocks + num_new > self.block_count:
+            self.reserve(self.num_blocks + num_new)
+        new_slots = torch.arange(self.num_blocks, self.num_blocks + num_new, device=self.device)
+        self.block_coords[new_slots] = coords[new]
+        slots[new] = new_slots
+        self.num_blocks += num_new
+
+        keys = torch.cat([self.keys, _block_keys(coords[new])])
+        key_slots = torch.cat([self.key_slots, new_slots])
+        order = torch.argsort(keys)
+        self.keys, self.key_slots = keys[order], key_slots[order]
+        return slots
+
+    def frustum_blocks(self, depth, intrinsic, extrinsic, depth_max, stride=4):
+        """
+        Blocks within the truncation distance of the back-projected depth map.
+        """
+        H, W = depth.shape
+        v, u = torch.meshgrid(torch.arange(0, H, stride, device=self.device),
+                              torch.arange(0, W, stride, device=self.device), indexing='ij')
+        d = depth[v, u]
+        valid = (d > 0) & (d < depth_max)
+        d, u, v = d[valid], u[valid].float(), v[valid].float()
+        cam = torch.stack([(u - intrinsic[0, 2]) * d / intrinsic[0, 0],
+                           (v - intrinsic[1, 2]) * d / intrinsic[1, 1], d], dim=-1)
+        c2w = torch.linalg.inv(extrinsic)
+        world = cam @ c2w[:3, :3].T + c2w[:3, 3]
+
+        block_len = self.voxel_size * self.R
+        coords = torch.unique(torch.floor(world / block_len).long(), dim=0)
+        r = int(np.ceil(self.trunc / block_len))
+        o = torch.arange(-r, r + 1, device=self.device)
+        offsets = torch.stack(torch.meshgrid(o, o, o, indexing='ij'), dim=-1).reshape(-1, 3)
+        return torch.unique((coords[:, None] + offsets[None]).reshape(-1, 3), dim=0)
+
+    @torch.no_grad()
+    def integrate(self, depths, colors, intrinsics, extrinsics, depth_max=6.0, chunk_blocks=256):
+        """
+        Fuse a batch of views at once. depths [V, H, W], colors [V, H, W, 3],
+        intrinsics [V, 3, 3] and world to camera extrinsics [V, 4, 4], all
+        tensors. Every view contributes with weight 1, which gives the same
+        result as integrating the views one after another.
+        """
+        depths, colors = depths.to(self.device), colors.to(self.device)
+        intrinsics, extrinsics = intrinsics.to(self.device).float(), extrinsics.to(self.device).float()
+        V, H, W = depths.shape
+
+        coords = torch.cat([self.frustum_blocks(depths[i], intrinsics[i], extrinsics[i], depth_max) for i in range(V)])
+        slots = self.activate(coords)
+
+        for start in range(0, slots.shape[0], chunk_blocks):
+            s = slots[start:start + chunk_blocks]
+            voxels = (self.block_coords[s][:, None] * self.R + self.local[None]).reshape(-1, 3)
+            pts = voxels.float() * self.voxel_size
+
+            tsdf_sum = torch.zeros(pts.shape[0], device=self.device)
+            weight_sum = torch.zeros(pts.shape[0], device=self.device)
+            color_sum = torch.zeros((pts.shape[0], 3), device=self.device)
+            for i in range(V):
+                K, E = intrinsics[i], extrinsics[i]
+                cam = pts @ E[:3, :3].T + E[:3, 3]
+                z = cam[:, 2]
+                u = torch.round(cam[:, 0] / z * K[0, 0] + K[0, 2]).long()
+                v = torch.round(cam[:, 1] / z * K[1, 1] + K[1, 2]).long()
+                valid = (z > 0) & (u >= 0) & (u < W) & (v >= 0) & (v < H)
+                idx = valid.nonzero(as_tuple=True)[0]
+                d = depths[i, v[idx], u[idx]]
+                sdf = d - z[idx]
+                keep = (d > 0) & (d < depth_max) & (sdf >= -self.trunc)
+                idx, sdf = idx[keep], sdf[keep]
+                tsdf_sum[idx] += torch.clamp(sdf / self.trunc, max=1.0)
+                weight_sum[idx] += 1
+                color_sum[idx] += colors[i, v[idx], u[idx]]
+
+            tsdf_sum = tsdf_sum.reshape(s.shape[0], -1)
+            weight_sum = weight_sum.reshape(s.shape[0], -1)
+            color_sum = color_sum.reshape(s.shape[0], -1, 3)
+            w = self.weight[s]
+            w_new = w + weight_sum
+            denom = w_new.clamp(min=1)
+            self.tsdf[s] = torch.where(weight_sum > 0, (self.tsdf[s] * w + tsdf_sum) / denom, self.tsdf[s])
+            self.color[s] = torch.where((weight_sum > 0)[..., None], (self.color[s] * w[..., None] + color_sum) / denom[..., None], self.color[s])
+            self.weight[s] = w_new
+
+    def query(self, voxels):
+        """
+        tsdf, weight and color of global voxel coordinates, weight 0 where the
+        block is not allocated.
+        """
+        blocks = torch.div(voxels, self.R, rounding_mode='floor')
+        local = voxels - blocks * self.R
+        local = (local[:, 0] * self.R + local[:, 1]) * self.R + local[:, 2]
+        slots = self.lookup(blocks)
+        found = slots >= 0
+        tsdf = torch.ones(voxels.shape[0], device=self.device)
+        weight = torch.zeros(voxels.shape[0], device=self.device)
+        color = torch.zeros((voxels.shape[0], 3), device=self.device)
+        tsdf[found] = self.tsdf[slots[found], local[found]]
+        weight[found] = self.weight[slots[found], local[found]]
+        color[found] = self.color[slots[found], local[found]]
+        return tsdf, weight, color
+
+    @torch.no_grad()
+    def extract_triangle_mesh(self, weight_threshold=3.0, chunk_blocks=256):
+        """
+        Marching cubes on every allocated block plus a one voxel apron from
+        its neighbours, stitched into one mesh. Returns world space vertices,
+        faces and vertex colors as numpy arrays.
+        """
+        S = self.R + 1
+        r = torch.arange(S, device=self.device)
+        apron = torch.stack(torch.meshgrid(r, r, r, indexing='ij'), dim=-1).reshape(-1, 3)
+        coords = self.block_coords[:self.num_blocks]
+        if self.num_blocks == 0:
+            return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.float32)
+
+        verts_list, faces_list = [], []
+        num_verts = 0
+        for start in tqdm(range(0, self.num_blocks, chunk_blocks), desc="TSDF marching cubes"):
+            origins = coords[start:start + chunk_blocks] * self.R
+            voxels = (origins[:, None] + apron[None]).reshape(-1, 3)
+            tsdf, weight, _ = self.query(voxels)
+            tsdf = tsdf.reshape(-1, S, S, S).cpu().numpy()
+            valid = (weight >= weight_threshold).reshape(-1, S, S, S).cpu().numpy()
+            for origin, block_tsdf, block_valid in zip(origins.cpu().numpy(), tsdf, valid):
+                if not block_valid.any():
+                    continue
+                values = block_tsdf[block_valid]
+                if values.min() > 0 or values.max() < 0:
+                    continue
+                verts, faces, _, _ = marching_cubes(block_tsdf, level=0.0, mask=block_valid)
+                if verts.shape[0] == 0:
+                    continue
+                verts_list.append(verts + origin)
+                faces_list.append(faces + num_verts)
+                num_verts += verts.shape[0]
+
+        if num_verts == 0:
+            return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.float32)
+
+        verts = np.concatenate(verts_list, axis=0)
+        faces = np.concatenate(faces_list, axis=0)
+        lo = coords.min(dim=0).values.cpu().numpy() * self.R
+        grid_dims = (coords.max(dim=0).values.cpu().numpy() * self.R + S) - lo
+        verts, faces = merge_block_vertices(verts - lo, faces, grid_dims)
+        verts = verts + lo
+
+        _, _, colors = self.query(torch.from_numpy(np.round(verts)).long().to(self.device))
+        return (verts * self.voxel_size).astype(np.float32), faces, colors.cpu().numpy()